@@ -11,49 +11,13 @@ from dotenv import load_dotenv
 # Загружаем настройки из .env файла
 load_dotenv()
 
-DATABASE_CONFIG = {
-    'host': os.getenv('DB_HOST'),
-    'port': int(os.getenv('DB_PORT')),
-    'database': os.getenv('DB_NAME'),
-    'user': os.getenv('DB_USER'),
-    'password': os.getenv('DB_PASSWORD')
-}
-
-def get_db_connection():
-    """Получить подключение к базе данных"""
-    try:
-        conn = psycopg2.connect(**DATABASE_CONFIG)
-        return conn
-    except psycopg2.Error as e:
-        print(f"Ошибка подключения к БД: {e}")
-        return None
-
-def execute_query(query, params=None, fetch=False, fetch_one=False):
-    """Выполнить SQL запрос"""
-    conn = get_db_connection()
-    if not conn:
-        print("❌ Нет подключения к БД")
-        return None
-    
-    try:
-        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
-            cur.execute(query, params)
-            
-            if fetch_one:
-                result = cur.fetchone()
-            elif fetch:
-                result = cur.fetchall()
-            else:
-                result = cur.rowcount
-                
-            conn.commit()
-            return result
-    except psycopg2.Error as e:
-        print(f"❌ Ошибка выполнения запроса: {e}")
-        conn.rollback()
-        return None
-    finally:
-        conn.close()
+from models.database import load_database_config, get_db_connection, execute_query, get_pool, init_app
+from models.query_stats import get_query_stats, reset_query_stats
+from models.dashboard import load_student_dashboard, load_children_dashboards
+from models.dashboard_cache import dashboard_cache, start_dashboard_cache
+from models.migrations import migration_status
+
+DATABASE_CONFIG = load_database_config()
 
 def get_student_by_name(student_name):
     """Получить ученика по имени"""
@@ -73,12 +37,6 @@ def check_user_login(login, password):
     result = execute_query(query, (login, password), fetch_one=True)
     return dict(result) if result else None
 
-def get_student_info(student_id):
-    """Получить информацию об ученике по ID"""
-    query = "SELECT * FROM students WHERE id = %s"
-    result = execute_query(query, (student_id,), fetch_one=True)
-    return dict(result) if result else None
-
 def authenticate_user(login, password):
     """Проверка логина и пароля пользователя"""
     query = """
@@ -89,83 +47,6 @@ def authenticate_user(login, password):
     result = execute_query(query, (login, password), fetch_one=True)
     return dict(result) if result else None
 
-def get_student_balance(student_id):
-    """Получить баланс ученика"""
-    query = """
-        SELECT 
-            COALESCE(SUM(amount), 0) as balance,
-            COALESCE(SUM(CASE WHEN amount > 0 THEN amount ELSE 0 END), 0) as total_paid,
-            COALESCE(SUM(CASE WHEN amount < 0 THEN ABS(amount) ELSE 0 END), 0) as total_spent
-        FROM payments
-        WHERE student_id = %s
-    """
-    result = execute_query(query, (student_id,), fetch_one=True)
-    return dict(result) if result else {'balance': 0, 'total_paid': 0, 'total_spent': 0}
-
-def get_student_lessons_count(student_id):
-    """Получить количество уроков ученика"""
-    query = """
-        SELECT 
-            COUNT(CASE WHEN status = 'completed' THEN 1 END) as completed_lessons,
-            COUNT(CASE WHEN status = 'cancelled' THEN 1 END) as cancelled_lessons,
-            COUNT(CASE WHEN status = 'scheduled' AND date >= CURRENT_DATE THEN 1 END) as planned_lessons
-        FROM lessons
-        WHERE student_id = %s
-    """
-    result = execute_query(query, (student_id,), fetch_one=True)
-    return dict(result) if result else {'completed_lessons': 0, 'cancelled_lessons': 0, 'planned_lessons': 0}
-
-def get_student_schedule_data(student_id):
-    """Получить данные расписания ученика"""
-    from datetime import datetime, timedelta
-    
-    # Получаем уроки на текущую неделю
-    today = datetime.now().date()
-    monday = today - timedelta(days=today.weekday())
-    sunday = monday + timedelta(days=6)
-    
-    query = """
-        SELECT date, time, subject, status, lesson_duration
-        FROM lessons
-        WHERE student_id = %s
-        AND date BETWEEN %s AND %s
-        ORDER BY date, time
-    """
-    result = execute_query(query, (student_id, monday, sunday), fetch=True)
-    
-    # Создаем структуру недели
-    week_days = ['Понедельник', 'Вторник', 'Среда', 'Четверг', 'Пятница', 'Суббота', 'Воскресенье']
-    week_data = []
-    
-    for i, day_name in enumerate(week_days):
-        current_date = monday + timedelta(days=i)
-        day_lessons = []
-        
-        if result:
-            for lesson in result:
-                if lesson['date'] == current_date:
-                    day_lessons.append({
-                        'time': lesson['time'].strftime('%H:%M'),
-                        'subject': lesson['subject'],
-                        'status': lesson['status']
-                    })
-        
-        week_data.append({
-            'day_name': day_name,
-            'day_number': current_date.day,
-            'full_date': current_date.strftime('%Y-%m-%d'),
-            'is_today': current_date == today,
-            'lessons': day_lessons
-        })
-    
-    return {
-        'week_data': week_data,
-        'week_info': {
-            'title': f'Неделя {today.isocalendar()[1]}, {today.year}',
-            'period': f'с {monday.strftime("%d.%m")} по {sunday.strftime("%d.%m")}'
-        }
-    }
-
 # Получаем данные уроков для таблицы
 def get_student_lesson_reports(student_id):
     """Получить отчеты по урокам ученика"""
@@ -231,53 +112,6 @@ def get_student_homework(student_id):
     print(f"🔍 ВСЕГО ДОМАШЕК: {len(homework)}")
     return homework
 
-def get_student_exam_results(student_id):
-    """Получить результаты пробников ученика"""
-    query = """
-        SELECT exam_date, primary_score, secondary_score
-        FROM exam_results
-        WHERE student_id = %s
-        ORDER BY exam_date DESC
-        LIMIT 10
-    """
-    result = execute_query(query, (student_id,), fetch=True)
-    
-    exam_scores = []
-    if result:
-        for row in result:
-            exam_scores.append({
-                'date': row['exam_date'].strftime('%d.%m'),
-                'score': row['secondary_score'] or row['primary_score'] or 0
-            })
-    
-    return exam_scores
-
-def get_student_topic_progress(student_id):
-    """Получить прогресс по темам ученика"""
-    query = """
-        SELECT understanding_level, COUNT(*) as count
-        FROM lesson_reports
-        WHERE student_id = %s
-        GROUP BY understanding_level
-    """
-    result = execute_query(query, (student_id,), fetch=True)
-    
-    progress = {'fully': 0, 'questions': 0, 'needWork': 0}
-    
-    if result:
-        for row in result:
-            level = row['understanding_level']
-            count = row['count']
-            
-            if level == 'Тема разобрана полностью':
-                progress['fully'] = count
-            elif level == 'Есть вопросы по теме':
-                progress['questions'] = count
-            elif level == 'Тему нужно закрепить':
-                progress['needWork'] = count
-    
-    return progress
-
 # Создаем Flask приложение
 app = Flask(__name__)
 
@@ -285,6 +119,24 @@ app = Flask(__name__)
 app.config['SECRET_KEY'] = 'your-secret-key-here'
 app.permanent_session_lifetime = timedelta(days=30)
 
+# Одно подключение и одна транзакция на каждый HTTP-запрос
+init_app(app)
+
+# Кэш кабинетов: Календаша сообщает об изменениях через LISTEN/NOTIFY
+start_dashboard_cache()
+
+def warn_pending_migrations():
+    """Сайт схему не меняет (это делают migrate.py и Календаша) - только предупреждает"""
+    try:
+        pending = [f"{version} ({name})" for version, name, applied in migration_status() if not applied]
+    except psycopg2.Error as e:
+        print(f"⚠️ Не удалось проверить миграции: {e}")
+        return
+    if pending:
+        print(f"⚠️ Не применены миграции: {', '.join(pending)} - запустите python migrate.py или Календашу")
+
+warn_pending_migrations()
+
 from flask import Flask, render_template, request, redirect, url_for, session
 
 @app.route('/')
@@ -417,53 +269,13 @@ def student_dashboard():
     if 'user_id' not in session or session.get('role') != 'student':
         return redirect(url_for('index'))
     
-    # Получаем данные ученика
+    # Все данные ЛКУ - одним запросом к базе
     student_id = session.get('student_id')
-    student = get_student_info(student_id)
+    student_data = load_student_dashboard(student_id)
     
-    if not student:
+    if not student_data:
         return redirect(url_for('login'))
     
-    # Собираем все данные для ЛКУ
-    balance_data = get_student_balance(student_id)
-    lessons_data = get_student_lessons_count(student_id)
-    schedule_data = get_student_schedule_data(student_id)
-    
-    # Данные для успеваемости
-    exam_results = get_student_exam_results(student_id)
-    topic_progress = get_student_topic_progress(student_id)
-    
-    # Рассчитываем запас уроков
-    lesson_price = student.get('lesson_price', 0)
-    current_balance = balance_data.get('balance', 0)
-    lessons_in_stock = int(current_balance / lesson_price) if lesson_price > 0 else 0
-
-    # Вызываем новые функции
-    lesson_reports = get_student_lesson_reports(student_id)
-    homework_data = get_student_homework(student_id)
-        
-    student_data = {
-        'name': student['name'],
-        'class': student.get('class_level', 'Не указан'),
-        'lesson_price': lesson_price,
-        'balance': current_balance,
-        'lessons_in_stock': lessons_in_stock,
-        'completed_lessons': lessons_data.get('completed_lessons', 0),
-        'cancelled_lessons': lessons_data.get('cancelled_lessons', 0), 
-        'planned_lessons': lessons_data.get('planned_lessons', 0),
-        'schedule': schedule_data,
-        'exam_results': exam_results,
-        'topic_progress': get_student_topic_progress(student_id),
-        'lesson_reports': lesson_reports,  # НОВОЕ
-        'homework_data': homework_data     # НОВОЕ
-    }
-    
-    # ОТЛАДКА - смотрим что передаем в шаблон
-    print("=== ДАННЫЕ ДЛЯ ЛКУ ===")
-    print(f"Данные ученика: {student_data}")
-    print("======================")
-    
-
     return render_template('student/dashboard.html', student=student_data)
 
 def get_parent_info(parent_id):
@@ -495,38 +307,8 @@ def parent_dashboard():
     # Получаем всех детей этого родителя
     children = get_parent_children(parent_info['parent_name'])
     
-    # Собираем данные для каждого ребенка
-    children_data = []
-    for child in children:
-        child_balance = get_student_balance(child['id'])
-        child_lessons = get_student_lessons_count(child['id'])
-        child_schedule = get_student_schedule_data(child['id'])
-        child_exam_results = get_student_exam_results(child['id'])
-        child_topic_progress = get_student_topic_progress(child['id'])
-        child_lesson_reports = get_student_lesson_reports(child['id'])
-        child_homework = get_student_homework(child['id'])
-        
-        # Рассчитываем запас уроков
-        lesson_price = child.get('lesson_price', 0)
-        current_balance = child_balance.get('balance', 0)
-        lessons_in_stock = int(current_balance / lesson_price) if lesson_price > 0 else 0
-        
-        children_data.append({
-            'id': child['id'],
-            'name': child['name'],
-            'class': child.get('class_level', 'Не указан'),
-            'lesson_price': lesson_price,
-            'balance': current_balance,
-            'lessons_in_stock': lessons_in_stock,
-            'completed_lessons': child_lessons.get('completed_lessons', 0),
-            'cancelled_lessons': child_lessons.get('cancelled_lessons', 0),
-            'planned_lessons': child_lessons.get('planned_lessons', 0),
-            'schedule': child_schedule,
-            'exam_results': child_exam_results,
-            'topic_progress': child_topic_progress,
-            'lesson_reports': child_lesson_reports,
-            'homework_data': child_homework
-        })
+    # Данные всех детей - одним набором запросов на всю семью
+    children_data = load_children_dashboards(children)
     
     parent_data = {
         'parent_name': parent_info.get('parent_name', 'Родитель'),
@@ -544,41 +326,11 @@ def admin_student_dashboard(student_id):
     if not admin_token:
         return redirect(url_for('index'))
 
-    # Получаем данные ученика (тот же код что в parent_dashboard для детей)
-    student = get_student_info(student_id)
-    if not student:
+    # Все данные ЛКУ - одним запросом к базе
+    student_data = load_student_dashboard(student_id)
+    if not student_data:
         return "Ученик не найден", 404
     
-    # Собираем все данные
-    student_balance = get_student_balance(student_id)
-    lessons_data = get_student_lessons_count(student_id)
-    schedule_data = get_student_schedule_data(student_id)
-    exam_results = get_student_exam_results(student_id)
-    topic_progress = get_student_topic_progress(student_id)
-    lesson_reports = get_student_lesson_reports(student_id)
-    homework_data = get_student_homework(student_id)
-    
-    # Рассчитываем запас уроков
-    lesson_price = student.get('lesson_price', 0)
-    current_balance = student_balance.get('balance', 0)
-    lessons_in_stock = int(current_balance / lesson_price) if lesson_price > 0 else 0
-    
-    student_data = {
-        'name': student['name'],
-        'class': student.get('class_level', 'Не указан'),
-        'lesson_price': lesson_price,
-        'balance': current_balance,
-        'lessons_in_stock': lessons_in_stock,
-        'completed_lessons': lessons_data.get('completed_lessons', 0),
-        'cancelled_lessons': lessons_data.get('cancelled_lessons', 0),
-        'planned_lessons': lessons_data.get('planned_lessons', 0),
-        'schedule': schedule_data,
-        'exam_results': exam_results,
-        'topic_progress': topic_progress,
-        'lesson_reports': lesson_reports,
-        'homework_data': homework_data
-    }
-    
     return render_template('student/dashboard.html', student=student_data)
 
 @app.route('/admin-parent/<parent_name>')
@@ -599,37 +351,8 @@ def admin_parent_dashboard(parent_name):
     if not children:
         return "Дети не найдены", 404
     
-    # Тот же код что в parent_dashboard()
-    children_data = []
-    for child in children:
-        child_balance = get_student_balance(child['id'])
-        child_lessons = get_student_lessons_count(child['id'])
-        child_schedule = get_student_schedule_data(child['id'])
-        child_exam_results = get_student_exam_results(child['id'])
-        child_topic_progress = get_student_topic_progress(child['id'])
-        child_lesson_reports = get_student_lesson_reports(child['id'])
-        child_homework = get_student_homework(child['id'])
-        
-        lesson_price = child.get('lesson_price', 0)
-        current_balance = child_balance.get('balance', 0)
-        lessons_in_stock = int(current_balance / lesson_price) if lesson_price > 0 else 0
-        
-        children_data.append({
-            'id': child['id'],
-            'name': child['name'],
-            'class': child.get('class_level', 'Не указан'),
-            'lesson_price': lesson_price,
-            'balance': current_balance,
-            'lessons_in_stock': lessons_in_stock,
-            'completed_lessons': child_lessons.get('completed_lessons', 0),
-            'cancelled_lessons': child_lessons.get('cancelled_lessons', 0),
-            'planned_lessons': child_lessons.get('planned_lessons', 0),
-            'schedule': child_schedule,
-            'exam_results': child_exam_results,
-            'topic_progress': child_topic_progress,
-            'lesson_reports': child_lesson_reports,
-            'homework_data': child_homework
-        })
+    # Тот же загрузчик, что в parent_dashboard()
+    children_data = load_children_dashboards(children)
     
     parent_data = {
         'parent_name': parent_name,
@@ -765,6 +488,25 @@ def test_db():
     except Exception as e:
         return f"<h2>Ошибка подключения:</h2><p>{str(e)}</p>"
 
+@app.route('/admin/db-pool')
+def db_pool_stats():
+    """Счетчики пула подключений (для подбора DB_POOL_MIN / DB_POOL_MAX)"""
+    if session.get('role') != 'admin':
+        return {"error": "Не авторизован"}, 401
+    return get_pool().stats()
+
+@app.route('/admin/query-stats')
+def query_stats():
+    """Время SQL-запросов: count/total/p50/p99, медленные запросы и подозрения на N+1"""
+    if session.get('role') != 'admin':
+        return {"error": "Не авторизован"}, 401
+    stats = get_query_stats()
+    stats['pool'] = get_pool().stats()
+    stats['dashboard_cache'] = dashboard_cache.stats()
+    if request.args.get('reset'):
+        reset_query_stats()
+    return stats
+
 @app.route('/logout')
 def logout():
     """Выход из системы"""
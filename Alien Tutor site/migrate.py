@@ -0,0 +1,18 @@
+"""Миграции схемы БД
+
+Запуск из папки сайта:
+    python migrate.py             # применить новые миграции
+    python migrate.py --status    # что применено, что нет
+    python migrate.py --explain   # планы горячих запросов до и после
+"""
+import sys
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from models.migrations import main
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,559 @@
+"""Данные личных кабинетов ученика (ЛКУ) и родителя (ЛКР) без запросов в цикле"""
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from models.dashboard_cache import MISS, dashboard_cache
+from models.database import execute_query, unit_of_work
+from models.recurrence import OCCURRENCES_SQL, PLANNED_HORIZON_DAYS, occurrence_params
+
+
+# Параллельная загрузка разделов ЛКР (по умолчанию выключена - запросы идут по очереди)
+DASHBOARD_CONCURRENT = os.getenv('DASHBOARD_CONCURRENT', '0').lower() in ('1', 'true', 'yes')
+DASHBOARD_WORKERS = int(os.getenv('DASHBOARD_WORKERS', 4))
+DASHBOARD_TIMEOUT = float(os.getenv('DASHBOARD_TIMEOUT', 5))
+
+
+WEEK_DAYS = ['Понедельник', 'Вторник', 'Среда', 'Четверг', 'Пятница', 'Суббота', 'Воскресенье']
+
+# Разделы кабинета (они же ключи кэша)
+SECTIONS = ('balances', 'counts', 'schedules', 'exams', 'topics', 'reports', 'homework')
+
+TOPIC_LEVELS = {
+    'fully': 'Тема разобрана полностью',
+    'questions': 'Есть вопросы по теме',
+    'needWork': 'Тему нужно закрепить'
+}
+
+# Все разделы ЛКУ одним запросом: каждый CTE - бывший отдельный запрос,
+# списки собираются в json_agg уже отформатированными (даты/время - строками).
+# occurrences - уроки по правилам шаблона недели с понедельника до горизонта планирования
+STUDENT_DASHBOARD_QUERY = f"""
+    WITH occurrences AS ({OCCURRENCES_SQL}),
+    student AS (
+        SELECT id, name, class_level, lesson_price
+        FROM students
+        WHERE id = %(student_id)s
+    ),
+    balance AS (
+        SELECT
+            COALESCE(MAX(balance), 0) as balance,
+            COALESCE(MAX(total_paid), 0) as total_paid,
+            COALESCE(MAX(total_spent), 0) as total_spent
+        FROM student_balances
+        WHERE student_id = %(student_id)s
+    ),
+    lessons_count AS (
+        SELECT
+            COUNT(CASE WHEN status = 'completed' THEN 1 END) as completed_lessons,
+            COUNT(CASE WHEN status = 'cancelled' THEN 1 END) as cancelled_lessons,
+            COUNT(CASE WHEN status = 'scheduled' AND date >= CURRENT_DATE THEN 1 END)
+                + (SELECT COUNT(*) FROM occurrences WHERE date >= CURRENT_DATE) as planned_lessons
+        FROM lessons
+        WHERE student_id = %(student_id)s
+    ),
+    schedule AS (
+        SELECT COALESCE(json_agg(json_build_object(
+                   'full_date', to_char(date, 'YYYY-MM-DD'),
+                   'time', to_char(time, 'HH24:MI'),
+                   'subject', subject,
+                   'status', status
+               ) ORDER BY date, time), '[]'::json) as lessons
+        FROM (
+            SELECT date, time, subject, status
+            FROM lessons
+            WHERE student_id = %(student_id)s
+            AND date BETWEEN %(monday)s AND %(sunday)s
+            UNION ALL
+            SELECT date, time, subject, status
+            FROM occurrences
+            WHERE date <= %(sunday)s
+        ) week_lessons
+    ),
+    exams AS (
+        SELECT COALESCE(json_agg(json_build_object(
+                   'date', to_char(exam_date, 'DD.MM'),
+                   'primary_score', primary_score,
+                   'secondary_score', secondary_score
+               ) ORDER BY exam_date DESC), '[]'::json) as rows
+        FROM (
+            SELECT exam_date, primary_score, secondary_score
+            FROM exam_results
+            WHERE student_id = %(student_id)s
+            ORDER BY exam_date DESC
+            LIMIT 10
+        ) e
+    ),
+    topics AS (
+        SELECT
+            COUNT(*) FILTER (WHERE understanding_level = %(fully)s) as fully,
+            COUNT(*) FILTER (WHERE understanding_level = %(questions)s) as questions,
+            COUNT(*) FILTER (WHERE understanding_level = %(needWork)s) as need_work
+        FROM lesson_reports
+        WHERE student_id = %(student_id)s
+    ),
+    reports AS (
+        SELECT COALESCE(json_agg(json_build_object(
+                   'date', to_char(created_at, 'DD.MM.YYYY'),
+                   'topic', topic,
+                   'understanding', understanding_level,
+                   'score', secondary_score,
+                   'feedback', teacher_comment
+               ) ORDER BY created_at DESC), '[]'::json) as rows
+        FROM (
+            SELECT lr.created_at, lr.topic, lr.understanding_level,
+                   lr.teacher_comment, er.secondary_score
+            FROM lesson_reports lr
+            LEFT JOIN exam_results er ON lr.student_id = er.student_id
+                                      AND DATE(lr.created_at) = er.exam_date
+            WHERE lr.student_id = %(student_id)s
+            ORDER BY lr.created_at DESC
+            LIMIT 10
+        ) r
+    ),
+    homework AS (
+        SELECT COALESCE(json_agg(json_build_object(
+                   'date', to_char(assignment_date, 'DD.MM.YYYY'),
+                   'topic', topic,
+                   'primary_score', primary_score,
+                   'secondary_score', secondary_score,
+                   'design_score', design_score,
+                   'solution_score', solution_score,
+                   'tasks_solved', tasks_solved,
+                   'tasks_assigned', tasks_assigned
+               ) ORDER BY assignment_date DESC), '[]'::json) as rows
+        FROM (
+            SELECT assignment_date, topic, primary_score, secondary_score,
+                   design_score, solution_score, tasks_solved, tasks_assigned
+            FROM homework_assignments
+            WHERE student_id = %(student_id)s
+            ORDER BY assignment_date DESC
+            LIMIT 10
+        ) h
+    )
+    SELECT student.*,
+           balance.balance, balance.total_paid, balance.total_spent,
+           lessons_count.completed_lessons, lessons_count.cancelled_lessons, lessons_count.planned_lessons,
+           schedule.lessons as schedule,
+           exams.rows as exam_results,
+           topics.fully, topics.questions, topics.need_work,
+           reports.rows as lesson_reports,
+           homework.rows as homework
+    FROM student
+    CROSS JOIN balance
+    CROSS JOIN lessons_count
+    CROSS JOIN schedule
+    CROSS JOIN exams
+    CROSS JOIN topics
+    CROSS JOIN reports
+    CROSS JOIN homework
+"""
+
+
+def current_week(today=None):
+    """Понедельник и воскресенье текущей недели"""
+    today = today or datetime.now().date()
+    monday = today - timedelta(days=today.weekday())
+    return today, monday, monday + timedelta(days=6)
+
+
+def build_week_schedule(lessons, today=None):
+    """Расписание недели для ЛКУ из уроков вида {'full_date', 'time', 'subject', 'status'}"""
+    today, monday, sunday = current_week(today)
+
+    by_date = {}
+    for lesson in lessons:
+        by_date.setdefault(lesson['full_date'], []).append({
+            'time': lesson['time'],
+            'subject': lesson['subject'],
+            'status': lesson['status']
+        })
+
+    week_data = []
+    for i, day_name in enumerate(WEEK_DAYS):
+        current_date = monday + timedelta(days=i)
+        full_date = current_date.strftime('%Y-%m-%d')
+        week_data.append({
+            'day_name': day_name,
+            'day_number': current_date.day,
+            'full_date': full_date,
+            'is_today': current_date == today,
+            'lessons': by_date.get(full_date, [])
+        })
+
+    return {
+        'week_data': week_data,
+        'week_info': {
+            'title': f'Неделя {today.isocalendar()[1]}, {today.year}',
+            'period': f'с {monday.strftime("%d.%m")} по {sunday.strftime("%d.%m")}'
+        }
+    }
+
+
+def build_exam_results(rows):
+    """Результаты пробников: вторичный балл, если нет - первичный"""
+    return [{
+        'date': row['date'],
+        'score': row['secondary_score'] or row['primary_score'] or 0
+    } for row in rows]
+
+
+def build_lesson_reports(rows):
+    """Отчеты по урокам для таблицы"""
+    return [{
+        'date': row['date'],
+        'topic': row['topic'],
+        'understanding': row['understanding'],
+        'score': row['score'] or '',
+        'feedback': row['feedback']
+    } for row in rows]
+
+
+def build_homework(rows):
+    """Домашние задания (пустые баллы - нули)"""
+    homework = []
+    for row in rows:
+        homework.append({
+            'date': row['date'],
+            'topic': row['topic'],
+            'primary_score': row['primary_score'] or 0,
+            # Автоматически копируем первичные баллы во вторичные (пока нет алгоритма)
+            'secondary_score': row['secondary_score'] or row['primary_score'] or 0,
+            'design_score': row['design_score'] or 0,
+            'solution_score': row['solution_score'] or 0,
+            'tasks_solved': row['tasks_solved'] or 0,
+            'tasks_assigned': row['tasks_assigned'] or 0
+        })
+    return homework
+
+
+def build_student_data(student, balance, lessons_count, schedule, exam_results,
+                       topic_progress, lesson_reports, homework_data):
+    """Словарь ученика для шаблонов ЛКУ/ЛКР"""
+    lesson_price = student.get('lesson_price', 0)
+    current_balance = balance.get('balance', 0)
+    lessons_in_stock = int(current_balance / lesson_price) if lesson_price > 0 else 0
+
+    return {
+        'name': student['name'],
+        'class': student.get('class_level', 'Не указан'),
+        'lesson_price': lesson_price,
+        'balance': current_balance,
+        'lessons_in_stock': lessons_in_stock,
+        'completed_lessons': lessons_count.get('completed_lessons', 0),
+        'cancelled_lessons': lessons_count.get('cancelled_lessons', 0),
+        'planned_lessons': lessons_count.get('planned_lessons', 0),
+        'schedule': schedule,
+        'exam_results': exam_results,
+        'topic_progress': topic_progress,
+        'lesson_reports': lesson_reports,
+        'homework_data': homework_data
+    }
+
+
+def _assemble_student(student, loaded, today):
+    """Собрать словарь ученика из сырых разделов (пустой раздел - значения по умолчанию)"""
+    topics = loaded.get('topics') or {}
+    return build_student_data(
+        student=student,
+        balance=loaded.get('balances') or {'balance': Decimal(0)},
+        lessons_count=loaded.get('counts') or {},
+        schedule=build_week_schedule(loaded.get('schedules') or [], today),
+        exam_results=build_exam_results(loaded.get('exams') or []),
+        topic_progress={
+            'fully': topics.get('fully', 0),
+            'questions': topics.get('questions', 0),
+            'needWork': topics.get('need_work', 0)
+        },
+        lesson_reports=build_lesson_reports(loaded.get('reports') or []),
+        homework_data=build_homework(loaded.get('homework') or [])
+    )
+
+
+def _split_dashboard_row(row):
+    """Строка STUDENT_DASHBOARD_QUERY -> сырые разделы (в том же виде, что и у ЛКР)"""
+    return {
+        'student': {key: row[key] for key in ('id', 'name', 'class_level', 'lesson_price')},
+        'balances': {key: row[key] for key in ('balance', 'total_paid', 'total_spent')},
+        'counts': {key: row[key] for key in ('completed_lessons', 'cancelled_lessons', 'planned_lessons')},
+        'schedules': row['schedule'],
+        'exams': row['exam_results'],
+        'topics': {key: row[key] for key in ('fully', 'questions', 'need_work')},
+        'reports': row['lesson_reports'],
+        'homework': row['homework']
+    }
+
+
+def load_student_dashboard(student_id, today=None):
+    """Все данные ЛКУ: из кэша или одним запросом; None, если ученика нет"""
+    today, monday, sunday = current_week(today)
+
+    version = dashboard_cache.version(student_id)
+    loaded = {key: dashboard_cache.get(student_id, key) for key in ('student',) + SECTIONS}
+
+    if any(value is MISS for value in loaded.values()):
+        params = {'student_id': student_id, 'monday': monday, 'sunday': sunday}
+        params.update(TOPIC_LEVELS)
+        params.update(_occurrence_window(monday, today, [student_id]))
+
+        row = execute_query(STUDENT_DASHBOARD_QUERY, params, fetch_one=True, name='student_dashboard')
+        if not row:
+            return None
+
+        loaded = _split_dashboard_row(row)
+        for key, value in loaded.items():
+            dashboard_cache.put(student_id, key, value, version)
+
+    return _assemble_student(loaded['student'], loaded, today)
+
+
+# Разделы для нескольких учеников сразу (ЛКР): каждый запрос выполняется один раз
+# для всех детей через student_id = ANY(...), строки делятся по ученикам в Python
+
+BALANCES_QUERY = """
+    SELECT student_id, balance, total_paid, total_spent
+    FROM student_balances
+    WHERE student_id = ANY(%(student_ids)s)
+"""
+
+LESSONS_COUNT_QUERY = f"""
+    WITH counts AS (
+        SELECT student_id,
+               COUNT(CASE WHEN status = 'completed' THEN 1 END) as completed_lessons,
+               COUNT(CASE WHEN status = 'cancelled' THEN 1 END) as cancelled_lessons,
+               COUNT(CASE WHEN status = 'scheduled' AND date >= CURRENT_DATE THEN 1 END) as planned_lessons
+        FROM lessons
+        WHERE student_id = ANY(%(student_ids)s)
+        GROUP BY student_id
+    ),
+    occurrences AS (
+        SELECT student_id, COUNT(*) as planned_lessons
+        FROM ({OCCURRENCES_SQL}) o
+        WHERE date >= CURRENT_DATE
+        GROUP BY student_id
+    )
+    SELECT COALESCE(c.student_id, o.student_id) as student_id,
+           COALESCE(c.completed_lessons, 0) as completed_lessons,
+           COALESCE(c.cancelled_lessons, 0) as cancelled_lessons,
+           COALESCE(c.planned_lessons, 0) + COALESCE(o.planned_lessons, 0) as planned_lessons
+    FROM counts c
+    FULL JOIN occurrences o ON o.student_id = c.student_id
+"""
+
+SCHEDULE_QUERY = f"""
+    SELECT student_id, to_char(date, 'YYYY-MM-DD') as full_date,
+           to_char(time, 'HH24:MI') as time, subject, status
+    FROM (
+        SELECT student_id, date, time, subject, status
+        FROM lessons
+        WHERE student_id = ANY(%(student_ids)s)
+        AND date BETWEEN %(monday)s AND %(sunday)s
+        UNION ALL
+        SELECT student_id, date, time, subject, status
+        FROM ({OCCURRENCES_SQL}) o
+        WHERE date <= %(sunday)s
+    ) week_lessons
+    ORDER BY date, time
+"""
+
+EXAMS_QUERY = """
+    SELECT student_id, to_char(exam_date, 'DD.MM') as date, primary_score, secondary_score
+    FROM (
+        SELECT student_id, exam_date, primary_score, secondary_score,
+               ROW_NUMBER() OVER (PARTITION BY student_id ORDER BY exam_date DESC) as rn
+        FROM exam_results
+        WHERE student_id = ANY(%(student_ids)s)
+    ) e
+    WHERE rn <= 10
+    ORDER BY exam_date DESC
+"""
+
+TOPICS_QUERY = """
+    SELECT student_id,
+           COUNT(*) FILTER (WHERE understanding_level = %(fully)s) as fully,
+           COUNT(*) FILTER (WHERE understanding_level = %(questions)s) as questions,
+           COUNT(*) FILTER (WHERE understanding_level = %(needWork)s) as need_work
+    FROM lesson_reports
+    WHERE student_id = ANY(%(student_ids)s)
+    GROUP BY student_id
+"""
+
+REPORTS_QUERY = """
+    SELECT student_id, to_char(created_at, 'DD.MM.YYYY') as date, topic,
+           understanding_level as understanding, secondary_score as score,
+           teacher_comment as feedback
+    FROM (
+        SELECT lr.student_id, lr.created_at, lr.topic, lr.understanding_level,
+               lr.teacher_comment, er.secondary_score,
+               ROW_NUMBER() OVER (PARTITION BY lr.student_id ORDER BY lr.created_at DESC) as rn
+        FROM lesson_reports lr
+        LEFT JOIN exam_results er ON lr.student_id = er.student_id
+                                  AND DATE(lr.created_at) = er.exam_date
+        WHERE lr.student_id = ANY(%(student_ids)s)
+    ) r
+    WHERE rn <= 10
+    ORDER BY created_at DESC
+"""
+
+HOMEWORK_QUERY = """
+    SELECT student_id, to_char(assignment_date, 'DD.MM.YYYY') as date, topic,
+           primary_score, secondary_score, design_score, solution_score,
+           tasks_solved, tasks_assigned
+    FROM (
+        SELECT *, ROW_NUMBER() OVER (PARTITION BY student_id ORDER BY assignment_date DESC) as rn
+        FROM homework_assignments
+        WHERE student_id = ANY(%(student_ids)s)
+    ) h
+    WHERE rn <= 10
+    ORDER BY assignment_date DESC
+"""
+
+
+def _occurrence_window(monday, today, student_ids):
+    """Окно уроков по правилам: с понедельника недели до горизонта планирования"""
+    return occurrence_params(monday, today + timedelta(days=PLANNED_HORIZON_DAYS), student_ids)
+
+
+def _rows_by_student(rows):
+    """Разложить строки по student_id (порядок строк сохраняется)"""
+    grouped = {}
+    for row in rows or []:
+        grouped.setdefault(row['student_id'], []).append(row)
+    return grouped
+
+
+def _row_by_student(rows):
+    """Одна агрегированная строка на ученика"""
+    return {row['student_id']: row for row in rows or []}
+
+
+def _load_section(key, query, params, group):
+    """Выполнить запрос раздела и разложить строки по ученикам (None - запрос не удался)"""
+    rows = execute_query(query, params, fetch=True, name=f'dashboard_{key}')
+    return group(rows) if rows is not None else None
+
+
+def _load_section_until(key, query, params, group, deadline):
+    """То же в потоке пула, но не дольше deadline (time.monotonic())
+
+    Своя транзакция с statement_timeout на оставшееся время: раздел, от которого
+    страница уже отказалась, прерывается базой и возвращает подключение в пул.
+    """
+    timeout_ms = int((deadline - time.monotonic()) * 1000)
+    if timeout_ms <= 0:
+        return None
+    with unit_of_work():
+        execute_query("SELECT set_config('statement_timeout', %s, true)", (f'{timeout_ms}ms',),
+                      fetch_one=True, name='dashboard_statement_timeout')
+        return _load_section(key, query, params, group)
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    """Общий ограниченный пул потоков для разделов ЛКР (создается при первом обращении)"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=DASHBOARD_WORKERS, thread_name_prefix='dashboard')
+        return _executor
+
+
+def _load_sections_concurrently(sections):
+    """Разделы параллельно, каждый на своем подключении из пула
+
+    Запросы в потоках идут вне транзакции HTTP-запроса. Раздел, не успевший
+    за DASHBOARD_TIMEOUT секунд, считается неудачным - как при ошибке запроса;
+    его запрос прерывает statement_timeout (см. _load_section_until).
+    """
+    started = time.perf_counter()
+    deadline = time.monotonic() + DASHBOARD_TIMEOUT
+    executor = _get_executor()
+    futures = {key: executor.submit(_load_section_until, key, *section, deadline)
+               for key, section in sections.items()}
+    wait(futures.values(), timeout=DASHBOARD_TIMEOUT)
+
+    loaded = {}
+    for key, future in futures.items():
+        if not future.done():
+            future.cancel()
+            print(f"⏱️ Раздел ЛКР {key} не загрузился за {DASHBOARD_TIMEOUT:g} с")
+            loaded[key] = None
+        elif future.exception() is not None:
+            print(f"❌ Ошибка загрузки раздела ЛКР {key}: {future.exception()}")
+            loaded[key] = None
+        else:
+            loaded[key] = future.result()
+
+    print(f"⚡ Разделы ЛКР загружены параллельно за {(time.perf_counter() - started) * 1000:.1f} мс")
+    return loaded
+
+
+def load_children_dashboards(children, today=None):
+    """Данные ЛКУ для каждого ребенка; число запросов не зависит от числа детей
+
+    Разделы, которые уже есть в кэше, не запрашиваются; запрос раздела идет
+    только по тем детям, у кого его в кэше нет.
+    """
+    if not children:
+        return []
+
+    today, monday, sunday = current_week(today)
+    child_ids = [child['id'] for child in children]
+    versions = {child_id: dashboard_cache.version(child_id) for child_id in child_ids}
+
+    loaded = {child_id: {} for child_id in child_ids}
+    missing = {}
+    for section in SECTIONS:
+        for child_id in child_ids:
+            value = dashboard_cache.get(child_id, section)
+            if value is MISS:
+                missing.setdefault(section, []).append(child_id)
+            else:
+                loaded[child_id][section] = value
+
+    queries = {
+        'balances': (BALANCES_QUERY, _row_by_student),
+        'counts': (LESSONS_COUNT_QUERY, _row_by_student),
+        'schedules': (SCHEDULE_QUERY, _rows_by_student),
+        'exams': (EXAMS_QUERY, _rows_by_student),
+        'topics': (TOPICS_QUERY, _row_by_student),
+        'reports': (REPORTS_QUERY, _rows_by_student),
+        'homework': (HOMEWORK_QUERY, _rows_by_student)
+    }
+    sections = {}
+    for section, ids in missing.items():
+        query, group = queries[section]
+        params = {'student_ids': ids, 'monday': monday, 'sunday': sunday}
+        if section == 'topics':
+            params.update(TOPIC_LEVELS)
+        if section in ('counts', 'schedules'):
+            params.update(_occurrence_window(monday, today, ids))
+        sections[section] = (query, params, group)
+
+    if DASHBOARD_CONCURRENT and len(sections) > 1:
+        results = _load_sections_concurrently(sections)
+    else:
+        results = {key: _load_section(key, *section) for key, section in sections.items()}
+
+    for section, grouped in results.items():
+        for child_id in missing[section]:
+            if grouped is None:
+                continue
+            value = grouped.get(child_id)
+            loaded[child_id][section] = value
+            dashboard_cache.put(child_id, section, value, versions[child_id])
+
+    children_data = []
+    for child in children:
+        children_data.append({
+            'id': child['id'],
+            **_assemble_student(child, loaded[child['id']], today)
+        })
+
+    return children_data
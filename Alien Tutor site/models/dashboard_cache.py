@@ -0,0 +1,110 @@
+"""Кэш разделов ЛКУ/ЛКР по ученикам, сбрасываемый событиями из Календаши"""
+import os
+import threading
+import time
+from datetime import date
+
+from models.events import get_listener, start_listener
+
+
+DASHBOARD_CACHE = os.getenv('DASHBOARD_CACHE', '1').lower() in ('1', 'true', 'yes')
+DASHBOARD_CACHE_TTL = float(os.getenv('DASHBOARD_CACHE_TTL', 600))   # страховка от потерянных событий
+
+# Какие разделы кабинета строятся из какой таблицы
+SECTIONS_BY_TABLE = {
+    'students': ('student',),
+    'payments': ('balances',),
+    'lessons': ('counts', 'schedules'),
+    'exam_results': ('exams', 'reports'),
+    'lesson_reports': ('topics', 'reports'),
+    'homework_assignments': ('homework',)
+}
+
+MISS = object()
+
+
+class DashboardCache:
+    """Разделы кабинета по ключу (student_id, раздел)
+
+    Кэш работает, только пока подключен слушатель событий: без него мы не узнаем
+    об изменениях. Записи живут до конца дня (расписание недели и "запланированные"
+    зависят от текущей даты) и не дольше ttl секунд.
+    """
+
+    def __init__(self, ttl=DASHBOARD_CACHE_TTL):
+        self.ttl = ttl
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._entries = {}       # (student_id, раздел) -> (значение, день, время записи)
+        self._versions = {}      # student_id -> номер версии, растет при каждом сбросе
+        self._generation = 0     # растет при полном сбросе
+        self._counters = {'hits': 0, 'misses': 0, 'invalidations': 0, 'resets': 0}
+
+    def version(self, student_id):
+        """Снимок версии до чтения из базы: сброс во время чтения не даст положить старые данные"""
+        with self._lock:
+            return self._generation, self._versions.get(student_id, 0)
+
+    def get(self, student_id, section):
+        with self._lock:
+            entry = self._entries.get((student_id, section)) if self.enabled else None
+            if entry is not None:
+                value, day, stored_at = entry
+                if day == date.today() and time.monotonic() - stored_at < self.ttl:
+                    self._counters['hits'] += 1
+                    return value
+                del self._entries[(student_id, section)]
+            self._counters['misses'] += 1
+            return MISS
+
+    def put(self, student_id, section, value, version):
+        with self._lock:
+            if not self.enabled or version != (self._generation, self._versions.get(student_id, 0)):
+                return
+            self._entries[(student_id, section)] = (value, date.today(), time.monotonic())
+
+    def invalidate(self, table, student_id=None):
+        """Сбросить разделы, построенные из таблицы (у одного ученика или у всех)"""
+        sections = SECTIONS_BY_TABLE.get(table)
+        if sections is None:
+            return
+        with self._lock:
+            self._counters['invalidations'] += 1
+            if student_id is None:
+                self._generation += 1
+                for key in [key for key in self._entries if key[1] in sections]:
+                    del self._entries[key]
+                return
+            self._versions[student_id] = self._versions.get(student_id, 0) + 1
+            for section in sections:
+                self._entries.pop((student_id, section), None)
+
+    def reset(self, enabled=None):
+        """Сбросить все (слушатель переподключился или отключился)"""
+        with self._lock:
+            self._counters['resets'] += 1
+            self._generation += 1
+            self._entries.clear()
+            if enabled is not None:
+                self.enabled = enabled
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters, enabled=self.enabled, entries=len(self._entries))
+
+
+dashboard_cache = DashboardCache()
+
+
+def _on_listener_reset():
+    """Слушатель (пере)подключился или отключился: события могли потеряться"""
+    listener = get_listener()
+    dashboard_cache.reset(enabled=listener is not None and listener.connected)
+
+
+def start_dashboard_cache():
+    """Включить кэш и подписаться на события Календаши"""
+    if not DASHBOARD_CACHE:
+        print("ℹ️ Кэш кабинетов выключен (DASHBOARD_CACHE=0)")
+        return None
+    return start_listener(dashboard_cache.invalidate, _on_listener_reset)
@@ -0,0 +1,517 @@
+"""Подключение к PostgreSQL: общий пул соединений для сайта и Календаши"""
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
+from flask import g, has_app_context
+
+from models.query_stats import record_query
+
+
+STREAM_BATCH_SIZE = int(os.getenv('DB_STREAM_BATCH_SIZE', 500))   # строк за один FETCH в stream_query
+
+
+def load_database_config():
+    """Настройки подключения из переменных окружения (.env загружает само приложение)"""
+    return {
+        'host': os.getenv('DB_HOST'),
+        'port': int(os.getenv('DB_PORT', 5432)),
+        'database': os.getenv('DB_NAME'),
+        'user': os.getenv('DB_USER'),
+        'password': os.getenv('DB_PASSWORD')
+    }
+
+
+def load_pool_settings():
+    """Размеры и таймауты пула из переменных окружения"""
+    return {
+        'minconn': int(os.getenv('DB_POOL_MIN', 1)),
+        'maxconn': int(os.getenv('DB_POOL_MAX', 10)),
+        'checkout_timeout': float(os.getenv('DB_POOL_TIMEOUT', 10)),
+        'max_lifetime': float(os.getenv('DB_POOL_MAX_LIFETIME', 1800)),
+        'max_idle': float(os.getenv('DB_POOL_MAX_IDLE', 300)),
+        'ping_after': float(os.getenv('DB_POOL_PING_AFTER', 30))
+    }
+
+
+class PoolTimeoutError(psycopg2.OperationalError):
+    """Свободное подключение не появилось за checkout_timeout секунд"""
+
+
+class ConnectionPool:
+    """Потокобезопасный пул подключений с проверкой и переиспользованием соединений
+
+    - minconn/maxconn: сколько соединений держим всегда и сколько максимум;
+    - checkout_timeout: сколько ждать свободное соединение, когда все заняты;
+    - max_lifetime: соединение старше этого возраста закрывается и пересоздается;
+    - max_idle: лишние (сверх minconn) соединения, простоявшие дольше, закрываются;
+    - ping_after: если соединение простаивало дольше, перед выдачей делаем SELECT 1.
+    """
+
+    def __init__(self, config, minconn=1, maxconn=10, checkout_timeout=10.0,
+                 max_lifetime=1800.0, max_idle=300.0, ping_after=30.0):
+        if maxconn < 1 or minconn < 0 or minconn > maxconn:
+            raise ValueError(f"Неверные размеры пула: min={minconn}, max={maxconn}")
+
+        self.config = config
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.checkout_timeout = checkout_timeout
+        self.max_lifetime = max_lifetime
+        self.max_idle = max_idle
+        self.ping_after = ping_after
+
+        self._lock = threading.Condition()
+        self._idle = []          # [(conn, время возврата в пул)], последний - самый "теплый"
+        self._born = {}          # id(conn) -> время создания
+        self._in_use = set()     # id(conn) выданных соединений
+        self._opening = 0        # соединения, которые сейчас открываются
+        self._closed = False
+
+        self._counters = {
+            'checkouts': 0,
+            'waits': 0,
+            'wait_time_total': 0.0,
+            'wait_time_max': 0.0,
+            'timeouts': 0,
+            'created': 0,
+            'recycled': 0,
+            'health_check_failures': 0,
+            'discarded': 0
+        }
+
+    # ------------------------------------------------------------------
+    # Служебные методы
+    # ------------------------------------------------------------------
+
+    def _size(self):
+        return len(self._idle) + len(self._in_use) + self._opening
+
+    def _connect(self):
+        conn = psycopg2.connect(**self.config)
+        with self._lock:
+            self._born[id(conn)] = time.monotonic()
+            self._counters['created'] += 1
+        return conn
+
+    def _close(self, conn):
+        self._born.pop(id(conn), None)
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def _is_expired(self, conn, now):
+        born = self._born.get(id(conn), now)
+        return self.max_lifetime > 0 and now - born > self.max_lifetime
+
+    def _is_healthy(self, conn, idle_since, now):
+        """Проверка соединения перед выдачей"""
+        if conn.closed:
+            return False
+        if conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            return False
+        if self.ping_after >= 0 and now - idle_since >= self.ping_after:
+            try:
+                with conn.cursor() as cur:
+                    cur.execute("SELECT 1")
+                conn.rollback()
+            except psycopg2.Error:
+                return False
+        return True
+
+    # ------------------------------------------------------------------
+    # Публичный интерфейс
+    # ------------------------------------------------------------------
+
+    def getconn(self):
+        """Взять соединение из пула (ждет не дольше checkout_timeout)"""
+        started = time.monotonic()
+        deadline = started + self.checkout_timeout
+        waited = False
+
+        while True:
+            conn = None
+            with self._lock:
+                if self._closed:
+                    raise psycopg2.InterfaceError("Пул подключений закрыт")
+
+                while not self._idle and self._size() >= self.maxconn:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._counters['timeouts'] += 1
+                        raise PoolTimeoutError(
+                            f"Нет свободных подключений к БД за {self.checkout_timeout} с "
+                            f"(занято {len(self._in_use)} из {self.maxconn})"
+                        )
+                    waited = True
+                    self._lock.wait(remaining)
+
+                if self._idle:
+                    conn, idle_since = self._idle.pop()
+                    self._in_use.add(id(conn))
+                else:
+                    self._opening += 1
+
+            if conn is None:
+                try:
+                    conn = self._connect()
+                finally:
+                    with self._lock:
+                        self._opening -= 1
+                        if conn is not None:
+                            self._in_use.add(id(conn))
+                        else:
+                            self._lock.notify()
+                break
+
+            now = time.monotonic()
+            if self._is_expired(conn, now):
+                with self._lock:
+                    self._in_use.discard(id(conn))
+                    self._counters['recycled'] += 1
+                    self._close(conn)
+                    self._lock.notify()
+                continue
+            if not self._is_healthy(conn, idle_since, now):
+                with self._lock:
+                    self._in_use.discard(id(conn))
+                    self._counters['health_check_failures'] += 1
+                    self._close(conn)
+                    self._lock.notify()
+                continue
+            break
+
+        wait_time = time.monotonic() - started
+        with self._lock:
+            self._counters['checkouts'] += 1
+            if waited:
+                self._counters['waits'] += 1
+                self._counters['wait_time_total'] += wait_time
+                self._counters['wait_time_max'] = max(self._counters['wait_time_max'], wait_time)
+        return conn
+
+    def putconn(self, conn, discard=False):
+        """Вернуть соединение в пул (discard=True - закрыть его вместо возврата)"""
+        now = time.monotonic()
+
+        if not discard and not conn.closed:
+            try:
+                # Незавершенная транзакция не должна утечь к следующему пользователю
+                if conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                discard = True
+
+        with self._lock:
+            self._in_use.discard(id(conn))
+
+            if discard or conn.closed or self._closed:
+                self._counters['discarded'] += 1
+                self._close(conn)
+            elif self._is_expired(conn, now):
+                self._counters['recycled'] += 1
+                self._close(conn)
+            else:
+                self._idle.append((conn, now))
+                self._trim_idle(now)
+
+            self._lock.notify()
+
+    def _trim_idle(self, now):
+        """Закрыть соединения сверх minconn, которые слишком долго простаивают"""
+        if self.max_idle <= 0:
+            return
+        total = self._size()
+        keep = []
+        for conn, idle_since in self._idle:
+            if now - idle_since > self.max_idle and total > self.minconn:
+                self._counters['recycled'] += 1
+                self._close(conn)
+                total -= 1
+            else:
+                keep.append((conn, idle_since))
+        self._idle = keep
+
+    def stats(self):
+        """Счетчики пула для подбора его размера под нагрузкой"""
+        with self._lock:
+            counters = dict(self._counters)
+            counters.update({
+                'size': self._size(),
+                'in_use': len(self._in_use),
+                'idle': len(self._idle),
+                'minconn': self.minconn,
+                'maxconn': self.maxconn
+            })
+        checkouts = counters['checkouts']
+        counters['wait_time_avg'] = counters['wait_time_total'] / counters['waits'] if counters['waits'] else 0.0
+        counters['wait_ratio'] = counters['waits'] / checkouts if checkouts else 0.0
+        return counters
+
+    def closeall(self):
+        """Закрыть все свободные соединения и больше не выдавать новые"""
+        with self._lock:
+            self._closed = True
+            for conn, _ in self._idle:
+                self._close(conn)
+            self._idle = []
+            self._lock.notify_all()
+
+
+# ============================================================================
+# ПУЛ ПРИЛОЖЕНИЯ
+# ============================================================================
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Пул текущего процесса (создается при первом обращении)"""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(load_database_config(), **load_pool_settings())
+    return _pool
+
+
+def get_db_connection():
+    """Получить подключение к базе данных из пула"""
+    try:
+        return get_pool().getconn()
+    except psycopg2.Error as e:
+        print(f"Ошибка подключения к БД: {e}")
+        return None
+
+
+def release_db_connection(conn, discard=False):
+    """Вернуть подключение в пул"""
+    get_pool().putconn(conn, discard=discard)
+
+
+# ============================================================================
+# ЕДИНИЦА РАБОТЫ: ОДНО ПОДКЛЮЧЕНИЕ И ОДНА ТРАНЗАКЦИЯ
+# ============================================================================
+
+class UnitOfWork:
+    """Одно подключение и одна транзакция на весь HTTP-запрос (или блок with)
+
+    Подключение берется из пула только при первом запросе к БД. Если какой-то
+    запрос упал, транзакция сразу откатывается (чтобы следующие чтения работали),
+    а в конце вместо COMMIT будет ROLLBACK - записи не применяются наполовину
+    (HTTP-запрос при этом получает ответ 500, а не ответ обработчика).
+    """
+
+    def __init__(self):
+        self.conn = None
+        self.failed = False
+        self.statements = 0
+
+    def connection(self):
+        if self.conn is None:
+            self.conn = get_db_connection()
+        return self.conn
+
+    def statement_failed(self):
+        """Запрос внутри транзакции упал: откатываем и помечаем всю единицу работы"""
+        self.failed = True
+        try:
+            self.conn.rollback()
+        except psycopg2.Error:
+            pass
+
+    def finish(self, commit=True):
+        """Завершить транзакцию и вернуть подключение в пул
+
+        Возвращает False только если сам COMMIT не удался.
+        """
+        conn, self.conn = self.conn, None
+        if conn is None:
+            return True
+
+        committed = True
+        broken = False
+        try:
+            if commit and not self.failed:
+                conn.commit()
+            else:
+                conn.rollback()
+        except psycopg2.Error as e:
+            print(f"❌ Ошибка завершения транзакции: {e}")
+            committed = False
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                broken = True
+        finally:
+            release_db_connection(conn, discard=broken or bool(conn.closed))
+        return committed
+
+
+_local = threading.local()
+
+
+def current_unit():
+    """Активная единица работы: запроса Flask или блока unit_of_work() в этом потоке"""
+    if has_app_context() and 'db_unit' in g:
+        return g.db_unit
+    return getattr(_local, 'unit', None)
+
+
+@contextmanager
+def unit_of_work():
+    """Выполнить блок в одной транзакции (вне HTTP-запроса: при старте, в фоне, из консоли)
+
+    Внутри уже открытой единицы работы просто присоединяется к ней.
+    """
+    unit = current_unit()
+    if unit is not None:
+        yield unit
+        return
+
+    unit = UnitOfWork()
+    _local.unit = unit
+    try:
+        yield unit
+    except Exception:
+        unit.finish(commit=False)
+        raise
+    else:
+        unit.finish(commit=True)
+    finally:
+        _local.unit = None
+
+
+def _failed_response(app, response, message):
+    """Ответ 500 вместо ответа обработчика (JSON - для JSON API)"""
+    if response.is_json:
+        return app.response_class(json.dumps({'success': False, 'error': message}, ensure_ascii=False),
+                                  status=500, mimetype='application/json')
+    return app.response_class(message, status=500)
+
+
+def init_app(app):
+    """Подключить единицу работы к каждому запросу приложения"""
+
+    @app.before_request
+    def begin_unit_of_work():
+        g.db_unit = UnitOfWork()
+
+    @app.after_request
+    def commit_unit_of_work(response):
+        unit = g.pop('db_unit', None)
+        if unit is None:
+            return response
+
+        # Какой-то запрос упал - транзакция уже откачена целиком, и обработчик
+        # не должен сообщить об успехе: все записи этого запроса потеряны
+        if unit.failed:
+            unit.finish(commit=False)
+            return _failed_response(app, response, "Ошибка базы данных: изменения не сохранены")
+
+        # Ответ 5xx - что-то пошло не так, ничего из запроса не сохраняем
+        if not unit.finish(commit=response.status_code < 500):
+            return _failed_response(app, response, "Ошибка сохранения данных")
+        return response
+
+    @app.teardown_request
+    def rollback_unit_of_work(exc):
+        # Сюда доходим с открытой транзакцией только если обработчик упал
+        unit = g.pop('db_unit', None)
+        if unit is not None:
+            unit.finish(commit=False)
+
+
+def execute_query(query, params=None, fetch=False, fetch_one=False, name=None):
+    """Выполнить SQL запрос
+
+    Внутри единицы работы запрос идет в ее транзакцию (COMMIT - в конце запроса),
+    иначе - отдельное подключение из пула и COMMIT сразу. Время выполнения
+    попадает в статистику под именем name (по умолчанию - функция, вызвавшая запрос).
+    """
+    unit = current_unit()
+    if unit is not None:
+        conn = unit.connection()
+    else:
+        conn = get_db_connection()
+    if not conn:
+        print("❌ Нет подключения к БД")
+        return None
+
+    broken = False
+    started = time.perf_counter()
+    try:
+        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+            cur.execute(query, params)
+
+            if fetch_one:
+                result = cur.fetchone()
+            elif fetch:
+                result = cur.fetchall()
+            else:
+                result = cur.rowcount
+
+            record_query(query, params, time.perf_counter() - started, name=name)
+
+            if unit is not None:
+                unit.statements += 1
+            else:
+                conn.commit()
+            return result
+    except psycopg2.Error as e:
+        print(f"❌ Ошибка выполнения запроса: {e}")
+        record_query(query, params, time.perf_counter() - started, name=name, failed=True)
+        if unit is not None:
+            unit.statement_failed()
+            return None
+        try:
+            conn.rollback()
+        except psycopg2.Error:
+            broken = True
+        return None
+    finally:
+        if unit is None:
+            release_db_connection(conn, discard=broken or bool(conn.closed))
+
+
+def stream_query(query, params=None, name=None, batch_size=STREAM_BATCH_SIZE):
+    """Строки большого запроса частями по batch_size через серверный (именованный) курсор
+
+    Генератор держит свое подключение из пула, а не подключение единицы работы:
+    его можно отдать в потоковый ответ Flask, который читается уже после конца
+    запроса. Только для чтения - транзакция в конце откатывается.
+
+    Ошибка базы пробрасывается дальше (в отличие от execute_query): потоковый ответ
+    обрывается, а не заканчивается как будто все строки прочитаны.
+    """
+    conn = get_db_connection()
+    if not conn:
+        print("❌ Нет подключения к БД")
+        return
+
+    broken = False
+    started = time.perf_counter()
+    try:
+        with conn.cursor(name='stream_query', cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+            cur.itersize = batch_size
+            cur.execute(query, params)
+            for row in cur:
+                yield row
+        record_query(query, params, time.perf_counter() - started, name=name)
+    except psycopg2.Error as e:
+        print(f"❌ Ошибка потокового запроса: {e}")
+        record_query(query, params, time.perf_counter() - started, name=name, failed=True)
+        raise
+    finally:
+        try:
+            conn.rollback()
+        except psycopg2.Error:
+            broken = True
+        release_db_connection(conn, discard=broken or bool(conn.closed))
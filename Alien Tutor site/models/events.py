@@ -0,0 +1,142 @@
+"""События об изменении данных между приложениями (PostgreSQL LISTEN/NOTIFY)
+
+Календаша после записи вызывает notify_change(таблица, student_id), сайт слушает
+канал в отдельном потоке и сбрасывает свой кэш только у затронутого ученика.
+"""
+import json
+import select
+import threading
+
+import psycopg2
+import psycopg2.extensions
+
+from models.database import execute_query, load_database_config
+
+
+CHANNEL = 'alien_tutor_changes'
+RECONNECT_DELAY = 5          # секунд между попытками переподключиться
+KEEPALIVE_INTERVAL = 30      # как часто проверяем, что соединение живо
+
+
+def notify_change(table, student_id=None):
+    """Сообщить об изменении таблицы (student_id=None - затронуты все ученики)
+
+    Внутри транзакции PostgreSQL отправит событие только после COMMIT,
+    при откате оно пропадет - слушатель не увидит несохраненных изменений.
+    """
+    payload = json.dumps({'table': table, 'student_id': student_id})
+    execute_query("SELECT pg_notify(%s, %s)", (CHANNEL, payload), fetch_one=True, name='notify_change')
+
+
+def notify_changes(tables, student_ids=None):
+    """То же для нескольких таблиц и учеников сразу"""
+    if isinstance(tables, str):
+        tables = [tables]
+    for table in tables:
+        if student_ids is None:
+            notify_change(table)
+            continue
+        for student_id in set(student_ids):
+            notify_change(table, student_id)
+
+
+class ChangeListener(threading.Thread):
+    """Фоновый поток: держит отдельное соединение с LISTEN и передает события подписчикам
+
+    Подписчик (subscribe) - пара обработчиков:
+    on_change(table, student_id) - пришло событие;
+    on_reset() - соединение (пере)установлено или потеряно: события могли потеряться.
+    """
+
+    def __init__(self):
+        super().__init__(name='change-listener', daemon=True)
+        self._subscribers = []
+        self._subscribers_lock = threading.Lock()
+        self.connected = False
+        self.events_received = 0
+        self._stopped = threading.Event()
+
+    def subscribe(self, on_change, on_reset):
+        """Добавить подписчика; если соединение уже есть, он сразу получает on_reset()"""
+        with self._subscribers_lock:
+            self._subscribers.append((on_change, on_reset))
+        if self.connected:
+            on_reset()
+
+    def subscribers(self):
+        with self._subscribers_lock:
+            return list(self._subscribers)
+
+    def on_change(self, table, student_id):
+        for on_change, _ in self.subscribers():
+            on_change(table, student_id)
+
+    def on_reset(self):
+        for _, on_reset in self.subscribers():
+            on_reset()
+
+    def stop(self):
+        self._stopped.set()
+
+    def run(self):
+        while not self._stopped.is_set():
+            conn = None
+            try:
+                conn = psycopg2.connect(**load_database_config())
+                conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                with conn.cursor() as cur:
+                    cur.execute(f"LISTEN {CHANNEL}")
+                self.connected = True
+                self.on_reset()
+                print(f"👂 Слушаем канал {CHANNEL}")
+                self._listen(conn)
+            except (psycopg2.Error, OSError) as e:
+                print(f"❌ Слушатель событий потерял соединение: {e}")
+            finally:
+                if self.connected:
+                    self.connected = False
+                    self.on_reset()
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except psycopg2.Error:
+                        pass
+            self._stopped.wait(RECONNECT_DELAY)
+
+    def _listen(self, conn):
+        while not self._stopped.is_set():
+            if select.select([conn], [], [], KEEPALIVE_INTERVAL) == ([], [], []):
+                # Тишина - убеждаемся, что соединение не оборвалось молча
+                with conn.cursor() as cur:
+                    cur.execute("SELECT 1")
+            else:
+                conn.poll()
+
+            while conn.notifies:
+                notify = conn.notifies.pop(0)
+                self.events_received += 1
+                try:
+                    event = json.loads(notify.payload)
+                except ValueError:
+                    print(f"⚠️ Непонятное событие в канале {CHANNEL}: {notify.payload}")
+                    continue
+                self.on_change(event.get('table'), event.get('student_id'))
+
+
+_listener = None
+_listener_lock = threading.Lock()
+
+
+def start_listener(on_change, on_reset):
+    """Подписаться на события; слушатель (поток и соединение) - один на процесс"""
+    global _listener
+    with _listener_lock:
+        if _listener is None:
+            _listener = ChangeListener()
+            _listener.start()
+        _listener.subscribe(on_change, on_reset)
+        return _listener
+
+
+def get_listener():
+    return _listener
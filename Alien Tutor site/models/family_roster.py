@@ -0,0 +1,128 @@
+"""Семьи учеников (2+ детей с одним parent_name) одним запросом
+
+Раньше get_families() делала GROUP BY и по запросу детей на каждую семью, а
+get_family_members / is_student_in_family заново строили все семьи ради одной.
+Теперь состав семей читается одним запросом в FamilyRoster: по parent_name и
+по имени ученика. Пока подключен слушатель событий, состав держится в памяти
+и сбрасывается при изменении students; без слушателя читается каждый раз.
+"""
+import os
+import threading
+import time
+
+from models.events import get_listener, start_listener
+from models.database import execute_query
+
+
+FAMILY_ROSTER_TTL = float(os.getenv('FAMILY_ROSTER_TTL', 600))   # страховка от потерянных событий
+
+# Все ученики с родителем; family_size - сколько детей у этого parent_name
+FAMILY_ROSTER_SQL = """
+    SELECT s.id, s.name, s.class_level, s.city, s.timezone, s.contact, s.notes, s.lesson_price,
+           s.parent_name,
+           COUNT(*) OVER (PARTITION BY s.parent_name) as family_size
+    FROM students s
+    WHERE s.parent_name IS NOT NULL AND s.parent_name != ''
+    ORDER BY s.parent_name, s.name
+"""
+
+CHILD_FIELDS = ('id', 'name', 'class_level', 'city', 'timezone', 'contact', 'notes', 'lesson_price')
+
+
+class FamilyRoster:
+    """Состав семей: families - parent_name -> дети, parents - имя ученика -> parent_name"""
+
+    def __init__(self, rows):
+        self.families = {}
+        self.parents = {}
+        for row in rows:
+            self.parents[row['name']] = row['parent_name'].strip()
+            if row['family_size'] > 1:
+                self.families.setdefault(row['parent_name'], []).append(
+                    {field: row[field] for field in CHILD_FIELDS})
+
+    @classmethod
+    def load(cls):
+        rows = execute_query(FAMILY_ROSTER_SQL, fetch=True, name='family_roster')
+        return cls(rows or [])
+
+    def members(self, parent_name):
+        return self.families.get(parent_name, [])
+
+    def parent_of(self, student_name):
+        """parent_name ученика (None - нет такого ученика или родитель не указан)"""
+        return self.parents.get(student_name)
+
+    def family_of(self, student_name):
+        """(ученик в семье из 2+ детей, parent_name)"""
+        parent_name = self.parent_of(student_name)
+        if not parent_name:
+            return False, None
+        return len(self.members(parent_name)) > 1, parent_name
+
+
+class FamilyRosterCache:
+    """Последний прочитанный FamilyRoster, пока слушатель событий подключен"""
+
+    def __init__(self, ttl=FAMILY_ROSTER_TTL):
+        self.ttl = ttl
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._roster = None
+        self._loaded_at = 0
+        self._generation = 0     # растет при каждом сбросе
+        self._counters = {'hits': 0, 'misses': 0, 'invalidations': 0}
+
+    def get(self):
+        with self._lock:
+            if self.enabled and self._roster is not None and time.monotonic() - self._loaded_at < self.ttl:
+                self._counters['hits'] += 1
+                return self._roster
+            self._counters['misses'] += 1
+            generation = self._generation
+
+        roster = FamilyRoster.load()
+        with self._lock:
+            # Сброс во время чтения - не кладем, возможно, старый состав
+            if self.enabled and generation == self._generation:
+                self._roster = roster
+                self._loaded_at = time.monotonic()
+        return roster
+
+    def invalidate(self, table=None, student_id=None):
+        """Сбросить состав, если изменились ученики (обработчик событий)"""
+        if table not in (None, 'students'):
+            return
+        with self._lock:
+            self._counters['invalidations'] += 1
+            self._generation += 1
+            self._roster = None
+
+    def reset(self, enabled=None):
+        with self._lock:
+            self._generation += 1
+            self._roster = None
+            if enabled is not None:
+                self.enabled = enabled
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters, enabled=self.enabled, loaded=self._roster is not None)
+
+
+family_roster = FamilyRosterCache()
+
+
+def get_family_roster():
+    return family_roster.get()
+
+
+def _on_listener_reset():
+    """Слушатель (пере)подключился или отключился: события могли потеряться"""
+    listener = get_listener()
+    family_roster.reset(enabled=listener is not None and listener.connected)
+
+
+def start_family_roster():
+    """Держать состав семей в памяти, сбрасывая его по событиям об учениках"""
+    return start_listener(family_roster.invalidate, _on_listener_reset)
@@ -0,0 +1,406 @@
+"""Сводная таблица балансов учеников (student_balances)
+
+Баланс больше не считается через SUM(amount) по всей истории платежей:
+каждая запись или удаление платежа в той же транзакции сдвигает строку ученика
+в student_balances, а проведенные уроки (lessons_taken) сдвигаются при смене
+статуса урока. Чтение баланса - одна строка по первичному ключу.
+
+Если сводка разошлась с платежами, reconcile() пересчитывает ее и сообщает расхождения.
+
+Контрольные точки (balance_checkpoints) - деньги ученика на момент закрытия месяца
+(close_month) или обнуления (reset_balance): пересчет берет последнюю точку и
+суммирует только платежи после нее, а обнуление больше не удаляет историю платежей.
+"""
+from decimal import Decimal
+
+from models.database import execute_query
+
+
+LEDGER_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS student_balances (
+        student_id INTEGER PRIMARY KEY REFERENCES students(id) ON DELETE CASCADE,
+        balance NUMERIC(12,2) NOT NULL DEFAULT 0,
+        total_paid NUMERIC(12,2) NOT NULL DEFAULT 0,
+        total_spent NUMERIC(12,2) NOT NULL DEFAULT 0,
+        lessons_taken INTEGER NOT NULL DEFAULT 0,
+        updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+    )
+"""
+
+# Сводка по всей истории платежей, без контрольных точек (так ее заполнила миграция 3)
+HISTORY_BALANCES_SQL = """
+    SELECT s.id as student_id,
+           COALESCE(p.balance, 0) as balance,
+           COALESCE(p.total_paid, 0) as total_paid,
+           COALESCE(p.total_spent, 0) as total_spent,
+           COALESCE(l.lessons_taken, 0) as lessons_taken
+    FROM students s
+    LEFT JOIN (
+        SELECT student_id,
+               SUM(amount) as balance,
+               SUM(CASE WHEN amount > 0 THEN amount ELSE 0 END) as total_paid,
+               SUM(CASE WHEN amount < 0 THEN ABS(amount) ELSE 0 END) as total_spent
+        FROM payments
+        WHERE student_id IS NOT NULL
+        GROUP BY student_id
+    ) p ON p.student_id = s.id
+    LEFT JOIN (
+        SELECT student_id, COUNT(*) as lessons_taken
+        FROM lessons
+        WHERE status = 'completed'
+        GROUP BY student_id
+    ) l ON l.student_id = s.id
+"""
+
+# last_payment_id - точка учитывает платежи ученика с id <= него; действует последняя
+# по id точка. kind: 'month_close' - закрытие месяца period, 'reset' - обнуление баланса
+CHECKPOINTS_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS balance_checkpoints (
+        id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        student_id INTEGER NOT NULL REFERENCES students(id) ON DELETE CASCADE,
+        kind VARCHAR(20) NOT NULL CHECK (kind IN ('month_close', 'reset')),
+        period DATE,
+        last_payment_id BIGINT NOT NULL DEFAULT 0,
+        balance NUMERIC(12,2) NOT NULL DEFAULT 0,
+        total_paid NUMERIC(12,2) NOT NULL DEFAULT 0,
+        total_spent NUMERIC(12,2) NOT NULL DEFAULT 0,
+        created_at TIMESTAMP NOT NULL DEFAULT NOW()
+    )
+"""
+
+# Деньги учеников: последняя контрольная точка + платежи после нее
+MONEY_BALANCES_SQL = """
+    SELECT s.id as student_id,
+           COALESCE(c.balance, 0) + COALESCE(p.balance, 0) as balance,
+           COALESCE(c.total_paid, 0) + COALESCE(p.total_paid, 0) as total_paid,
+           COALESCE(c.total_spent, 0) + COALESCE(p.total_spent, 0) as total_spent
+    FROM students s
+    LEFT JOIN LATERAL (
+        SELECT last_payment_id, balance, total_paid, total_spent
+        FROM balance_checkpoints
+        WHERE student_id = s.id
+        ORDER BY id DESC
+        LIMIT 1
+    ) c ON true
+    LEFT JOIN LATERAL (
+        SELECT SUM(amount) as balance,
+               SUM(CASE WHEN amount > 0 THEN amount ELSE 0 END) as total_paid,
+               SUM(CASE WHEN amount < 0 THEN ABS(amount) ELSE 0 END) as total_spent
+        FROM payments
+        WHERE student_id = s.id
+        AND id > COALESCE(c.last_payment_id, 0)
+    ) p ON true
+"""
+
+# Эталон: то, что должно лежать в сводке, посчитанное от контрольных точек
+EXPECTED_BALANCES_SQL = f"""
+    SELECT m.student_id, m.balance, m.total_paid, m.total_spent,
+           COALESCE(l.lessons_taken, 0) as lessons_taken
+    FROM ({MONEY_BALANCES_SQL}) m
+    LEFT JOIN (
+        SELECT student_id, COUNT(*) as lessons_taken
+        FROM lessons
+        WHERE status = 'completed'
+        GROUP BY student_id
+    ) l ON l.student_id = m.student_id
+"""
+
+# Закрытие месяца: точка для каждого ученика одним запросом (повторно - ничего не делает)
+CLOSE_MONTH_SQL = f"""
+    INSERT INTO balance_checkpoints (student_id, kind, period, last_payment_id, balance, total_paid, total_spent)
+    SELECT m.student_id, 'month_close', %(period)s,
+           (SELECT COALESCE(MAX(id), 0) FROM payments),
+           m.balance, m.total_paid, m.total_spent
+    FROM ({MONEY_BALANCES_SQL}) m
+    ON CONFLICT (student_id, period) WHERE kind = 'month_close' DO NOTHING
+"""
+
+# Удаленные платежи, которые уже "забыты" обнулением баланса
+FORGOTTEN_PAYMENTS_SQL = """
+    SELECT d.id
+    FROM unnest(%(ids)s::bigint[], %(student_ids)s::int[]) as d(id, student_id)
+    WHERE EXISTS (
+        SELECT 1 FROM balance_checkpoints c
+        WHERE c.student_id = d.student_id AND c.kind = 'reset' AND c.last_payment_id >= d.id
+    )
+"""
+
+# Удаленные платежи, вошедшие в закрытия месяцев: сдвигаем эти точки
+SHIFT_CHECKPOINTS_SQL = """
+    UPDATE balance_checkpoints c
+    SET balance = c.balance - d.balance,
+        total_paid = c.total_paid - d.total_paid,
+        total_spent = c.total_spent - d.total_spent
+    FROM (
+        SELECT k.id,
+               SUM(x.amount) as balance,
+               SUM(GREATEST(x.amount, 0)) as total_paid,
+               SUM(GREATEST(-x.amount, 0)) as total_spent
+        FROM unnest(%(ids)s::bigint[], %(student_ids)s::int[], %(amounts)s::numeric[]) as x(id, student_id, amount)
+        JOIN balance_checkpoints k ON k.student_id = x.student_id AND k.last_payment_id >= x.id
+        GROUP BY k.id
+    ) d
+    WHERE c.id = d.id
+"""
+
+LEDGER_FIELDS = ('balance', 'total_paid', 'total_spent', 'lessons_taken')
+
+EMPTY_BALANCE = {
+    'balance': Decimal(0),
+    'total_paid': Decimal(0),
+    'total_spent': Decimal(0),
+    'lessons_taken': 0
+}
+
+
+def _money(value):
+    """Сумма в Decimal без двоичных хвостов float"""
+    return value if isinstance(value, Decimal) else Decimal(str(value or 0))
+
+
+def lock_balance(student_id):
+    """Заблокировать строку сводки ученика до конца транзакции (строки нет - создать)
+
+    Берется до записи платежа ученика: тогда обнуление (reset_balance), которое
+    держит ту же строку, видит все платежи с меньшим id.
+    """
+    query = """
+        INSERT INTO student_balances (student_id) VALUES (%s)
+        ON CONFLICT (student_id) DO UPDATE SET updated_at = student_balances.updated_at
+    """
+    execute_query(query, (student_id,), name='ledger_lock_balance')
+
+
+def apply_delta(student_id, balance=0, total_paid=0, total_spent=0, lessons_taken=0):
+    """Сдвинуть сводку ученика (строка создается при первом сдвиге)"""
+    if student_id is None:
+        return
+    query = """
+        INSERT INTO student_balances (student_id, balance, total_paid, total_spent, lessons_taken, updated_at)
+        VALUES (%(student_id)s, %(balance)s, %(total_paid)s, %(total_spent)s, %(lessons_taken)s, NOW())
+        ON CONFLICT (student_id) DO UPDATE SET
+            balance = student_balances.balance + EXCLUDED.balance,
+            total_paid = student_balances.total_paid + EXCLUDED.total_paid,
+            total_spent = student_balances.total_spent + EXCLUDED.total_spent,
+            lessons_taken = student_balances.lessons_taken + EXCLUDED.lessons_taken,
+            updated_at = NOW()
+    """
+    execute_query(query, {
+        'student_id': student_id,
+        'balance': _money(balance),
+        'total_paid': _money(total_paid),
+        'total_spent': _money(total_spent),
+        'lessons_taken': lessons_taken
+    }, name='ledger_apply_delta')
+
+
+def record_payment(student_id, amount):
+    """Учесть новый платеж (пополнение, списание за урок, возврат)
+
+    Перед INSERT платежа вызывается lock_balance(student_id).
+    """
+    amount = _money(amount)
+    apply_delta(student_id,
+                balance=amount,
+                total_paid=max(amount, 0),
+                total_spent=max(-amount, 0))
+
+
+def remove_payments(rows):
+    """Учесть удаленные платежи: rows - строки из DELETE ... RETURNING id, student_id, amount
+
+    Платеж до обнуления баланса в нем уже не учтен - его удаление баланс не меняет;
+    платеж, вошедший в закрытие месяца, уменьшает и эту контрольную точку.
+    """
+    rows = [row for row in rows or [] if row['student_id'] is not None]
+    if not rows:
+        return
+    forgotten = execute_query(FORGOTTEN_PAYMENTS_SQL, {
+        'ids': [row['id'] for row in rows],
+        'student_ids': [row['student_id'] for row in rows]
+    }, fetch=True, name='ledger_forgotten_payments')
+    if forgotten is None:
+        return
+    forgotten = {row['id'] for row in forgotten}
+    rows = [row for row in rows if row['id'] not in forgotten]
+    if not rows:
+        return
+
+    execute_query(SHIFT_CHECKPOINTS_SQL, {
+        'ids': [row['id'] for row in rows],
+        'student_ids': [row['student_id'] for row in rows],
+        'amounts': [_money(row['amount']) for row in rows]
+    }, name='ledger_shift_checkpoints')
+
+    totals = {}
+    for row in rows:
+        amount = _money(row['amount'])
+        total = totals.setdefault(row['student_id'], [Decimal(0), Decimal(0), Decimal(0)])
+        total[0] -= amount
+        total[1] -= max(amount, 0)
+        total[2] -= max(-amount, 0)
+
+    for student_id, (balance, total_paid, total_spent) in totals.items():
+        apply_delta(student_id, balance=balance, total_paid=total_paid, total_spent=total_spent)
+
+
+def record_lesson_status(student_id, old_status, new_status):
+    """Урок сменил статус: пересчитываем проведенные уроки"""
+    delta = (new_status == 'completed') - (old_status == 'completed')
+    if delta:
+        apply_delta(student_id, lessons_taken=delta)
+
+
+def remove_lessons(rows):
+    """Учесть удаленные уроки: rows - строки из DELETE ... RETURNING student_id, status"""
+    completed = {}
+    for row in rows or []:
+        if row['status'] == 'completed' and row['student_id'] is not None:
+            completed[row['student_id']] = completed.get(row['student_id'], 0) + 1
+
+    for student_id, count in completed.items():
+        apply_delta(student_id, lessons_taken=-count)
+
+
+def _zero_money(student_ids=None):
+    query = "UPDATE student_balances SET balance = 0, total_paid = 0, total_spent = 0, updated_at = NOW()"
+    if student_ids is None:
+        execute_query(query)
+    else:
+        execute_query(query + " WHERE student_id = ANY(%s)", (list(student_ids),))
+
+
+def reset_payments(student_ids=None):
+    """Все платежи учеников удалены - обнуляем денежную часть сводки и точки (None - у всех)"""
+    if student_ids is None:
+        execute_query("DELETE FROM balance_checkpoints")
+    else:
+        execute_query("DELETE FROM balance_checkpoints WHERE student_id = ANY(%s)", (list(student_ids),))
+    _zero_money(student_ids)
+
+
+def reset_balance(student_id):
+    """Обнулить баланс ученика контрольной точкой 'reset' - история платежей остается
+
+    Платежи ученика до точки в балансе больше не учитываются. Блокируется только
+    строка сводки ученика: платежи ученика пишутся под ней же (lock_balance),
+    поэтому платеж с меньшим id не появится после точки.
+    """
+    lock_balance(student_id)
+    query = """
+        INSERT INTO balance_checkpoints (student_id, kind, last_payment_id)
+        SELECT %(student_id)s, 'reset', COALESCE(MAX(id), 0)
+        FROM payments
+        WHERE student_id = %(student_id)s
+    """
+    if not execute_query(query, {'student_id': student_id}):
+        return False
+    _zero_money([student_id])
+    return True
+
+
+def month_closed(period):
+    """Месяц (первое число) уже закрыт хотя бы у одного ученика"""
+    query = "SELECT EXISTS (SELECT 1 FROM balance_checkpoints WHERE kind = 'month_close' AND period = %s) as closed"
+    result = execute_query(query, (period,), fetch_one=True)
+    return bool(result and result['closed'])
+
+
+def close_month(period):
+    """Закрыть месяц (period - первое число): контрольная точка всем ученикам одним запросом
+
+    Точка - деньги ученика на момент закрытия (все записанные к этому времени
+    платежи). Возвращает число новых точек, None при ошибке.
+
+    Вызывать в отдельной транзакции, где еще ничего не записано: блокировки берутся
+    первыми - платежи (дождаться начатых записей), затем точки (дождаться обнулений).
+    Со строками student_balances закрытие не пересекается, поэтому не ждет тех,
+    кто держит их и пишет платеж.
+    """
+    execute_query("LOCK TABLE payments IN SHARE MODE")
+    execute_query("LOCK TABLE balance_checkpoints IN EXCLUSIVE MODE")
+    return execute_query(CLOSE_MONTH_SQL, {'period': period}, name='ledger_close_month')
+
+
+def reset_lessons(student_ids=None):
+    """Все уроки учеников удалены - обнуляем проведенные уроки (None - у всех)"""
+    query = "UPDATE student_balances SET lessons_taken = 0, updated_at = NOW()"
+    if student_ids is None:
+        execute_query(query)
+    else:
+        execute_query(query + " WHERE student_id = ANY(%s)", (list(student_ids),))
+
+
+def get_balance(student_id):
+    """Сводка одного ученика (нет строки - нули)"""
+    query = """
+        SELECT balance, total_paid, total_spent, lessons_taken
+        FROM student_balances
+        WHERE student_id = %s
+    """
+    result = execute_query(query, (student_id,), fetch_one=True)
+    return dict(result) if result else dict(EMPTY_BALANCE)
+
+
+def get_balances(student_ids=None):
+    """Сводки учеников: {student_id: {...}} (None - всех)"""
+    query = "SELECT student_id, balance, total_paid, total_spent, lessons_taken FROM student_balances"
+    if student_ids is None:
+        result = execute_query(query, fetch=True)
+    else:
+        result = execute_query(query + " WHERE student_id = ANY(%s)", (list(student_ids),), fetch=True)
+    return {row['student_id']: dict(row) for row in result or []}
+
+
+def reconcile(fix=True):
+    """Сверить сводку с платежами и уроками; при fix=True - переписать расхождения
+
+    Возвращает список расхождений: student_id, поле, было в сводке, должно быть.
+    Вызывать внутри unit_of_work(): на время сверки запись платежей и уроков
+    блокируется, иначе параллельный платеж мог бы потеряться при перезаписи.
+    """
+    if fix:
+        execute_query("LOCK TABLE payments, lessons IN SHARE MODE")
+    expected = execute_query(EXPECTED_BALANCES_SQL, fetch=True)
+    if expected is None:
+        return None
+    stored = get_balances()
+
+    drift = []
+    for row in expected:
+        current = stored.get(row['student_id'], EMPTY_BALANCE)
+        for field in LEDGER_FIELDS:
+            if current[field] != row[field]:
+                drift.append({
+                    'student_id': row['student_id'],
+                    'field': field,
+                    'stored': current[field],
+                    'expected': row[field]
+                })
+
+    if fix and drift:
+        query = f"""
+            INSERT INTO student_balances (student_id, balance, total_paid, total_spent, lessons_taken, updated_at)
+            SELECT student_id, balance, total_paid, total_spent, lessons_taken, NOW()
+            FROM ({EXPECTED_BALANCES_SQL}) expected
+            WHERE student_id = ANY(%s)
+            ON CONFLICT (student_id) DO UPDATE SET
+                balance = EXCLUDED.balance,
+                total_paid = EXCLUDED.total_paid,
+                total_spent = EXCLUDED.total_spent,
+                lessons_taken = EXCLUDED.lessons_taken,
+                updated_at = NOW()
+        """
+        execute_query(query, (sorted({item['student_id'] for item in drift}),), name='ledger_rebuild')
+
+    return drift
+
+
+def ensure_ledger():
+    """Создать student_balances, если ее еще нет, и заполнить из платежей"""
+    exists = execute_query("SELECT to_regclass('student_balances') IS NOT NULL as exists", fetch_one=True)
+    if exists is None or exists['exists']:
+        return
+    execute_query(LEDGER_TABLE_SQL)
+    drift = reconcile(fix=True)
+    print(f"✅ Создана сводка балансов student_balances (учеников: {len({item['student_id'] for item in drift or []})})")
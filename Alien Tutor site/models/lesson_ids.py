@@ -0,0 +1,25 @@
+"""id уроков: BIGINT из последовательности (миграция 8)
+
+Раньше id урока был str(uuid4())[:8]; он остался в lessons.legacy_id, чтобы
+работали старые ссылки вида /schedule/lesson/<id>/edit.
+"""
+from models.database import execute_query
+
+
+LEGACY_ID_LENGTH = 8
+
+
+def find_lesson_id(lesson_id):
+    """id урока в lessons по id из URL/формы (число или старый 8-символьный id); None - нет такого"""
+    if lesson_id is None or isinstance(lesson_id, bool):
+        return None
+    if isinstance(lesson_id, int):
+        return lesson_id
+
+    value = str(lesson_id).strip()
+    # Старый id мог состоять из одних цифр - такие сначала ищем среди старых
+    if not value.isdigit() or len(value) == LEGACY_ID_LENGTH:
+        result = execute_query("SELECT id FROM lessons WHERE legacy_id = %s", (value,), fetch_one=True)
+        if result:
+            return result['id']
+    return int(value) if value.isdigit() else None
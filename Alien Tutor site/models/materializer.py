@@ -0,0 +1,106 @@
+"""Применение шаблона недели одним запросом
+
+Для каждой строки lesson_templates все даты нужного дня недели считаются
+в SQL (generate_series с шагом 7 дней) и вставляются одним INSERT ... SELECT.
+Урок не создается, если у ученика уже есть урок, изначально стоявший на эту
+дату и время (в т.ч. перенесенный), или урок, перенесенный на это время.
+Уникальный ключ (student_id, original_date, original_time) для уроков из
+шаблона (миграция 5) не дает создать дубль при параллельном применении.
+Как и в OCCURRENCES_SQL, не создаются удаленные уроки (lesson_skips) и даты
+до rule_start - начала действия текущей версии правила.
+"""
+from datetime import date, timedelta
+
+from models.database import execute_query
+from models.events import notify_changes
+
+
+DEFAULT_HORIZON_DAYS = 365
+
+MATERIALIZE_TEMPLATES_SQL = """
+    WITH templates AS (
+        SELECT lt.student_id, lt.time, lt.subject,
+               COALESCE(lt.lesson_type, 'regular') as lesson_type,
+               COALESCE(lt.lesson_duration, 60) as lesson_duration,
+               lt.weekday as isodow,
+               COALESCE(lt.start_date, %(today)s) as start_date,
+               COALESCE(lt.end_date, %(horizon)s) as end_date,
+               lt.rule_start
+        FROM lesson_templates lt
+        JOIN students s ON s.id = lt.student_id
+        WHERE lt.time IS NOT NULL
+    ),
+    candidates AS (
+        SELECT t.*, day::date as day
+        FROM templates t
+        CROSS JOIN LATERAL generate_series(
+            t.start_date + ((t.isodow - EXTRACT(ISODOW FROM t.start_date)::int + 7) %% 7),
+            t.end_date,
+            INTERVAL '7 days'
+        ) as day
+        WHERE t.isodow IS NOT NULL
+        AND day::date + t.time >= t.rule_start
+    ),
+    clipped AS (
+        -- Даты окна по умолчанию [today, horizon], которые отрезал период шаблона
+        SELECT COUNT(*) as clipped
+        FROM templates t
+        CROSS JOIN LATERAL generate_series(
+            %(today)s + ((t.isodow - EXTRACT(ISODOW FROM %(today)s::date)::int + 7) %% 7),
+            %(horizon)s,
+            INTERVAL '7 days'
+        ) as day
+        WHERE t.isodow IS NOT NULL
+        AND (day::date < t.start_date OR day::date > t.end_date)
+    ),
+    inserted AS (
+        INSERT INTO lessons (student_id, date, time, subject, status, lesson_type, lesson_duration,
+                             from_template, is_paid, original_date, original_time, is_moved, created_at)
+        SELECT c.student_id, c.day, c.time, c.subject, 'scheduled',
+               c.lesson_type, c.lesson_duration, true, false, c.day, c.time, false, NOW()
+        FROM candidates c
+        WHERE NOT EXISTS (
+            SELECT 1 FROM lessons l
+            WHERE l.student_id = c.student_id
+            AND ((l.original_date = c.day AND l.original_time = c.time)
+                 OR (l.date = c.day AND l.time = c.time))
+        )
+        AND NOT EXISTS (
+            SELECT 1 FROM lesson_skips k
+            WHERE k.student_id = c.student_id
+            AND k.original_date = c.day
+            AND k.original_time = c.time
+        )
+        ON CONFLICT (student_id, original_date, original_time) WHERE from_template = true DO NOTHING
+        RETURNING student_id
+    )
+    SELECT (SELECT COUNT(*) FROM candidates) as candidates,
+           (SELECT COUNT(*) FROM inserted) as added,
+           (SELECT clipped FROM clipped) as clipped,
+           (SELECT array_agg(DISTINCT student_id) FROM inserted) as student_ids
+"""
+
+
+def materialize_templates(today=None, horizon_days=DEFAULT_HORIZON_DAYS):
+    """Создать уроки по шаблону недели; None при ошибке, иначе
+
+    {'added': создано, 'skipped': уже были (или перенесены на это время),
+     'clipped': отрезано периодом шаблона из окна [today, today + horizon_days]}
+    Без периода шаблон действует с today по today + horizon_days.
+    """
+    today = today or date.today()
+    result = execute_query(MATERIALIZE_TEMPLATES_SQL, {
+        'today': today,
+        'horizon': today + timedelta(days=horizon_days)
+    }, fetch_one=True, name='materialize_templates')
+    if result is None:
+        return None
+
+    student_ids = result['student_ids'] or []
+    if student_ids:
+        notify_changes('lessons', student_ids)
+    return {
+        'added': result['added'],
+        'skipped': result['candidates'] - result['added'],
+        'clipped': result['clipped']
+    }
@@ -0,0 +1,570 @@
+"""Версионные миграции схемы БД (общие для сайта и Календаши)
+
+Каждая миграция - номер, имя и список SQL-команд; применяется в своей транзакции
+и записывается в schema_migrations. Запуск - migrate.py в папке любого приложения:
+
+    python migrate.py             # применить новые миграции
+    python migrate.py --status    # что применено, что нет
+    python migrate.py --explain   # планы горячих запросов до и после миграций
+"""
+import argparse
+from datetime import date
+
+import psycopg2
+
+from models.database import execute_query, unit_of_work
+from models.ledger import CHECKPOINTS_TABLE_SQL, HISTORY_BALANCES_SQL, LEDGER_TABLE_SQL
+
+
+# Схема из "Структура базы данных.txt" (типы - по тому, как с колонками работает код)
+INITIAL_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS students (
+        id SERIAL PRIMARY KEY,
+        name VARCHAR(255) NOT NULL,
+        class_level VARCHAR(50),
+        city VARCHAR(100),
+        timezone VARCHAR(20),
+        parent_name VARCHAR(255),
+        contact TEXT,
+        notes TEXT,
+        lesson_price NUMERIC(10,2) DEFAULT 0,
+        created_at TIMESTAMP DEFAULT NOW()
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS user_accounts (
+        id SERIAL PRIMARY KEY,
+        student_id INTEGER REFERENCES students(id),
+        role VARCHAR(20),
+        login VARCHAR(255),
+        password VARCHAR(255),
+        full_name VARCHAR(255),
+        last_login TIMESTAMP,
+        created_at TIMESTAMP DEFAULT NOW()
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS lessons (
+        id VARCHAR(20) PRIMARY KEY,
+        student_id INTEGER REFERENCES students(id),
+        date DATE,
+        time TIME,
+        day_of_week VARCHAR(20),
+        subject VARCHAR(255),
+        status VARCHAR(20) DEFAULT 'scheduled',
+        lesson_type VARCHAR(20) DEFAULT 'regular',
+        lesson_duration INTEGER DEFAULT 60,
+        from_template BOOLEAN DEFAULT FALSE,
+        is_paid BOOLEAN DEFAULT FALSE,
+        created_at TIMESTAMP DEFAULT NOW(),
+        original_date DATE,
+        original_time TIME,
+        is_moved BOOLEAN DEFAULT FALSE,
+        moved_reason TEXT
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS lesson_templates (
+        id SERIAL PRIMARY KEY,
+        day_of_week VARCHAR(20),
+        time TIME,
+        student_id INTEGER REFERENCES students(id),
+        subject VARCHAR(255),
+        start_date DATE,
+        end_date DATE,
+        lesson_type VARCHAR(20),
+        lesson_duration INTEGER,
+        created_at TIMESTAMP DEFAULT NOW()
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS available_slots (
+        id VARCHAR(20) PRIMARY KEY,
+        day_of_week VARCHAR(20),
+        time TIME,
+        duration INTEGER,
+        slot_type VARCHAR(20),
+        created_at TIMESTAMP DEFAULT NOW()
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS payments (
+        id VARCHAR(20) PRIMARY KEY,
+        student_id INTEGER REFERENCES students(id),
+        amount NUMERIC(10,2),
+        payment_type VARCHAR(30),
+        description TEXT,
+        lesson_id VARCHAR(20),
+        payment_date TIMESTAMP,
+        created_at TIMESTAMP DEFAULT NOW()
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS families (
+        id SERIAL PRIMARY KEY,
+        parent_name VARCHAR(255),
+        family_balance NUMERIC(10,2) DEFAULT 0,
+        total_family_paid NUMERIC(10,2) DEFAULT 0,
+        total_family_spent NUMERIC(10,2) DEFAULT 0,
+        created_at TIMESTAMP DEFAULT NOW()
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS lesson_reports (
+        id SERIAL PRIMARY KEY,
+        lesson_id VARCHAR(20),
+        student_id INTEGER REFERENCES students(id),
+        topic TEXT,
+        understanding_level VARCHAR(100),
+        teacher_comment TEXT,
+        homework_assigned TEXT,
+        created_at TIMESTAMP DEFAULT NOW()
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS homework_assignments (
+        id SERIAL PRIMARY KEY,
+        student_id INTEGER REFERENCES students(id),
+        lesson_id VARCHAR(20),
+        assignment_date DATE,
+        primary_score INTEGER,
+        secondary_score INTEGER,
+        tasks_solved INTEGER,
+        solution_score INTEGER,
+        topic TEXT,
+        tasks_assigned INTEGER,
+        created_at TIMESTAMP DEFAULT NOW(),
+        is_checked BOOLEAN DEFAULT FALSE,
+        checked_date TIMESTAMP,
+        design_score INTEGER
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS exam_results (
+        id SERIAL PRIMARY KEY,
+        student_id INTEGER REFERENCES students(id),
+        exam_date DATE,
+        exam_type VARCHAR(50),
+        primary_score INTEGER,
+        secondary_score INTEGER,
+        tasks_solved INTEGER,
+        grade VARCHAR(10),
+        created_at TIMESTAMP DEFAULT NOW()
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS topic_progress (
+        id SERIAL PRIMARY KEY,
+        student_id INTEGER REFERENCES students(id),
+        topic_name TEXT,
+        understanding_level VARCHAR(100),
+        last_studied DATE,
+        lessons_count INTEGER DEFAULT 0,
+        created_at TIMESTAMP DEFAULT NOW()
+    )
+    """
+]
+
+HOT_QUERY_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS idx_lessons_student_date ON lessons (student_id, date)",
+    "CREATE INDEX IF NOT EXISTS idx_lessons_date_time ON lessons (date, time)",
+    "CREATE INDEX IF NOT EXISTS idx_lessons_status_date ON lessons (status, date)",
+    "CREATE INDEX IF NOT EXISTS idx_payments_student ON payments (student_id)",
+    "CREATE INDEX IF NOT EXISTS idx_payments_lesson ON payments (lesson_id)",
+    "CREATE INDEX IF NOT EXISTS idx_lesson_reports_lesson ON lesson_reports (lesson_id)",
+    "CREATE INDEX IF NOT EXISTS idx_homework_lesson ON homework_assignments (lesson_id)",
+    "CREATE INDEX IF NOT EXISTS idx_user_accounts_login ON user_accounts (login)",
+    "CREATE INDEX IF NOT EXISTS idx_students_name ON students (name)",
+    "CREATE INDEX IF NOT EXISTS idx_students_parent_name ON students (parent_name)"
+]
+
+STUDENT_BALANCES = [
+    LEDGER_TABLE_SQL,
+    f"""
+    INSERT INTO student_balances (student_id, balance, total_paid, total_spent, lessons_taken, updated_at)
+    SELECT student_id, balance, total_paid, total_spent, lessons_taken, NOW()
+    FROM ({HISTORY_BALANCES_SQL}) expected
+    ON CONFLICT (student_id) DO NOTHING
+    """
+]
+
+# Одно списание на проведение урока (см. models.settlement)
+LESSON_EXPENSE_UNIQUE = [
+    "ALTER TABLE payments ADD COLUMN IF NOT EXISTS lesson_at TIMESTAMP",
+    """
+    CREATE UNIQUE INDEX IF NOT EXISTS uq_payments_lesson_expense
+    ON payments (lesson_id, lesson_at) WHERE payment_type = 'expense'
+    """
+]
+
+# Один урок из шаблона на исходные дату и время (см. models.materializer)
+TEMPLATE_LESSON_UNIQUE = [
+    """
+    CREATE UNIQUE INDEX IF NOT EXISTS uq_lessons_template_original
+    ON lessons (student_id, original_date, original_time) WHERE from_template = true
+    """
+]
+
+# Шаблон недели как правила (см. models.recurrence): момент начала действия правила,
+# удаленные уроки по правилам и очистка заранее созданных будущих уроков
+LESSON_RECURRENCE = [
+    "ALTER TABLE lesson_templates ADD COLUMN IF NOT EXISTS rule_start TIMESTAMP",
+    "UPDATE lesson_templates SET rule_start = NOW() WHERE rule_start IS NULL",
+    "ALTER TABLE lesson_templates ALTER COLUMN rule_start SET DEFAULT NOW()",
+    "ALTER TABLE lesson_templates ALTER COLUMN rule_start SET NOT NULL",
+    """
+    CREATE TABLE IF NOT EXISTS lesson_skips (
+        student_id INTEGER NOT NULL REFERENCES students(id) ON DELETE CASCADE,
+        original_date DATE NOT NULL,
+        original_time TIME NOT NULL,
+        created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+        PRIMARY KEY (student_id, original_date, original_time)
+    )
+    """,
+    # Будущие уроки из шаблона, которые правило и так покажет - больше не храним
+    """
+    DELETE FROM lessons l
+    USING lesson_templates lt
+    WHERE l.student_id = lt.student_id
+    AND l.from_template = true
+    AND l.status = 'scheduled'
+    AND l.is_paid = false
+    AND COALESCE(l.is_moved, false) = false
+    AND l.date = l.original_date
+    AND l.time = l.original_time
+    AND l.time = lt.time
+    AND l.subject IS NOT DISTINCT FROM lt.subject
+    AND l.date + l.time > lt.rule_start
+    AND l.date >= COALESCE(lt.start_date, l.date)
+    AND l.date <= COALESCE(lt.end_date, l.date)
+    AND lt.day_of_week = (ARRAY['Понедельник', 'Вторник', 'Среда', 'Четверг',
+                                'Пятница', 'Суббота', 'Воскресенье'])[EXTRACT(ISODOW FROM l.date)]
+    AND NOT EXISTS (SELECT 1 FROM payments p WHERE p.lesson_id = l.id)
+    AND NOT EXISTS (SELECT 1 FROM lesson_reports r WHERE r.lesson_id = l.id)
+    AND NOT EXISTS (SELECT 1 FROM homework_assignments h WHERE h.lesson_id = l.id)
+    """
+]
+
+
+def _weekday_column(table):
+    """Название дня недели (day_of_week) -> номер дня по ISO (1 - понедельник) с индексом"""
+    return [
+        f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS weekday SMALLINT",
+        f"""
+        UPDATE {table}
+        SET weekday = array_position(ARRAY['Понедельник', 'Вторник', 'Среда', 'Четверг',
+                                           'Пятница', 'Суббота', 'Воскресенье'], day_of_week::text)
+        WHERE day_of_week IS NOT NULL
+        """,
+        f"ALTER TABLE {table} ADD CONSTRAINT ck_{table}_weekday CHECK (weekday BETWEEN 1 AND 7)",
+        f"ALTER TABLE {table} DROP COLUMN day_of_week",
+        f"CREATE INDEX IF NOT EXISTS idx_{table}_weekday_time ON {table} (weekday, time)"
+    ]
+
+
+# День недели - число (сортировка и фильтры по индексу), название - только при выводе
+WEEKDAY_NUMBERS = (
+    _weekday_column('lesson_templates')
+    + _weekday_column('available_slots')
+    + _weekday_column('lessons')
+)
+
+
+def _bigint_key(table, order_by):
+    """Текстовый id (str(uuid4())[:8]) -> BIGINT IDENTITY; старый id остается в legacy_id
+
+    Существующие строки нумеруются по order_by, новые получают id из последовательности.
+    """
+    return [
+        f"ALTER TABLE {table} RENAME COLUMN id TO legacy_id",
+        f"ALTER TABLE {table} DROP CONSTRAINT {table}_pkey",
+        f"ALTER TABLE {table} ALTER COLUMN legacy_id DROP NOT NULL",
+        f"ALTER TABLE {table} ADD COLUMN id BIGINT",
+        f"""
+        UPDATE {table} t
+        SET id = numbered.id
+        FROM (
+            SELECT legacy_id, ROW_NUMBER() OVER (ORDER BY {order_by}, legacy_id) as id
+            FROM {table}
+        ) numbered
+        WHERE numbered.legacy_id = t.legacy_id
+        """,
+        f"ALTER TABLE {table} ALTER COLUMN id SET NOT NULL",
+        f"ALTER TABLE {table} ALTER COLUMN id ADD GENERATED BY DEFAULT AS IDENTITY",
+        f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), (SELECT COALESCE(MAX(id), 0) + 1 FROM {table}), false)",
+        f"ALTER TABLE {table} ADD PRIMARY KEY (id)"
+    ]
+
+
+def _lesson_reference(table):
+    """{table}.lesson_id: старый текстовый id урока -> новый BIGINT (ссылки на удаленные уроки -> NULL)"""
+    return [
+        f"ALTER TABLE {table} ADD COLUMN lesson_ref BIGINT",
+        f"""
+        UPDATE {table} t
+        SET lesson_ref = l.id
+        FROM lessons l
+        WHERE l.legacy_id = t.lesson_id
+        """,
+        f"ALTER TABLE {table} DROP COLUMN lesson_id",
+        f"ALTER TABLE {table} RENAME COLUMN lesson_ref TO lesson_id"
+    ]
+
+
+# Короткие числовые ключи вместо 8 символов uuid: меньше индексы и соединения, нет коллизий.
+# Старые id уроков (ссылки вида /schedule/lesson/<id>/edit) ищутся по legacy_id
+COMPACT_PRIMARY_KEYS = (
+    _bigint_key('lessons', 'created_at NULLS FIRST, date NULLS FIRST, time NULLS FIRST')
+    + ["CREATE UNIQUE INDEX IF NOT EXISTS uq_lessons_legacy_id ON lessons (legacy_id)"]
+    + _bigint_key('payments', 'created_at NULLS FIRST, payment_date NULLS FIRST')
+    + _bigint_key('available_slots', 'created_at NULLS FIRST')
+    + _lesson_reference('payments')
+    + _lesson_reference('lesson_reports')
+    + _lesson_reference('homework_assignments')
+    + [
+        # Индексы по lesson_id удалились вместе со старыми столбцами
+        "CREATE INDEX IF NOT EXISTS idx_payments_lesson ON payments (lesson_id)",
+        "CREATE INDEX IF NOT EXISTS idx_lesson_reports_lesson ON lesson_reports (lesson_id)",
+        "CREATE INDEX IF NOT EXISTS idx_homework_lesson ON homework_assignments (lesson_id)",
+        """
+        CREATE UNIQUE INDEX IF NOT EXISTS uq_payments_lesson_expense
+        ON payments (lesson_id, lesson_at) WHERE payment_type = 'expense'
+        """
+    ]
+)
+
+# История платежей листается по ключу (payment_date, id) от новых к старым,
+# поэтому дата платежа обязательна (все записи и так ее заполняют)
+PAYMENT_HISTORY_KEYSET = [
+    "UPDATE payments SET payment_date = COALESCE(created_at, NOW()) WHERE payment_date IS NULL",
+    "ALTER TABLE payments ALTER COLUMN payment_date SET DEFAULT NOW()",
+    "ALTER TABLE payments ALTER COLUMN payment_date SET NOT NULL",
+    "CREATE INDEX IF NOT EXISTS idx_payments_student_date ON payments (student_id, payment_date DESC, id DESC)"
+]
+
+# Контрольные точки балансов (см. models.ledger): закрытия месяцев и обнуления
+BALANCE_CHECKPOINTS = [
+    CHECKPOINTS_TABLE_SQL,
+    """
+    CREATE UNIQUE INDEX IF NOT EXISTS uq_balance_checkpoints_month
+    ON balance_checkpoints (student_id, period) WHERE kind = 'month_close'
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_balance_checkpoints_student ON balance_checkpoints (student_id, last_payment_id DESC, id DESC)"
+]
+
+# Действует последняя по id контрольная точка ученика
+CHECKPOINT_ORDER_INDEX = [
+    "DROP INDEX IF EXISTS idx_balance_checkpoints_student",
+    "CREATE INDEX IF NOT EXISTS idx_balance_checkpoints_student_id ON balance_checkpoints (student_id, id DESC)"
+]
+
+# Одна строка families на семью: дубликаты (параллельные первые платежи) сливаем в старшую
+FAMILY_PARENT_UNIQUE = [
+    """
+    UPDATE families f
+    SET family_balance = t.family_balance,
+        total_family_paid = t.total_family_paid,
+        total_family_spent = t.total_family_spent,
+        created_at = t.created_at
+    FROM (
+        SELECT parent_name, MIN(id) as keep_id,
+               SUM(COALESCE(family_balance, 0)) as family_balance,
+               SUM(COALESCE(total_family_paid, 0)) as total_family_paid,
+               SUM(COALESCE(total_family_spent, 0)) as total_family_spent,
+               MIN(created_at) as created_at
+        FROM families
+        WHERE parent_name IS NOT NULL
+        GROUP BY parent_name
+        HAVING COUNT(*) > 1
+    ) t
+    WHERE f.id = t.keep_id
+    """,
+    """
+    DELETE FROM families f
+    USING families k
+    WHERE k.parent_name = f.parent_name AND k.id < f.id
+    """,
+    "CREATE UNIQUE INDEX IF NOT EXISTS uq_families_parent_name ON families (parent_name)"
+]
+
+# (версия, имя, команды) - только добавлять в конец, примененные не менять
+MIGRATIONS = [
+    (1, 'initial_schema', INITIAL_SCHEMA),
+    (2, 'hot_query_indexes', HOT_QUERY_INDEXES),
+    (3, 'student_balances', STUDENT_BALANCES),
+    (4, 'lesson_expense_unique', LESSON_EXPENSE_UNIQUE),
+    (5, 'template_lesson_unique', TEMPLATE_LESSON_UNIQUE),
+    (6, 'lesson_recurrence', LESSON_RECURRENCE),
+    (7, 'weekday_numbers', WEEKDAY_NUMBERS),
+    (8, 'compact_primary_keys', COMPACT_PRIMARY_KEYS),
+    (9, 'payment_history_keyset', PAYMENT_HISTORY_KEYSET),
+    (10, 'balance_checkpoints', BALANCE_CHECKPOINTS),
+    (11, 'checkpoint_order_index', CHECKPOINT_ORDER_INDEX),
+    (12, 'family_parent_unique', FAMILY_PARENT_UNIQUE)
+]
+
+MIGRATIONS_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+        version INTEGER PRIMARY KEY,
+        name VARCHAR(255) NOT NULL,
+        applied_at TIMESTAMP NOT NULL DEFAULT NOW()
+    )
+"""
+
+# Ключ advisory-блокировки: две одновременные миграции не пойдут параллельно
+MIGRATIONS_LOCK_KEY = 7301
+
+# Горячие запросы приложений: имя -> (SQL, пример параметров) для EXPLAIN
+HOT_QUERIES = {
+    'lessons_student_week': (
+        "SELECT date, time, subject, status FROM lessons "
+        "WHERE student_id = %(student_id)s AND date BETWEEN %(start)s AND %(end)s ORDER BY date, time",
+        {'student_id': 1, 'start': date.today(), 'end': date.today()}
+    ),
+    'lessons_for_date': (
+        "SELECT * FROM lessons WHERE date = %(day)s ORDER BY time",
+        {'day': date.today()}
+    ),
+    'lessons_overdue': (
+        "SELECT id FROM lessons WHERE status = 'scheduled' AND date <= %(day)s",
+        {'day': date.today()}
+    ),
+    'payments_by_student': (
+        "SELECT * FROM payments WHERE student_id = %(student_id)s",
+        {'student_id': 1}
+    ),
+    'payment_history_page': (
+        "SELECT id, amount, payment_date FROM payments WHERE student_id = %(student_id)s "
+        "AND (payment_date, id) < (%(before_date)s, %(before_id)s) ORDER BY payment_date DESC, id DESC LIMIT 50",
+        {'student_id': 1, 'before_date': date.today(), 'before_id': 1}
+    ),
+    'latest_checkpoint': (
+        "SELECT last_payment_id, balance FROM balance_checkpoints WHERE student_id = %(student_id)s "
+        "ORDER BY id DESC LIMIT 1",
+        {'student_id': 1}
+    ),
+    'payments_by_lesson': (
+        "SELECT id, amount FROM payments WHERE lesson_id = %(lesson_id)s AND payment_type = 'expense'",
+        {'lesson_id': 1}
+    ),
+    'report_by_lesson': (
+        "SELECT id FROM lesson_reports WHERE lesson_id = %(lesson_id)s",
+        {'lesson_id': 1}
+    ),
+    'homework_by_lesson': (
+        "SELECT id FROM homework_assignments WHERE lesson_id = %(lesson_id)s",
+        {'lesson_id': 1}
+    ),
+    'account_by_login': (
+        "SELECT id, login, role, student_id, full_name FROM user_accounts WHERE login = %(login)s",
+        {'login': 'login'}
+    ),
+    'student_by_name': (
+        "SELECT * FROM students WHERE name = %(name)s",
+        {'name': 'name'}
+    ),
+    'students_by_parent': (
+        "SELECT * FROM students WHERE parent_name = %(parent_name)s ORDER BY name",
+        {'parent_name': 'parent'}
+    ),
+    'template_week': (
+        "SELECT id, weekday, time, student_id FROM lesson_templates ORDER BY weekday, time",
+        {}
+    ),
+    'slots_for_weekday': (
+        "SELECT id, time, duration FROM available_slots WHERE weekday = %(weekday)s ORDER BY time",
+        {'weekday': 1}
+    )
+}
+
+
+def applied_versions():
+    """Номера уже примененных миграций"""
+    execute_query(MIGRATIONS_TABLE_SQL)
+    rows = execute_query("SELECT version FROM schema_migrations", fetch=True)
+    return {row['version'] for row in rows or []}
+
+
+def migrate(target=None):
+    """Применить миграции, которых еще нет (до версии target включительно)"""
+    applied = []
+    for version, name, statements in MIGRATIONS:
+        if target is not None and version > target:
+            break
+        with unit_of_work() as unit:
+            execute_query("SELECT pg_advisory_xact_lock(%s)", (MIGRATIONS_LOCK_KEY,), fetch_one=True)
+            if version in applied_versions():
+                continue
+
+            print(f"⏳ Миграция {version}: {name}")
+            for statement in statements:
+                if execute_query(statement) is None:
+                    raise RuntimeError(f"Миграция {version} ({name}) не применилась")
+            execute_query(
+                "INSERT INTO schema_migrations (version, name) VALUES (%s, %s)",
+                (version, name)
+            )
+            if not unit.finish(commit=True):
+                raise RuntimeError(f"Миграция {version} ({name}) не сохранилась")
+        applied.append(version)
+        print(f"✅ Миграция {version} применена")
+    return applied
+
+
+def migration_status():
+    """[(версия, имя, применена ли)]; только читает (schema_migrations не создает)"""
+    with unit_of_work():
+        table = execute_query("SELECT to_regclass('schema_migrations') IS NOT NULL as exists", fetch_one=True)
+        if table is None:
+            raise psycopg2.OperationalError("Не удалось прочитать schema_migrations")
+        done = applied_versions() if table['exists'] else set()
+    return [(version, name, version in done) for version, name, _ in MIGRATIONS]
+
+
+def explain_hot_queries():
+    """План каждого горячего запроса: {имя: [строки EXPLAIN]}"""
+    plans = {}
+    with unit_of_work():
+        for name, (query, params) in HOT_QUERIES.items():
+            rows = execute_query("EXPLAIN " + query, params, fetch=True, name=f'explain_{name}')
+            plans[name] = [row['QUERY PLAN'] for row in rows] if rows is not None else ['(таблицы нет)']
+    return plans
+
+
+def print_plans(title, plans):
+    print(f"===== {title} =====")
+    for name, lines in plans.items():
+        print(f"--- {name}")
+        for line in lines:
+            print(f"    {line}")
+
+
+def main(argv=None):
+    """Командная строка для migrate.py обоих приложений"""
+    parser = argparse.ArgumentParser(description="Миграции схемы БД Alien Tutor")
+    parser.add_argument('--status', action='store_true', help="показать примененные и новые миграции")
+    parser.add_argument('--explain', action='store_true', help="EXPLAIN горячих запросов до и после миграций")
+    parser.add_argument('--target', type=int, help="применить миграции только до этой версии")
+    args = parser.parse_args(argv)
+
+    if args.status:
+        for version, name, done in migration_status():
+            print(f"{'✅' if done else '⏳'} {version:>3} {name}")
+        return 0
+
+    if args.explain:
+        print_plans("ДО миграций", explain_hot_queries())
+
+    try:
+        applied = migrate(args.target)
+    except RuntimeError as e:
+        print(f"❌ {e}")
+        return 1
+
+    if not applied:
+        print("✅ Схема актуальна, новых миграций нет")
+
+    if args.explain:
+        print_plans("ПОСЛЕ миграций", explain_hot_queries())
+    return 0
@@ -0,0 +1,71 @@
+"""Периоды для отчетов: неделя, ISO-неделя, месяц, произвольный диапазон
+
+Период - полуоткрытый интервал [start, end): в SQL это
+    date >= %(start)s AND date < %(end)s
+такое условие идет по индексу на date/payment_date, в отличие от
+EXTRACT(MONTH FROM date) = ..., которое заставляет читать всю таблицу.
+"""
+from datetime import date, datetime, timedelta
+from typing import NamedTuple
+
+
+class Period(NamedTuple):
+    start: date
+    end: date      # не включается
+
+    def contains(self, day):
+        return self.start <= day < self.end
+
+    def days(self):
+        """Все дни периода по порядку"""
+        return [self.start + timedelta(days=i) for i in range((self.end - self.start).days)]
+
+    def params(self):
+        """Параметры для SQL с именованными %(start)s и %(end)s"""
+        return {'start': self.start, 'end': self.end}
+
+
+def _as_date(day):
+    if day is None:
+        return date.today()
+    if isinstance(day, datetime):
+        return day.date()
+    return day
+
+
+def week(day=None):
+    """Неделя (пн-вс), в которую попадает день (по умолчанию - сегодня)"""
+    day = _as_date(day)
+    start = day - timedelta(days=day.weekday())
+    return Period(start, start + timedelta(days=7))
+
+
+def iso_week(year, week_number):
+    """ISO-неделя года (неделя 1 - та, в которой первый четверг)"""
+    start = date.fromisocalendar(year, week_number, 1)
+    return Period(start, start + timedelta(days=7))
+
+
+def month(year=None, month_number=None):
+    """Календарный месяц (по умолчанию - текущий)"""
+    if year is None or month_number is None:
+        today = date.today()
+        year, month_number = today.year, today.month
+    year, month_number = int(year), int(month_number)
+    start = date(year, month_number, 1)
+    end = date(year + 1, 1, 1) if month_number == 12 else date(year, month_number + 1, 1)
+    return Period(start, end)
+
+
+def parse_month(value):
+    """Месяц из строки 'ГГГГ-ММ' (как в ?month= у API)"""
+    year, month_number = value.split('-')
+    return month(year, month_number)
+
+
+def custom(start, end_inclusive):
+    """Произвольный диапазон дат, оба конца включительно"""
+    start, end_inclusive = _as_date(start), _as_date(end_inclusive)
+    if end_inclusive < start:
+        raise ValueError(f"Конец периода {end_inclusive} раньше начала {start}")
+    return Period(start, end_inclusive + timedelta(days=1))
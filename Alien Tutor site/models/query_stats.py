@@ -0,0 +1,185 @@
+"""Статистика SQL-запросов: время по каждому запросу, медленные запросы, поиск N+1"""
+import os
+import re
+import sys
+import threading
+import time
+import zlib
+from collections import deque
+
+from flask import g, has_request_context, request
+
+
+SLOW_QUERY_MS = float(os.getenv('DB_SLOW_QUERY_MS', 200))
+N_PLUS_ONE_THRESHOLD = int(os.getenv('DB_N_PLUS_ONE_THRESHOLD', 5))
+
+SAMPLES_PER_QUERY = 1000     # сколько последних замеров держим для p50/p99
+SLOW_LOG_SIZE = 200          # сколько последних медленных запросов помним
+
+_lock = threading.Lock()
+_queries = {}                # имя -> статистика
+_slow_log = deque(maxlen=SLOW_LOG_SIZE)
+_n_plus_one = {}             # (маршрут, имя) -> статистика повторов
+
+_SPACES = re.compile(r'\s+')
+_PLACEHOLDER_LIST = re.compile(r'\(\s*%s(\s*,\s*%s)+\s*\)')
+_NUMBER = re.compile(r'\b\d+\b')
+_STRING = re.compile(r"'(?:[^']|'')*'")
+
+# Функции-обертки, которые не считаем "автором" запроса
+_WRAPPERS = {'execute_query', 'db_execute_query', 'stream_query', 'record_query'}
+
+
+def statement_shape(query):
+    """Форма запроса: без лишних пробелов, литералов и длины списков IN (...)"""
+    shape = _SPACES.sub(' ', query).strip()
+    shape = _STRING.sub('?', shape)
+    shape = _NUMBER.sub('?', shape)
+    return _PLACEHOLDER_LIST.sub('(%s, ...)', shape)
+
+
+def _caller_name():
+    """Имя функции приложения, из которой пришел запрос"""
+    frame = sys._getframe(2)
+    while frame is not None:
+        code = frame.f_code
+        if code.co_name not in _WRAPPERS and not code.co_filename.endswith(('database.py', 'query_stats.py')):
+            return code.co_name
+        frame = frame.f_back
+    return 'unknown'
+
+
+def query_name(query, name=None):
+    """Имя запроса в реестре: явное или "функция#хэш формы" """
+    shape = statement_shape(query)
+    if name:
+        return name, shape
+    return f"{_caller_name()}#{zlib.crc32(shape.encode('utf-8')) & 0xffff:04x}", shape
+
+
+def redact_params(params):
+    """Параметры без значений - только типы (в логах не должно быть персональных данных)"""
+    if params is None:
+        return None
+    if isinstance(params, dict):
+        return {key: f"<{type(value).__name__}>" for key, value in params.items()}
+    return [f"<{type(value).__name__}>" for value in params]
+
+
+def _percentile(sorted_samples, fraction):
+    if not sorted_samples:
+        return 0.0
+    index = min(len(sorted_samples) - 1, int(round(fraction * (len(sorted_samples) - 1))))
+    return sorted_samples[index]
+
+
+def record_query(query, params, duration, name=None, failed=False):
+    """Учесть выполненный запрос (duration - в секундах)"""
+    name, shape = query_name(query, name)
+    duration_ms = duration * 1000
+
+    with _lock:
+        stats = _queries.get(name)
+        if stats is None:
+            stats = _queries[name] = {
+                'name': name,
+                'sql': shape,
+                'count': 0,
+                'errors': 0,
+                'total_ms': 0.0,
+                'max_ms': 0.0,
+                'samples': deque(maxlen=SAMPLES_PER_QUERY)
+            }
+        stats['count'] += 1
+        stats['total_ms'] += duration_ms
+        stats['max_ms'] = max(stats['max_ms'], duration_ms)
+        stats['samples'].append(duration_ms)
+        if failed:
+            stats['errors'] += 1
+
+    endpoint = request.endpoint if has_request_context() else None
+
+    if duration_ms >= SLOW_QUERY_MS:
+        entry = {
+            'name': name,
+            'sql': shape,
+            'params': redact_params(params),
+            'duration_ms': round(duration_ms, 2),
+            'endpoint': endpoint,
+            'at': time.strftime('%Y-%m-%d %H:%M:%S')
+        }
+        with _lock:
+            _slow_log.append(entry)
+        print(f"🐢 Медленный запрос {name}: {duration_ms:.1f} мс (порог {SLOW_QUERY_MS:.0f} мс)")
+
+    if has_request_context():
+        _track_repeats(endpoint, name, shape)
+
+
+def _track_repeats(endpoint, name, shape):
+    """Один и тот же запрос много раз за один HTTP-запрос - признак N+1"""
+    counts = g.get('db_query_counts')
+    if counts is None:
+        counts = g.db_query_counts = {}
+    counts[name] = counts.get(name, 0) + 1
+    count = counts[name]
+
+    if count <= N_PLUS_ONE_THRESHOLD:
+        return
+
+    with _lock:
+        key = (endpoint, name)
+        entry = _n_plus_one.get(key)
+        if entry is None:
+            entry = _n_plus_one[key] = {
+                'endpoint': endpoint,
+                'name': name,
+                'sql': shape,
+                'requests': 0,
+                'max_per_request': 0
+            }
+        if count == N_PLUS_ONE_THRESHOLD + 1:
+            entry['requests'] += 1
+        entry['max_per_request'] = max(entry['max_per_request'], count)
+
+    if count == N_PLUS_ONE_THRESHOLD + 1:
+        print(f"⚠️ N+1: запрос {name} выполнен больше {N_PLUS_ONE_THRESHOLD} раз за один запрос к {endpoint}")
+
+
+def get_query_stats():
+    """Снимок статистики для админского JSON"""
+    with _lock:
+        queries = []
+        for stats in _queries.values():
+            samples = sorted(stats['samples'])
+            queries.append({
+                'name': stats['name'],
+                'sql': stats['sql'],
+                'count': stats['count'],
+                'errors': stats['errors'],
+                'total_ms': round(stats['total_ms'], 2),
+                'avg_ms': round(stats['total_ms'] / stats['count'], 2) if stats['count'] else 0,
+                'p50_ms': round(_percentile(samples, 0.50), 2),
+                'p99_ms': round(_percentile(samples, 0.99), 2),
+                'max_ms': round(stats['max_ms'], 2)
+            })
+        slow = list(_slow_log)
+        repeats = sorted(_n_plus_one.values(), key=lambda x: x['max_per_request'], reverse=True)
+        repeats = [dict(entry) for entry in repeats]
+
+    queries.sort(key=lambda x: x['total_ms'], reverse=True)
+    return {
+        'slow_query_ms': SLOW_QUERY_MS,
+        'n_plus_one_threshold': N_PLUS_ONE_THRESHOLD,
+        'queries': queries,
+        'slow_queries': slow[::-1],
+        'n_plus_one': repeats
+    }
+
+
+def reset_query_stats():
+    """Сбросить накопленную статистику"""
+    with _lock:
+        _queries.clear()
+        _slow_log.clear()
+        _n_plus_one.clear()
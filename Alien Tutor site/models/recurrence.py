@@ -0,0 +1,226 @@
+"""Регулярные уроки как правила: шаблон недели разворачивается при чтении
+
+Строка lesson_templates - правило "каждый <день недели> в <время>" с периодом
+[start_date, end_date] и моментом начала действия rule_start. Будущие уроки по
+правилу не хранятся в lessons: их отдает OCCURRENCES_SQL для запрошенного окна.
+В lessons попадают только исключения - урок, который перенесли, отменили,
+провели или к которому написали отчет (строка с from_template = true и
+original_date/original_time = дата и время по правилу). Такая строка закрывает
+собой урок по правилу. Удаленный урок по правилу запоминается в lesson_skips.
+
+У урока по правилу временный id вида t<id шаблона>-<ГГГГММДД>; при любом
+изменении (или при проведении) он сохраняется в lessons и получает обычный id.
+"""
+import re
+from datetime import date, datetime, timedelta
+
+from models.database import execute_query
+from models.events import notify_changes
+from models.lesson_ids import find_lesson_id
+
+
+# Сколько дней вперед считаются "запланированными" (как окно применения шаблона)
+PLANNED_HORIZON_DAYS = 365
+
+VIRTUAL_ID = re.compile(r'^t(\d+)-(\d{8})$')
+
+# Уроки по правилам в окне [occ_start, occ_end), которые не закрыты строкой в lessons.
+# Параметры - occurrence_params(); occ_student_ids/occ_template_id = NULL - без фильтра
+OCCURRENCES_SQL = """
+    SELECT 't' || lt.id || '-' || to_char(day, 'YYYYMMDD') as id,
+           lt.id as template_id,
+           lt.student_id,
+           s.name as student_name,
+           day::date as date,
+           lt.time,
+           NULL::smallint as weekday,
+           lt.subject,
+           'scheduled'::varchar as status,
+           COALESCE(lt.lesson_type, 'regular') as lesson_type,
+           COALESCE(lt.lesson_duration, 60) as lesson_duration,
+           true as from_template,
+           false as is_paid,
+           day::date as original_date,
+           lt.time as original_time
+    FROM lesson_templates lt
+    JOIN students s ON s.id = lt.student_id
+    CROSS JOIN LATERAL (
+        SELECT GREATEST(%(occ_start)s::date, lt.start_date, lt.rule_start::date) as first_day,
+               LEAST(%(occ_end)s::date - 1, lt.end_date) as last_day
+    ) bounds
+    CROSS JOIN LATERAL generate_series(
+        bounds.first_day + ((lt.weekday - EXTRACT(ISODOW FROM bounds.first_day)::int + 7) %% 7),
+        bounds.last_day,
+        INTERVAL '7 days'
+    ) as day
+    WHERE lt.time IS NOT NULL
+    AND lt.weekday IS NOT NULL
+    AND (%(occ_student_ids)s::int[] IS NULL OR lt.student_id = ANY(%(occ_student_ids)s::int[]))
+    AND (%(occ_template_id)s::int IS NULL OR lt.id = %(occ_template_id)s::int)
+    AND day::date + lt.time >= lt.rule_start
+    AND NOT EXISTS (
+        SELECT 1 FROM lessons l
+        WHERE l.student_id = lt.student_id
+        AND ((l.original_date = day::date AND l.original_time = lt.time)
+             OR (l.date = day::date AND l.time = lt.time))
+    )
+    AND NOT EXISTS (
+        SELECT 1 FROM lesson_skips k
+        WHERE k.student_id = lt.student_id
+        AND k.original_date = day::date
+        AND k.original_time = lt.time
+    )
+"""
+
+
+def occurrence_params(start, end, student_ids=None, template_id=None):
+    """Параметры OCCURRENCES_SQL для окна [start, end)"""
+    return {
+        'occ_start': start,
+        'occ_end': end,
+        'occ_student_ids': list(student_ids) if student_ids is not None else None,
+        'occ_template_id': template_id
+    }
+
+
+def load_occurrences(start, end, student_ids=None):
+    """Уроки по правилам в окне [start, end), по дате и времени"""
+    query = f"SELECT * FROM ({OCCURRENCES_SQL}) o ORDER BY date, time"
+    return execute_query(query, occurrence_params(start, end, student_ids), fetch=True, name='load_occurrences') or []
+
+
+# Сохранить уроки по правилам в lessons (условие на момент урока - в {until})
+MATERIALIZE_SQL = """
+    INSERT INTO lessons (student_id, date, time, subject, status, lesson_type, lesson_duration,
+                         from_template, is_paid, original_date, original_time, is_moved, created_at)
+    SELECT o.student_id, o.date, o.time, o.subject, 'scheduled',
+           o.lesson_type, o.lesson_duration, true, false, o.date, o.time, false, NOW()
+    FROM ({occurrences}) o
+    WHERE {until}
+    ON CONFLICT (student_id, original_date, original_time) WHERE from_template = true DO NOTHING
+    RETURNING id, student_id
+"""
+
+# Урок закончился - его пора проводить
+ENDED = "o.date + o.time + INTERVAL '1 minute' * o.lesson_duration < NOW()"
+# Урок уже начался - он относится к прошлому правила
+STARTED = "o.date + o.time <= NOW()"
+
+
+def _materialize(until, params):
+    query = MATERIALIZE_SQL.format(occurrences=OCCURRENCES_SQL, until=until)
+    rows = execute_query(query, params, fetch=True, name='materialize_occurrences')
+    if rows:
+        notify_changes('lessons', [row['student_id'] for row in rows])
+    return rows
+
+
+def materialize_due():
+    """Сохранить закончившиеся уроки по правилам (перед проведением); сколько сохранено"""
+    rows = _materialize(ENDED, occurrence_params(None, date.today() + timedelta(days=1)))
+    return len(rows) if rows is not None else None
+
+
+def freeze_rule_history(template_id):
+    """Сохранить уже начавшиеся уроки правила - перед его изменением или удалением
+
+    Изменение правила действует с текущего момента, прошлое остается как было.
+    """
+    _materialize(STARTED, occurrence_params(None, date.today() + timedelta(days=1), template_id=template_id))
+
+
+def restart_rules():
+    """Все уроки удалены ("Очистить все") - правила действуют с текущего момента
+
+    Иначе прошлые уроки по правилам снова стали бы виртуальными, materialize_due()
+    сохранил бы их с новыми id, и проведение списало бы их второй раз.
+    """
+    execute_query("UPDATE lesson_templates SET rule_start = NOW() WHERE rule_start < NOW()")
+
+
+def parse_virtual_id(lesson_id):
+    """(id шаблона, дата) для временного id урока по правилу, иначе None"""
+    match = VIRTUAL_ID.match(str(lesson_id or ''))
+    if not match:
+        return None
+    try:
+        return int(match.group(1)), datetime.strptime(match.group(2), '%Y%m%d').date()
+    except ValueError:
+        return None
+
+
+def get_occurrence(lesson_id):
+    """Урок по правилу по временному id (строка в формате OCCURRENCES_SQL) или None"""
+    parsed = parse_virtual_id(lesson_id)
+    if parsed is None:
+        return None
+    template_id, day = parsed
+    query = f"SELECT * FROM ({OCCURRENCES_SQL}) o"
+    params = occurrence_params(day, day + timedelta(days=1), template_id=template_id)
+    return execute_query(query, params, fetch_one=True, name='get_occurrence')
+
+
+def resolve_lesson_id(lesson_id):
+    """id урока в lessons: урок по правилу сохраняется при первом изменении
+
+    Для обычного урока - его id (в т.ч. по старому 8-символьному id);
+    None - такого урока нет.
+    """
+    parsed = parse_virtual_id(lesson_id)
+    if parsed is None:
+        return find_lesson_id(lesson_id)
+    template_id, day = parsed
+
+    params = occurrence_params(day, day + timedelta(days=1), template_id=template_id)
+    _materialize("true", params)
+
+    # Строка могла появиться раньше (другим запросом) - ищем по правилу
+    query = """
+        SELECT l.id
+        FROM lesson_templates lt
+        JOIN lessons l ON l.student_id = lt.student_id
+                      AND l.original_date = %s
+                      AND l.original_time = lt.time
+                      AND l.from_template = true
+        WHERE lt.id = %s
+    """
+    result = execute_query(query, (day, template_id), fetch_one=True)
+    return result['id'] if result else None
+
+
+def skip_occurrence(student_id, original_date, original_time):
+    """Урок по правилу удален - больше не показывать его"""
+    query = """
+        INSERT INTO lesson_skips (student_id, original_date, original_time)
+        VALUES (%s, %s, %s)
+        ON CONFLICT DO NOTHING
+    """
+    execute_query(query, (student_id, original_date, original_time))
+
+
+# Будущие уроки правила, сохраненные заранее и ничем не отличающиеся от правила
+# ("Применить шаблон"): при изменении правила они устаревают
+UNTOUCHED_FUTURE_SQL = """
+    DELETE FROM lessons l
+    USING lesson_templates lt
+    WHERE lt.id = %(template_id)s
+    AND l.student_id = lt.student_id
+    AND l.from_template = true
+    AND l.status = 'scheduled'
+    AND l.is_paid = false
+    AND COALESCE(l.is_moved, false) = false
+    AND l.date = l.original_date
+    AND l.time = l.original_time
+    AND l.time = lt.time
+    AND l.date + l.time > NOW()
+    AND lt.weekday = EXTRACT(ISODOW FROM l.date)
+    AND NOT EXISTS (SELECT 1 FROM payments p WHERE p.lesson_id = l.id)
+    AND NOT EXISTS (SELECT 1 FROM lesson_reports r WHERE r.lesson_id = l.id)
+    AND NOT EXISTS (SELECT 1 FROM homework_assignments h WHERE h.lesson_id = l.id)
+    RETURNING l.student_id, l.status
+"""
+
+
+def drop_untouched_future(template_id):
+    """Удалить заранее сохраненные будущие уроки правила; возвращает удаленные строки"""
+    return execute_query(UNTOUCHED_FUTURE_SQL, {'template_id': template_id}, fetch=True) or []
@@ -0,0 +1,55 @@
+"""Индекс расписания: уроки, разложенные по дням
+
+Строится один раз на запрос из списка слотов (load_lessons_between)
+и отдает уроки дня за O(1) вместо прохода по всему списку на каждый день.
+"""
+import heapq
+from datetime import datetime
+
+
+WEEKDAYS_RU = ["Понедельник", "Вторник", "Среда", "Четверг", "Пятница", "Суббота", "Воскресенье"]
+
+
+def _sort_key(entry):
+    return entry[0], entry[1]
+
+
+class ScheduleIndex:
+    """Уроки по датам ('ГГГГ-ММ-ДД') и уроки без даты по дням недели
+
+    Внутри корзины уроки уже отсортированы по времени; при равном времени
+    сохраняется порядок исходного списка - как у get_lessons_for_date.
+    """
+
+    def __init__(self, slots):
+        self._by_date = {}
+        self._by_weekday = {}
+        for position, slot in enumerate(slots):
+            if slot.get('date'):
+                bucket = self._by_date.setdefault(slot['date'], [])
+            elif slot.get('day'):
+                bucket = self._by_weekday.setdefault(slot['day'], [])
+            else:
+                continue
+            bucket.append((slot['time'], position, slot))
+
+        for bucket in self._by_date.values():
+            bucket.sort(key=_sort_key)
+        for bucket in self._by_weekday.values():
+            bucket.sort(key=_sort_key)
+
+    def lessons_for(self, day):
+        """Уроки дня (строка 'ГГГГ-ММ-ДД' или date), отсортированные по времени"""
+        if isinstance(day, str):
+            date_str = day
+            day = datetime.strptime(day, '%Y-%m-%d').date()
+        else:
+            if isinstance(day, datetime):
+                day = day.date()
+            date_str = day.strftime('%Y-%m-%d')
+
+        dated = self._by_date.get(date_str, [])
+        undated = self._by_weekday.get(WEEKDAYS_RU[day.weekday()], [])
+        if not undated:
+            return [slot for _, _, slot in dated]
+        return [slot for _, _, slot in heapq.merge(dated, undated, key=_sort_key)]
@@ -0,0 +1,86 @@
+"""Фоновые задачи по расписанию (проведение прошедших уроков и т.п.)
+
+Задача запускается в своем потоке раз в interval секунд, каждый запуск - в одной
+транзакции под advisory-блокировкой PostgreSQL: если приложение запущено в
+нескольких процессах, работу делает только тот, кто взял блокировку.
+"""
+import threading
+import time
+from datetime import datetime
+
+from models.database import execute_query, unit_of_work
+
+
+class PeriodicJob(threading.Thread):
+    """Поток, который раз в interval секунд вызывает func() под блокировкой lock_key
+
+    func возвращает количество обработанных записей. Результат последнего
+    запуска доступен через stats() (для /api/... статистики).
+    """
+
+    def __init__(self, name, func, interval, lock_key):
+        super().__init__(name=name, daemon=True)
+        self.func = func
+        self.interval = interval
+        self.lock_key = lock_key
+        self.runs = 0
+        self.skipped = 0
+        self.last_run = None          # когда начался последний запуск
+        self.last_duration = None     # секунд
+        self.last_processed = None
+        self.last_error = None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def stop(self):
+        self._stopped.set()
+
+    def run(self):
+        while not self._stopped.is_set():
+            self.run_once()
+            self._stopped.wait(self.interval)
+
+    def run_once(self):
+        """Один запуск; False - блокировку держит другой процесс"""
+        started_at = datetime.now()
+        started = time.perf_counter()
+        error = None
+        processed = None
+        try:
+            with unit_of_work() as unit:
+                locked = execute_query(
+                    "SELECT pg_try_advisory_xact_lock(%s) as locked",
+                    (self.lock_key,), fetch_one=True, name=f'{self.name}_lock'
+                )
+                if not locked or not locked['locked']:
+                    with self._lock:
+                        self.skipped += 1
+                    return False
+                processed = self.func()
+            if unit.failed:
+                error, processed = "запрос упал, транзакция откачена", 0
+        except Exception as e:
+            error = str(e)
+            print(f"❌ Фоновая задача {self.name} упала: {e}")
+
+        with self._lock:
+            self.runs += 1
+            self.last_run = started_at
+            self.last_duration = time.perf_counter() - started
+            self.last_processed = processed
+            self.last_error = error
+        return True
+
+    def stats(self):
+        with self._lock:
+            return {
+                'name': self.name,
+                'interval': self.interval,
+                'running': self.is_alive(),
+                'runs': self.runs,
+                'skipped': self.skipped,
+                'last_run': self.last_run.isoformat(timespec='seconds') if self.last_run else None,
+                'last_duration_ms': round(self.last_duration * 1000, 1) if self.last_duration is not None else None,
+                'last_processed': self.last_processed,
+                'last_error': self.last_error
+            }
@@ -0,0 +1,109 @@
+"""Проведение прошедших уроков одним SQL-запросом
+
+Все прошедшие уроки со статусом 'scheduled' за один запрос:
+помечаются проведенными и оплаченными (UPDATE ... RETURNING), по каждому
+не пробному уроку создается списание (INSERT ... SELECT) и сдвигается
+сводка балансов student_balances. Все в одной транзакции.
+
+Списание уникально для (lesson_id, lesson_at) - урока и времени, на которое он
+был проведен (миграция 4). Повторный запуск ничего не спишет второй раз, а урок,
+перенесенный с возвратом денег, при следующем проведении оплачивается заново.
+"""
+from models.database import execute_query
+from models.events import notify_changes
+
+
+# Прошедший, но еще не проведенный урок
+OVERDUE_CONDITION = """
+    l.status = 'scheduled'
+    AND l.date IS NOT NULL
+    AND l.time IS NOT NULL
+    AND l.date + l.time + INTERVAL '1 minute' * COALESCE(l.lesson_duration, 60) < NOW()
+"""
+
+# Строки сводки учеников блокируются до записи списаний (как в ledger.lock_balance),
+# по порядку student_id
+LOCK_OVERDUE_BALANCES_SQL = f"""
+    INSERT INTO student_balances (student_id)
+    SELECT DISTINCT l.student_id
+    FROM lessons l
+    JOIN students s ON s.id = l.student_id
+    WHERE {OVERDUE_CONDITION}
+    ORDER BY l.student_id
+    ON CONFLICT (student_id) DO UPDATE SET updated_at = student_balances.updated_at
+"""
+
+SETTLE_OVERDUE_SQL = f"""
+    WITH settled AS (
+        UPDATE lessons l
+        SET status = 'completed', is_paid = true
+        FROM students s
+        WHERE s.id = l.student_id
+        AND {OVERDUE_CONDITION}
+        RETURNING l.id, l.student_id, l.lesson_type, l.date + l.time as lesson_at,
+                  COALESCE(s.lesson_price, 0) as lesson_price
+    ),
+    charged AS (
+        INSERT INTO payments (student_id, amount, payment_type, description,
+                              lesson_id, lesson_at, payment_date, created_at)
+        SELECT student_id, -lesson_price, 'expense',
+               'Оплата урока ' || id, id, lesson_at, NOW(), NOW()
+        FROM settled
+        WHERE lesson_type IS DISTINCT FROM 'trial'
+        ON CONFLICT (lesson_id, lesson_at) WHERE payment_type = 'expense' DO NOTHING
+        RETURNING student_id, amount
+    ),
+    lessons_by_student AS (
+        SELECT student_id,
+               COUNT(*) as lessons,
+               COUNT(*) FILTER (WHERE lesson_type = 'trial') as trial_lessons
+        FROM settled
+        GROUP BY student_id
+    ),
+    charges_by_student AS (
+        SELECT student_id, COUNT(*) as charged, SUM(amount) as amount
+        FROM charged
+        GROUP BY student_id
+    ),
+    summary AS (
+        SELECT l.student_id, l.lessons, l.trial_lessons,
+               COALESCE(c.charged, 0) as charged,
+               COALESCE(c.amount, 0) as amount
+        FROM lessons_by_student l
+        LEFT JOIN charges_by_student c ON c.student_id = l.student_id
+    ),
+    ledger AS (
+        INSERT INTO student_balances (student_id, balance, total_paid, total_spent, lessons_taken, updated_at)
+        SELECT student_id, amount, GREATEST(amount, 0), GREATEST(-amount, 0), lessons, NOW()
+        FROM summary
+        ON CONFLICT (student_id) DO UPDATE SET
+            balance = student_balances.balance + EXCLUDED.balance,
+            total_paid = student_balances.total_paid + EXCLUDED.total_paid,
+            total_spent = student_balances.total_spent + EXCLUDED.total_spent,
+            lessons_taken = student_balances.lessons_taken + EXCLUDED.lessons_taken,
+            updated_at = NOW()
+    )
+    SELECT summary.student_id, s.name as student_name,
+           summary.lessons, summary.trial_lessons, summary.charged, summary.amount
+    FROM summary
+    JOIN students s ON s.id = summary.student_id
+    ORDER BY s.name
+"""
+
+
+def settle_overdue_lessons():
+    """Провести все прошедшие уроки; возвращает сводку по ученикам или None при ошибке
+
+    [{'student_id', 'student_name', 'lessons', 'trial_lessons', 'charged', 'amount'}]
+    lessons - проведено уроков, charged - создано списаний, amount - их сумма (<= 0).
+    """
+    if execute_query(LOCK_OVERDUE_BALANCES_SQL, name='settle_lock_balances') is None:
+        return None
+    rows = execute_query(SETTLE_OVERDUE_SQL, fetch=True, name='settle_overdue_lessons')
+    if rows is None:
+        return None
+
+    summary = [dict(row) for row in rows]
+    if summary:
+        notify_changes(['payments', 'lessons'], [row['student_id'] for row in summary])
+    return summary
@@ -0,0 +1,283 @@
+"""Предпросмотр шаблона недели: что изменится в расписании, без записи в базу
+
+Уроки учеников шаблона за нужный период читаются одним запросом (вместе с
+удаленными уроками по правилу из lesson_skips), дальше даты правил
+сравниваются с ними в памяти по ключам (ученик, дата, время):
+  - created    - уроки, которые будут созданы (или появятся по правилу);
+  - deleted    - уроки, которые исчезнут (сохраненные заранее будущие уроки
+                 правила удаляет update_template_lesson, stored = true);
+  - collisions - даты правила, занятые перенесенным уроком (урок с этой даты
+                 перенесен или на это время перенесли другой урок).
+Правила те же, что в materialize_templates и OCCURRENCES_SQL.
+"""
+import time as timer
+from datetime import date, datetime, timedelta
+
+from models.database import execute_query
+from models.recurrence import PLANNED_HORIZON_DAYS
+from models.schedule_index import WEEKDAYS_RU
+
+
+TEMPLATES_SQL = """
+    SELECT lt.id, lt.student_id, s.name as student_name, lt.weekday, lt.time,
+           lt.start_date, lt.end_date, lt.rule_start
+    FROM lesson_templates lt
+    JOIN students s ON s.id = lt.student_id
+    WHERE lt.time IS NOT NULL
+    AND (%(template_id)s::int IS NULL OR lt.id = %(template_id)s::int)
+"""
+
+# Уроки и удаленные уроки по правилу учеников за период (end = NULL - без конца)
+PERIOD_LESSONS_SQL = """
+    SELECT 'lesson' as kind, l.id, l.student_id, l.date, l.time, l.original_date, l.original_time,
+           l.status,
+           COALESCE(l.from_template, false) as from_template,
+           COALESCE(l.is_moved, false) as is_moved,
+           COALESCE(l.is_paid, false) as is_paid,
+           (EXISTS (SELECT 1 FROM payments p WHERE p.lesson_id = l.id)
+            OR EXISTS (SELECT 1 FROM lesson_reports r WHERE r.lesson_id = l.id)
+            OR EXISTS (SELECT 1 FROM homework_assignments h WHERE h.lesson_id = l.id)) as has_links
+    FROM lessons l
+    WHERE l.student_id = ANY(%(student_ids)s::int[])
+    AND (l.date >= %(start)s OR l.original_date >= %(start)s)
+    AND (%(end)s::date IS NULL OR l.date <= %(end)s OR l.original_date <= %(end)s)
+    UNION ALL
+    SELECT 'skip', NULL, k.student_id, NULL, NULL, k.original_date, k.original_time,
+           NULL, true, false, false, false
+    FROM lesson_skips k
+    WHERE k.student_id = ANY(%(student_ids)s::int[])
+    AND k.original_date >= %(start)s
+    AND (%(end)s::date IS NULL OR k.original_date <= %(end)s)
+"""
+
+
+def _time(value):
+    """time из строки формы ('HH:MM' / 'HH:MM:SS') или как есть"""
+    if isinstance(value, str):
+        return datetime.strptime(value[:5], '%H:%M').time()
+    return value
+
+
+def _date(value):
+    if isinstance(value, str):
+        return date.fromisoformat(value) if value else None
+    return value
+
+
+def rule_dates(rule, first, last):
+    """Даты правила {'weekday', 'time', 'start_date', 'end_date', 'rule_start'} в [first, last]"""
+    if rule['weekday'] is None or rule['time'] is None:
+        return
+    first = max(d for d in (first, rule['start_date']) if d is not None)
+    last = min(d for d in (last, rule['end_date']) if d is not None)
+    day = first + timedelta(days=(rule['weekday'] - first.isoweekday()) % 7)
+    while day <= last:
+        if rule['rule_start'] is None or datetime.combine(day, rule['time']) >= rule['rule_start']:
+            yield day
+        day += timedelta(days=7)
+
+
+class PeriodLessons:
+    """Уроки периода, разложенные по ключам (ученик, дата, время)"""
+
+    def __init__(self, rows):
+        self.by_original = {}   # урок из шаблона по дате и времени по правилу
+        self.by_slot = {}       # любой урок по фактической дате и времени
+        self.skips = set()
+        self.rows = []
+        for row in rows:
+            if row['kind'] == 'skip':
+                self.skips.add((row['student_id'], row['original_date'], row['original_time']))
+                continue
+            self.rows.append(row)
+            if row['original_date'] is not None and row['original_time'] is not None:
+                self.by_original[(row['student_id'], row['original_date'], row['original_time'])] = row
+            if row['date'] is not None and row['time'] is not None:
+                self.by_slot.setdefault((row['student_id'], row['date'], row['time']), row)
+
+    @classmethod
+    def load(cls, student_ids, start, end):
+        rows = execute_query(PERIOD_LESSONS_SQL, {
+            'student_ids': list(student_ids), 'start': start, 'end': end
+        }, fetch=True, name='template_preview_lessons')
+        if rows is None:
+            return None
+        return cls(rows)
+
+    def classify(self, key):
+        """'free' / 'exists' / 'deleted' / 'moved' (+ урок, из-за которого дата занята)"""
+        if key in self.skips:
+            return 'deleted', None
+        lesson = self.by_original.get(key)
+        if lesson is not None:
+            if (lesson['date'], lesson['time']) != (lesson['original_date'], lesson['original_time']):
+                return 'moved', lesson
+            return 'exists', lesson
+        lesson = self.by_slot.get(key)
+        if lesson is not None:
+            if lesson['original_date'] is not None and (lesson['original_date'], lesson['original_time']) != key[1:]:
+                return 'moved', lesson
+            return 'exists', lesson
+        return 'free', None
+
+
+def _entry(rule, day, lesson_id=None):
+    entry = {
+        'date': day.strftime('%Y-%m-%d'),
+        'day': WEEKDAYS_RU[day.weekday()],
+        'time': rule['time'].strftime('%H:%M'),
+        'student': rule['student_name']
+    }
+    if lesson_id is not None:
+        entry['lesson_id'] = lesson_id
+    return entry
+
+
+def _collision(rule, day, lesson):
+    entry = _entry(rule, day, lesson['id'])
+    entry['moved_from'] = f"{lesson['original_date']} {str(lesson['original_time'])[:5]}" if lesson['original_date'] else None
+    entry['moved_to'] = f"{lesson['date']} {str(lesson['time'])[:5]}" if lesson['date'] else None
+    return entry
+
+
+def _sorted(entries):
+    return sorted(entries, key=lambda e: (e['date'], e['time'], e['student']))
+
+
+def _result(created, deleted, collisions, skipped, started):
+    return {
+        'created': _sorted(created),
+        'deleted': _sorted(deleted),
+        'collisions': _sorted(collisions),
+        'counts': {
+            'created': len(created),
+            'deleted': len(deleted),
+            'collisions': len(collisions),
+            'skipped': skipped
+        },
+        'elapsed_ms': round((timer.perf_counter() - started) * 1000, 1)
+    }
+
+
+def preview_apply(today=None, horizon_days=PLANNED_HORIZON_DAYS):
+    """Что сделает "Применить шаблон" (materialize_templates); None при ошибке"""
+    started = timer.perf_counter()
+    today = today or date.today()
+    horizon = today + timedelta(days=horizon_days)
+
+    templates = execute_query(TEMPLATES_SQL, {'template_id': None}, fetch=True, name='template_preview_rules')
+    if templates is None:
+        return None
+    rules = []
+    for row in templates:
+        rule = dict(row)
+        rule['start_date'] = rule['start_date'] or today
+        rule['end_date'] = rule['end_date'] or horizon
+        rules.append(rule)
+    if not rules:
+        return _result([], [], [], 0, started)
+
+    period = PeriodLessons.load({rule['student_id'] for rule in rules},
+                                min(rule['start_date'] for rule in rules),
+                                max(rule['end_date'] for rule in rules))
+    if period is None:
+        return None
+
+    created, collisions, skipped = [], [], 0
+    for rule in rules:
+        for day in rule_dates(rule, rule['start_date'], rule['end_date']):
+            state, lesson = period.classify((rule['student_id'], day, rule['time']))
+            if state == 'free':
+                created.append(_entry(rule, day))
+            elif state == 'moved':
+                collisions.append(_collision(rule, day, lesson))
+            else:
+                skipped += 1
+    return _result(created, [], collisions, skipped + len(collisions), started)
+
+
+def _is_untouched_future(lesson, rule, now):
+    """Строка, которую удалит drop_untouched_future (UNTOUCHED_FUTURE_SQL)"""
+    return (lesson['from_template']
+            and lesson['status'] == 'scheduled'
+            and not lesson['is_paid']
+            and not lesson['is_moved']
+            and not lesson['has_links']
+            and lesson['date'] is not None and lesson['time'] is not None
+            and lesson['date'] == lesson['original_date']
+            and lesson['time'] == lesson['original_time']
+            and lesson['time'] == rule['time']
+            and lesson['date'].isoweekday() == rule['weekday']
+            and datetime.combine(lesson['date'], lesson['time']) > now)
+
+
+def preview_edit(template_id, lesson_data, student, now=None, horizon_days=PLANNED_HORIZON_DAYS):
+    """Что изменится в расписании после update_template_lesson; None - нет шаблона или ошибка
+
+    student - новый ученик ({'id', 'name'}), lesson_data - данные формы.
+    """
+    started = timer.perf_counter()
+    now = now or datetime.now()
+    today = now.date()
+    horizon = today + timedelta(days=horizon_days)
+
+    old = execute_query(TEMPLATES_SQL, {'template_id': template_id}, fetch_one=True, name='template_preview_rules')
+    if not old:
+        return None
+    old = dict(old)
+    new = {
+        'student_id': student['id'],
+        'student_name': student['name'],
+        'weekday': WEEKDAYS_RU.index(lesson_data['day']) + 1 if lesson_data.get('day') in WEEKDAYS_RU else None,
+        'time': _time(lesson_data.get('time')),
+        'start_date': _date(lesson_data.get('start_date')),
+        'end_date': _date(lesson_data.get('end_date')),
+        'rule_start': old['rule_start']
+    }
+    rule_changed = (old['weekday'] != new['weekday'] or old['time'] != new['time']
+                    or old['student_id'] != new['student_id'])
+    if rule_changed:
+        new['rule_start'] = now
+
+    period = PeriodLessons.load({old['student_id'], new['student_id']}, today, None)
+    if period is None:
+        return None
+
+    def upcoming(rule):
+        """Будущие уроки правила, которые сейчас видны в расписании"""
+        result = {}
+        for day in rule_dates(rule, today, horizon):
+            if datetime.combine(day, rule['time']) < now:
+                continue
+            key = (rule['student_id'], day, rule['time'])
+            result[key] = (day, period.classify(key))
+        return result
+
+    old_upcoming = upcoming(old)
+    new_upcoming = upcoming(new)
+
+    created, deleted, collisions, skipped = [], [], [], 0
+    for key, (day, (state, lesson)) in new_upcoming.items():
+        if state == 'moved':
+            collisions.append(_collision(new, day, lesson))
+        elif state != 'free':
+            skipped += 1
+        elif key not in old_upcoming:
+            created.append(_entry(new, day))
+
+    for key, (day, (state, lesson)) in old_upcoming.items():
+        if state == 'free' and key not in new_upcoming:
+            entry = _entry(old, day)
+            entry['stored'] = False
+            deleted.append(entry)
+
+    if rule_changed:
+        for lesson in period.rows:
+            if lesson['student_id'] == old['student_id'] and _is_untouched_future(lesson, old, now):
+                entry = _entry(old, lesson['date'], lesson['id'])
+                entry['stored'] = True
+                deleted.append(entry)
+
+    result = _result(created, deleted, collisions, skipped, started)
+    result['rule_changed'] = rule_changed
+    return result
@@ -1,11 +1,10 @@
-from flask import Flask, render_template, request, redirect, url_for, session, jsonify
+from flask import Flask, render_template, request, redirect, url_for, session, jsonify, Response
 import requests
 import psycopg2
 import psycopg2.extras
 from datetime import datetime, timedelta
 import calendar
 import pytz
-import uuid
 import json
 
 app = Flask(__name__)
@@ -14,18 +13,48 @@ app.permanent_session_lifetime = timedelta(days=30)
 
 # Настройки подключения к PostgreSQL
 import os
+import sys
 from dotenv import load_dotenv
 
 # Загружаем настройки из .env файла
 load_dotenv()
 
-DATABASE_CONFIG = {
-    'host': os.getenv('DB_HOST'),
-    'port': int(os.getenv('DB_PORT')),
-    'database': os.getenv('DB_NAME'),
-    'user': os.getenv('DB_USER'),
-    'password': os.getenv('DB_PASSWORD')
-}
+# Общие модули (пул подключений к БД) лежат в папке сайта
+SITE_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Alien Tutor site'))
+if SITE_DIR not in sys.path:
+    sys.path.insert(0, SITE_DIR)
+
+from models.database import load_database_config, get_db_connection, get_pool, init_app, unit_of_work, stream_query
+from models.database import execute_query as db_execute_query
+from models.query_stats import get_query_stats, reset_query_stats
+from models.events import notify_change, notify_changes
+from models import ledger, periods
+from models.schedule_index import ScheduleIndex
+from models.scheduler import PeriodicJob
+from models.settlement import settle_overdue_lessons
+from models.materializer import materialize_templates
+from models.migrations import migrate
+from models import recurrence
+from models.lesson_ids import find_lesson_id
+from models import template_preview
+from models.family_roster import family_roster, get_family_roster, start_family_roster
+
+DATABASE_CONFIG = load_database_config()
+
+# Проведение прошедших уроков в фоне: раз в SETTLEMENT_INTERVAL секунд
+SETTLEMENT_INTERVAL = int(os.getenv('SETTLEMENT_INTERVAL', 60))
+SETTLEMENT_LOCK_KEY = 7302   # advisory-блокировка: проводит только один процесс
+
+# Закрытие прошлого месяца контрольными точками балансов - отдельной задачей
+MONTH_CLOSE_INTERVAL = int(os.getenv('MONTH_CLOSE_INTERVAL', 3600))
+MONTH_CLOSE_LOCK_KEY = 7303
+
+# История платежей: столько записей на странице, дальше - "Показать еще"
+PAYMENT_HISTORY_PAGE_SIZE = int(os.getenv('PAYMENT_HISTORY_PAGE_SIZE', 50))
+
+# Одно подключение и одна транзакция на каждый HTTP-запрос:
+# многошаговые операции (удаление ученика, списание за урок) применяются целиком или никак
+init_app(app)
 
 # Словарь часовых поясов
 TIMEZONE_MAPPING = {
@@ -61,45 +90,16 @@ TIMEZONE_MAPPING = {
 # ПОДКЛЮЧЕНИЕ К БАЗЕ ДАННЫХ
 # ============================================================================
 
-def get_db_connection():
-    """Получить подключение к базе данных"""
-    try:
-        conn = psycopg2.connect(**DATABASE_CONFIG)
-        return conn
-    except psycopg2.Error as e:
-        print(f"Ошибка подключения к БД: {e}")
-        return None
-
-def execute_query(query, params=None, fetch=False, fetch_one=False):
-    """Выполнить SQL запрос"""
-    conn = get_db_connection()
-    if not conn:
-        print("❌ Нет подключения к БД")
-        return None
+def execute_query(query, params=None, fetch=False, fetch_one=False, name=None):
+    """Выполнить SQL запрос (подключение берется из общего пула)"""
+    print(f"🔍 Выполняем запрос: {query}")
+    print(f"🔍 Параметры: {params}")
     
-    try:
-        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
-            print(f"🔍 Выполняем запрос: {query}")
-            print(f"🔍 Параметры: {params}")
-            
-            cur.execute(query, params)
-            
-            if fetch_one:
-                result = cur.fetchone()
-            elif fetch:
-                result = cur.fetchall()
-            else:
-                result = cur.rowcount  # ✅ Изменение здесь!
-                print(f"🔍 Количество затронутых строк: {result}")
-                
-            conn.commit()
-            return result
-    except psycopg2.Error as e:
-        print(f"❌ Ошибка выполнения запроса: {e}")
-        conn.rollback()
-        return None
-    finally:
-        conn.close()
+    result = db_execute_query(query, params, fetch=fetch, fetch_one=fetch_one, name=name)
+    
+    if not fetch and not fetch_one:
+        print(f"🔍 Количество затронутых строк: {result}")
+    return result
 
 # ============================================================================
 # ФУНКЦИИ ДЛЯ УЧЕНИКОВ
@@ -116,6 +116,17 @@ def load_students():
     result = execute_query(query, fetch=True)
     return [dict(row) for row in result] if result else []
 
+def load_student(student_id):
+    """Загрузить ученика по ID (в том же виде, что и load_students)"""
+    query = """
+        SELECT id, name, class_level as class, city, timezone, parent_name, 
+               contact, notes, lesson_price, created_at
+        FROM students 
+        WHERE id = %s
+    """
+    result = execute_query(query, (student_id,), fetch_one=True)
+    return dict(result) if result else None
+
 def verify_admin_login(login, password):
     """Проверка логина и пароля админа"""
     query = """
@@ -150,6 +161,8 @@ def save_student(student_data):
     
     if result:
         student_id = result['id']
+        family_roster.invalidate('students')
+        notify_change('students', student_id)
         registration_time = datetime.now()
         
         # Создаем учетные записи для ученика и родителя
@@ -173,6 +186,8 @@ def update_student(student_id, student_data):
     """
     student_data['student_id'] = student_id
     execute_query(query, student_data)
+    family_roster.invalidate('students')
+    notify_change('students', student_id)
 
 def delete_student_completely(student_id):
     """Полное удаление ученика и всех его данных"""
@@ -206,6 +221,9 @@ def delete_student_completely(student_id):
             result = execute_query(query, (student_id,))
             print(f"✅ Удалено записей: {result}")
         
+        family_roster.invalidate('students')
+        notify_changes(['lesson_reports', 'homework_assignments', 'exam_results', 'lessons', 'payments', 'students'],
+                       [student_id])
         print(f"🎉 Ученик {student_id} полностью удален!")
         return True
         
@@ -270,39 +288,59 @@ def create_user_account(student_id, student_name, registration_time):
 # ФУНКЦИИ ДЛЯ УРОКОВ
 # ============================================================================
 
-def load_slots():
-    """Загрузить все уроки"""
+def slot_from_row(row):
+    """Строка lessons + student_name -> словарь слота (формат старого кода)"""
+    slot = {
+        'id': row['id'],
+        'student': row['student_name'],
+        'subject': row['subject'],
+        'time': str(row['time']),
+        'status': row['status'],
+        'lesson_type': row['lesson_type'],
+        'lesson_duration': row['lesson_duration'],
+        'from_template': row['from_template'],
+        'is_paid': row['is_paid']
+    }
+    
+    if row['date']:
+        slot['date'] = row['date'].strftime('%Y-%m-%d')
+    if row['weekday']:
+        slot['day'] = get_weekday_ru(row['weekday'] - 1)
+    
+    return slot
+
+def load_lessons_between(start, end):
+    """Загрузить уроки с датой в [start, end) и уроки без даты (регулярные по дню недели)
+
+    Страница расписания читает только показанные дни, а не всю историю уроков
+    (две части через UNION ALL, чтобы диапазон по date шел по индексу).
+    """
     query = """
         SELECT l.*, s.name as student_name
         FROM lessons l
         LEFT JOIN students s ON l.student_id = s.id
-        ORDER BY l.date, l.time
+        WHERE l.date >= %(start)s AND l.date < %(end)s
+        UNION ALL
+        SELECT l.*, s.name as student_name
+        FROM lessons l
+        LEFT JOIN students s ON l.student_id = s.id
+        WHERE l.date IS NULL
+        ORDER BY date, time
     """
-    result = execute_query(query, fetch=True)
+    result = execute_query(query, {'start': start, 'end': end}, fetch=True) or []
     
-    # Преобразуем в формат, совместимый со старым кодом
-    slots = []
-    for row in result:
-        slot = {
-            'id': row['id'],
-            'student': row['student_name'],
-            'subject': row['subject'],
-            'time': str(row['time']),
-            'status': row['status'],
-            'lesson_type': row['lesson_type'],
-            'lesson_duration': row['lesson_duration'],
-            'from_template': row['from_template'],
-            'is_paid': row['is_paid']
-        }
-        
-        if row['date']:
-            slot['date'] = row['date'].strftime('%Y-%m-%d')
-        if row['day_of_week']:
-            slot['day'] = row['day_of_week']
-            
-        slots.append(slot)
-    
-    return slots
+    # Уроки по правилам шаблона недели (в lessons их нет, пока их не изменили)
+    occurrences = recurrence.load_occurrences(start, end)
+    if occurrences:
+        dated = [row for row in result if row['date']] + occurrences
+        dated.sort(key=lambda row: (row['date'], row['time']))
+        result = dated + [row for row in result if not row['date']]
+    return [slot_from_row(row) for row in result]
+
+def load_week_lessons(week_dates):
+    """Уроки для дней из get_week_dates()"""
+    start = datetime.strptime(week_dates[0]['full_date'], '%Y-%m-%d').date()
+    return load_lessons_between(start, start + timedelta(days=len(week_dates)))
 
 def create_lesson(lesson_data):
     """Создать новый урок"""
@@ -311,21 +349,20 @@ def create_lesson(lesson_data):
         return None
         
     query = """
-        INSERT INTO lessons (id, student_id, date, time, day_of_week, subject, status, 
+        INSERT INTO lessons (student_id, date, time, weekday, subject, status, 
                         lesson_type, lesson_duration, from_template, is_paid, 
                         original_date, original_time, is_moved, moved_reason, created_at)
-        VALUES (%(id)s, %(student_id)s, %(date)s, %(time)s, %(day_of_week)s, %(subject)s, %(status)s,
+        VALUES (%(student_id)s, %(date)s, %(time)s, %(weekday)s, %(subject)s, %(status)s,
                 %(lesson_type)s, %(lesson_duration)s, %(from_template)s, %(is_paid)s,
                 %(original_date)s, %(original_time)s, %(is_moved)s, %(moved_reason)s, NOW())
         RETURNING id
     """
     
     lesson_params = {
-        'id': lesson_data.get('id', generate_slot_id()),
         'student_id': student['id'],
         'date': lesson_data.get('date'),
         'time': lesson_data.get('time'),
-        'day_of_week': lesson_data.get('day'),
+        'weekday': get_iso_weekday(lesson_data.get('day')),
         'subject': lesson_data.get('subject'),
         'status': lesson_data.get('status', 'scheduled'),
         'lesson_type': lesson_data.get('lesson_type', 'regular'),
@@ -340,10 +377,14 @@ def create_lesson(lesson_data):
     }
     
     result = execute_query(query, lesson_params, fetch_one=True)
+    if result:
+        ledger.record_lesson_status(student['id'], None, lesson_params['status'])
+        notify_change('lessons', student['id'])
     return result['id'] if result else None
 
 def update_lesson(lesson_id, lesson_data, is_system_update=False):
     """Обновить урок"""
+    lesson_id = recurrence.resolve_lesson_id(lesson_id)
     print(f"🔄 Начинаем обновление урока {lesson_id}")
     print(f"🔄 Новые данные: {lesson_data}")
     print(f"🔄 Системное обновление: {is_system_update}")
@@ -410,15 +451,17 @@ def update_lesson(lesson_id, lesson_data, is_system_update=False):
                 if payment_result:
                     # Создаем возврат средств
                     refund_amount = abs(payment_result['amount'])  # Делаем положительным
+                    ledger.lock_balance(student['id'])
                     refund_query = """
-                        INSERT INTO payments (id, student_id, amount, payment_type, description, lesson_id, payment_date, created_at)
-                        VALUES (%s, %s, %s, %s, %s, %s, NOW(), NOW())
+                        INSERT INTO payments (student_id, amount, payment_type, description, lesson_id, payment_date, created_at)
+                        VALUES (%s, %s, %s, %s, %s, NOW(), NOW())
                     """
-                    refund_id = generate_slot_id()
                     execute_query(refund_query, (
-                        refund_id, student['id'], refund_amount, 'refund', 
+                        student['id'], refund_amount, 'refund', 
                         f"Возврат за перенос урока {lesson_id}", lesson_id
                     ))
+                    ledger.record_payment(student['id'], refund_amount)
+                    notify_change('payments', student['id'])
                     print(f"✅ Создан возврат {refund_amount} руб. за урок {lesson_id}")
                 
                 # Меняем статус на scheduled только если переносим в будущее
@@ -443,7 +486,7 @@ def update_lesson(lesson_id, lesson_data, is_system_update=False):
     # Обновляем урок
     query = """
         UPDATE lessons 
-        SET student_id=%(student_id)s, date=%(date)s, time=%(time)s, day_of_week=%(day_of_week)s,
+        SET student_id=%(student_id)s, date=%(date)s, time=%(time)s, weekday=%(weekday)s,
             subject=%(subject)s, status=%(status)s, lesson_duration=%(lesson_duration)s
         WHERE id=%(lesson_id)s
     """
@@ -453,7 +496,7 @@ def update_lesson(lesson_id, lesson_data, is_system_update=False):
         'student_id': student['id'],
         'date': lesson_data.get('date'),
         'time': lesson_data.get('time'),
-        'day_of_week': lesson_data.get('day'),
+        'weekday': get_iso_weekday(lesson_data.get('day')),
         'subject': lesson_data.get('subject'),
         'status': lesson_data.get('status', 'scheduled'),
         'lesson_duration': lesson_data.get('lesson_duration', 60)
@@ -462,22 +505,43 @@ def update_lesson(lesson_id, lesson_data, is_system_update=False):
     print(f"🔄 Обновляем урок с параметрами: {lesson_params}")
     
     execute_query(query, lesson_params)
+    
+    # Проведенные уроки в сводке балансов (урок мог перейти к другому ученику)
+    if current_lesson.get('student_id') == student['id']:
+        ledger.record_lesson_status(student['id'], current_status, lesson_params['status'])
+    else:
+        ledger.record_lesson_status(current_lesson.get('student_id'), current_status, None)
+        ledger.record_lesson_status(student['id'], None, lesson_params['status'])
+    
+    # Урок мог перейти к другому ученику - сообщаем об обоих
+    notify_changes('lessons', [current_lesson.get('student_id'), student['id']])
     print(f"✅ Урок {lesson_id} обновлен")
     return True
 
 def update_lesson_status(lesson_id, new_status):
     """Обновить только статус урока"""
-    query = "UPDATE lessons SET status = %s WHERE id = %s"
-    execute_query(query, (new_status, lesson_id))
+    lesson_id = recurrence.resolve_lesson_id(lesson_id)
+    query = """
+        UPDATE lessons l SET status = %s
+        FROM lessons old
+        WHERE l.id = %s AND old.id = l.id
+        RETURNING l.student_id, old.status as old_status
+    """
+    result = execute_query(query, (new_status, lesson_id), fetch_one=True)
+    if result:
+        ledger.record_lesson_status(result['student_id'], result['old_status'], new_status)
+        notify_change('lessons', result['student_id'])
     return True
 
 def delete_lesson(lesson_id):
     """Удалить урок и все связанные платежи"""
     print(f"🗑️ Удаляем урок {lesson_id} и связанные данные")
+    lesson_id = recurrence.resolve_lesson_id(lesson_id)
     
     # Сначала удаляем все платежи за этот урок
-    payments_query = "DELETE FROM payments WHERE lesson_id = %s"
-    execute_query(payments_query, (lesson_id,))
+    payments_query = "DELETE FROM payments WHERE lesson_id = %s RETURNING id, student_id, amount"
+    deleted_payments = execute_query(payments_query, (lesson_id,), fetch=True)
+    ledger.remove_payments(deleted_payments)
     print(f"✅ Удалены платежи за урок {lesson_id}")
     
     # Потом удаляем отчеты и домашки
@@ -488,26 +552,42 @@ def delete_lesson(lesson_id):
     execute_query(homework_query, (lesson_id,))
     
     # И наконец удаляем сам урок
-    lesson_query = "DELETE FROM lessons WHERE id = %s"
-    result = execute_query(lesson_query, (lesson_id,))
+    lesson_query = """
+        DELETE FROM lessons WHERE id = %s
+        RETURNING student_id, status, from_template, original_date, original_time
+    """
+    result = execute_query(lesson_query, (lesson_id,), fetch_one=True)
+    if result:
+        ledger.remove_lessons([result])
+        if result['from_template'] and result['original_date'] and result['original_time']:
+            # Иначе урок снова появится по правилу шаблона
+            recurrence.skip_occurrence(result['student_id'], result['original_date'], result['original_time'])
+        notify_changes(['payments', 'lesson_reports', 'homework_assignments', 'lessons'], [result['student_id']])
     
     print(f"✅ Урок {lesson_id} полностью удален")
-    return result is not None and result > 0
+    return result is not None
 
 def get_lesson_by_id(lesson_id):
-    """Получить урок по ID"""
-    query = """
-        SELECT l.*, s.name as student_name
-        FROM lessons l
-        LEFT JOIN students s ON l.student_id = s.id
-        WHERE l.id = %s
-    """
-    result = execute_query(query, (lesson_id,), fetch_one=True)
+    """Получить урок по ID (в т.ч. по старому id и еще не сохраненный урок по правилу шаблона)"""
+    if recurrence.parse_virtual_id(lesson_id):
+        result = recurrence.get_occurrence(lesson_id)
+    else:
+        lesson_id = find_lesson_id(lesson_id)
+        if lesson_id is None:
+            return None
+        query = """
+            SELECT l.*, s.name as student_name
+            FROM lessons l
+            LEFT JOIN students s ON l.student_id = s.id
+            WHERE l.id = %s
+        """
+        result = execute_query(query, (lesson_id,), fetch_one=True)
     
     if result:
         lesson = {
             'id': result['id'],
             'student': result['student_name'],
+            'student_id': result['student_id'],
             'subject': result['subject'],
             'time': str(result['time']),
             'status': result['status'],
@@ -519,8 +599,8 @@ def get_lesson_by_id(lesson_id):
         
         if result['date']:
             lesson['date'] = result['date'].strftime('%Y-%m-%d')
-        if result['day_of_week']:
-            lesson['day'] = result['day_of_week']
+        if result['weekday']:
+            lesson['day'] = get_weekday_ru(result['weekday'] - 1)
             
         return lesson
     
@@ -530,10 +610,6 @@ def get_lesson_by_id(lesson_id):
 # ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ
 # ============================================================================
 
-def generate_slot_id():
-    """Генерирует уникальный ID для занятия"""
-    return str(uuid.uuid4())[:8]
-
 def convert_time_for_user(time_str, from_timezone='МСК', to_timezone='МСК'):
     """Конвертирует время между часовыми поясами"""
     try:
@@ -568,43 +644,50 @@ def load_template_week():
         SELECT lt.*, s.name as student_name
         FROM lesson_templates lt
         LEFT JOIN students s ON lt.student_id = s.id
-        ORDER BY 
-            CASE lt.day_of_week
-                WHEN 'Понедельник' THEN 1
-                WHEN 'Вторник' THEN 2
-                WHEN 'Среда' THEN 3
-                WHEN 'Четверг' THEN 4
-                WHEN 'Пятница' THEN 5
-                WHEN 'Суббота' THEN 6
-                WHEN 'Воскресенье' THEN 7
-            END, lt.time
+        ORDER BY lt.weekday, lt.time
     """
     result = execute_query(query, fetch=True)
+    return [template_from_row(row) for row in result]
+
+def load_template_lesson(template_id):
+    """Загрузить один урок шаблона недели по ID (в том же виде, что и load_template_week)"""
+    query = """
+        SELECT lt.*, s.name as student_name
+        FROM lesson_templates lt
+        LEFT JOIN students s ON lt.student_id = s.id
+        WHERE lt.id = %s
+    """
+    row = execute_query(query, (template_id,), fetch_one=True)
+    return template_from_row(row) if row else None
+
+def template_from_row(row):
+    """Урок шаблона для страниц и API из строки lesson_templates"""
+    template = {
+        'id': row['id'],
+        'day': get_weekday_ru(row['weekday'] - 1) if row['weekday'] else None,
+        'time': str(row['time']),
+        'student': row['student_name'],
+        'subject': row['subject'],
+        'lesson_type': row['lesson_type'],
+        'lesson_duration': row['lesson_duration']
+    }
     
-    templates = []
-    for row in result:
-        template = {
-            'day': row['day_of_week'],
-            'time': str(row['time']),
-            'student': row['student_name'],
-            'subject': row['subject'],
-            'lesson_type': row['lesson_type'],
-            'lesson_duration': row['lesson_duration']
-        }
+    if row['start_date']:
+        template['start_date'] = row['start_date'].strftime('%Y-%m-%d')
+    else:
+        template['start_date'] = ""
         
-        if row['start_date']:
-            template['start_date'] = row['start_date'].strftime('%Y-%m-%d')
-        else:
-            template['start_date'] = ""
-            
-        if row['end_date']:
-            template['end_date'] = row['end_date'].strftime('%Y-%m-%d')
-        else:
-            template['end_date'] = ""
-            
-        templates.append(template)
-    
-    return templates
+    if row['end_date']:
+        template['end_date'] = row['end_date'].strftime('%Y-%m-%d')
+    else:
+        template['end_date'] = ""
+        
+    return template
+
+def get_template(template_id):
+    """Строка lesson_templates по ID"""
+    query = "SELECT id, weekday, time, student_id FROM lesson_templates WHERE id = %s"
+    return execute_query(query, (template_id,), fetch_one=True)
 
 def add_template_lesson(lesson_data):
     """Добавить новый урок в шаблон недели"""
@@ -615,22 +698,23 @@ def add_template_lesson(lesson_data):
     # Проверяем дублирование
     check_query = """
         SELECT id FROM lesson_templates 
-        WHERE day_of_week = %s AND time = %s AND student_id = %s
+        WHERE weekday = %s AND time = %s AND student_id = %s
     """
-    existing = execute_query(check_query, (lesson_data.get("day"), lesson_data.get("time"), student['id']), fetch_one=True)
+    weekday = get_iso_weekday(lesson_data.get("day"))
+    existing = execute_query(check_query, (weekday, lesson_data.get("time"), student['id']), fetch_one=True)
     
     if existing:
         return False  # дубликат найден
     
     query = """
-        INSERT INTO lesson_templates (day_of_week, time, student_id, subject, start_date, end_date,
+        INSERT INTO lesson_templates (weekday, time, student_id, subject, start_date, end_date,
                                     lesson_type, lesson_duration, created_at)
-        VALUES (%(day)s, %(time)s, %(student_id)s, %(subject)s, %(start_date)s, %(end_date)s,
+        VALUES (%(weekday)s, %(time)s, %(student_id)s, %(subject)s, %(start_date)s, %(end_date)s,
                 %(lesson_type)s, %(lesson_duration)s, NOW())
     """
     
     template_params = {
-        'day': lesson_data.get("day"),
+        'weekday': weekday,
         'time': lesson_data.get("time"),
         'student_id': student['id'],
         'subject': lesson_data.get("subject"),
@@ -641,39 +725,25 @@ def add_template_lesson(lesson_data):
     }
     
     execute_query(query, template_params)
+    # Уроки по новому правилу сразу появляются в расписании
+    notify_change('lessons', student['id'])
     return True
 
-def update_template_lesson(index, lesson_data):
-    """Обновить урок в шаблоне недели с автоматическим удалением старых регулярных уроков"""
-    print(f"🔄 Обновляем урок в шаблоне, индекс: {index}")
+def update_template_lesson(template_id, lesson_data):
+    """Обновить урок в шаблоне недели
+
+    Шаблон - правило, будущие уроки по нему не хранятся, поэтому обновляется одна
+    строка. Если поменялись день, время или ученик, новое правило действует с
+    текущего момента: уже начавшиеся уроки по старому сохраняются как были.
+    """
+    print(f"🔄 Обновляем урок в шаблоне, ID: {template_id}")
     print(f"🔄 Новые данные: {lesson_data}")
     
-    # Получаем список всех шаблонов для определения ID по индексу
-    templates = load_template_week()
-    if index < 0 or index >= len(templates):
-        return False
-        
-    # Получаем ID шаблона по порядковому номеру
-    query_get_id = """
-        SELECT id, day_of_week, time, student_id FROM lesson_templates 
-        ORDER BY 
-            CASE day_of_week
-                WHEN 'Понедельник' THEN 1
-                WHEN 'Вторник' THEN 2
-                WHEN 'Среда' THEN 3
-                WHEN 'Четверг' THEN 4
-                WHEN 'Пятница' THEN 5
-                WHEN 'Суббота' THEN 6
-                WHEN 'Воскресенье' THEN 7
-            END, time
-        LIMIT 1 OFFSET %s
-    """
-    result = execute_query(query_get_id, (index,), fetch_one=True)
+    result = get_template(template_id)
     if not result:
         return False
         
-    template_id = result['id']
-    old_day = result['day_of_week']
+    old_day = result['weekday']
     old_time = result['time']
     old_student_id = result['student_id']
     
@@ -684,67 +754,34 @@ def update_template_lesson(index, lesson_data):
         return False
     
     new_student_id = student['id']
-    new_day = lesson_data.get("day")
+    new_day = get_iso_weekday(lesson_data.get("day"))
     new_time = lesson_data.get("time")
     
     print(f"🔄 Новые параметры: {new_day} {new_time}, student_id: {new_student_id}")
     
-    # ВАЖНО: Удаляем старые регулярные уроки только если что-то изменилось
-    # НО ТОЛЬКО БУДУЩИЕ УРОКИ! Прошедшие не трогаем!
-    if (old_day != new_day or old_time != new_time or old_student_id != new_student_id):
-        print(f"🗑️ Найдены изменения! Удаляем ТОЛЬКО БУДУЩИЕ регулярные уроки...")
-        
-        # ИСПРАВЛЕНИЕ: Удаляем ТОЛЬКО будущие уроки, прошедшие не трогаем
-        delete_old_query = """
-            DELETE FROM lessons 
-            WHERE student_id = %s 
-            AND original_date IS NOT NULL 
-            AND original_time = %s
-            AND EXTRACT(DOW FROM original_date) = %s
-            AND from_template = true 
-            AND status NOT IN ('cancelled') 
-            AND date >= CURRENT_DATE
-        """
-        
-        # Преобразуем день недели в номер (0=воскресенье, 1=понедельник, etc.)
-        old_day_num = {
-            'Воскресенье': 0, 'Понедельник': 1, 'Вторник': 2, 'Среда': 3,
-            'Четверг': 4, 'Пятница': 5, 'Суббота': 6
-        }.get(old_day, 1)
-        
-        deleted_count = execute_query(delete_old_query, (old_student_id, old_time, old_day_num))
-        print(f"🗑️ Удалено будущих регулярных уроков: {deleted_count}")
-        
-        # КРИТИЧЕСКИ ВАЖНО: НЕ ОБНОВЛЯЕМ ПРОШЕДШИЕ УРОКИ ВООБЩЕ!
-        # Проверяем, есть ли прошедшие уроки с этими параметрами
-        check_past_query = """
-            SELECT COUNT(*) as count FROM lessons 
-            WHERE student_id = %s 
-            AND original_time = %s
-            AND EXTRACT(DOW FROM original_date) = %s
-            AND from_template = true 
-            AND date < CURRENT_DATE
-        """
-        past_lessons_result = execute_query(check_past_query, (old_student_id, old_time, old_day_num), fetch_one=True)
-        past_lessons_count = past_lessons_result['count'] if past_lessons_result else 0
-        
-        if past_lessons_count > 0:
-            print(f"⚠️ ВНИМАНИЕ: Найдено {past_lessons_count} прошедших уроков. Их НЕ ТРОГАЕМ!")
+    rule_changed = (old_day != new_day or str(old_time)[:5] != str(new_time)[:5] or old_student_id != new_student_id)
+    if rule_changed:
+        # Прошлое старого правила - в lessons, заранее созданные будущие уроки - удаляем
+        recurrence.freeze_rule_history(template_id)
+        dropped = recurrence.drop_untouched_future(template_id)
+        print(f"🗑️ Удалено заранее созданных будущих уроков: {len(dropped)}")
     else:
-        print(f"ℹ️ Изменений в расписании нет, старые уроки не удаляем")
+        print(f"ℹ️ День, время и ученик не изменились")
     
     # Обновляем ТОЛЬКО сам шаблон, НЕ ТРОГАЕМ существующие уроки
     query = """
         UPDATE lesson_templates 
-        SET day_of_week=%(day)s, time=%(time)s, student_id=%(student_id)s, subject=%(subject)s,
+        SET weekday=%(weekday)s, time=%(time)s, student_id=%(student_id)s, subject=%(subject)s,
             start_date=%(start_date)s, end_date=%(end_date)s, lesson_type=%(lesson_type)s,
-            lesson_duration=%(lesson_duration)s
+            lesson_duration=%(lesson_duration)s,
+            rule_start = CASE WHEN %(rule_changed)s THEN NOW() ELSE rule_start END
         WHERE id=%(template_id)s
     """
     
     template_params = {
         'template_id': template_id,
-        'day': lesson_data.get("day"),
+        'rule_changed': rule_changed,
+        'weekday': new_day,
         'time': lesson_data.get("time"),
         'student_id': student['id'],
         'subject': lesson_data.get("subject"),
@@ -755,43 +792,21 @@ def update_template_lesson(index, lesson_data):
     }
     
     execute_query(query, template_params)
+    notify_changes('lessons', [old_student_id, new_student_id])
     print(f"✅ Шаблон обновлен! Прошедшие уроки остались нетронутыми!")
     
     return True
 
-def delete_template_lesson(index):
+def delete_template_lesson(template_id):
     """Удалить урок из шаблона недели"""
-    # Получаем ID шаблона по порядковому номеру
-    query_get_id = """
-        SELECT id FROM lesson_templates 
-        ORDER BY 
-            CASE day_of_week
-                WHEN 'Понедельник' THEN 1
-                WHEN 'Вторник' THEN 2
-                WHEN 'Среда' THEN 3
-                WHEN 'Четверг' THEN 4
-                WHEN 'Пятница' THEN 5
-                WHEN 'Суббота' THEN 6
-                WHEN 'Воскресенье' THEN 7
-            END, time
-        LIMIT 1 OFFSET %s
-    """
-    result = execute_query(query_get_id, (index,), fetch_one=True)
+    result = get_template(template_id)
     if not result:
         return False
-        
-    template_id = result['id']
     
-    # Удаляем связанные уроки из расписания
-    delete_related_query = """
-        DELETE FROM lessons 
-        WHERE from_template = true 
-        AND student_id = (SELECT student_id FROM lesson_templates WHERE id = %s)
-        AND day_of_week = (SELECT day_of_week FROM lesson_templates WHERE id = %s)
-        AND time = (SELECT time FROM lesson_templates WHERE id = %s)
-        AND subject = (SELECT subject FROM lesson_templates WHERE id = %s)
-    """
-    execute_query(delete_related_query, (template_id, template_id, template_id, template_id))
+    # Прошедшие уроки по правилу остаются, будущие исчезают вместе с правилом
+    recurrence.freeze_rule_history(template_id)
+    recurrence.drop_untouched_future(template_id)
+    notify_change('lessons', result['student_id'])
     
     # Удаляем сам шаблон
     query = "DELETE FROM lesson_templates WHERE id = %s"
@@ -803,94 +818,16 @@ def delete_template_lesson(index):
 # ============================================================================
 
 def apply_template_to_schedule_with_periods():
-    """Применить шаблон недели с учетом указанных периодов"""
-    template = load_template_week()
-    added_count = 0
-    today = datetime.now().date()
-    
-    for template_lesson in template:
-        start_date = template_lesson.get('start_date')
-        end_date = template_lesson.get('end_date')
-        
-        # Пропускаем пустые записи
-        if not template_lesson.get('day') or not template_lesson.get('time') or not template_lesson.get('student'):
-            continue
-        
-        # Определяем период действия урока
-        if start_date:
-            try:
-                start_date_obj = datetime.strptime(start_date, '%Y-%m-%d').date()
-            except:
-                start_date_obj = today
-        else:
-            start_date_obj = today
-        
-        if end_date:
-            try:
-                end_date_obj = datetime.strptime(end_date, '%Y-%m-%d').date()
-            except:
-                end_date_obj = today + timedelta(days=365)
-        else:
-            end_date_obj = today + timedelta(days=365)
-        
-        # Находим все даты в указанном периоде для нужного дня недели
-        day_name = template_lesson['day']
-        target_weekday = get_weekday_num(day_name)
-        
-        current_date = start_date_obj
-        while current_date <= end_date_obj:
-            if current_date.weekday() == target_weekday:
-                # Проверяем, нет ли уже урока с этим учеником на эту дату/время (включая перенесенные)
-                check_query = """
-                    SELECT id FROM lessons 
-                    WHERE student_id = (SELECT id FROM students WHERE name = %s)
-                    AND (
-                        (original_date = %s AND original_time = %s) OR 
-                        (date = %s AND time = %s)
-                    )
-                """
+    """Применить шаблон недели с учетом указанных периодов
 
-                print(f"🔍 ПРОВЕРЯЕМ: {template_lesson['student']} на {current_date} в {template_lesson['time']}")
-                existing = execute_query(check_query, (
-                    template_lesson['student'], 
-                    current_date, template_lesson['time'],  # original_date, original_time
-                    current_date, template_lesson['time']   # date, time
-                ), fetch_one=True)
-                print(f"🔍 РЕЗУЛЬТАТ ПРОВЕРКИ: {existing}")
-
-                if not existing:
-                    print(f"✅ СОЗДАЕМ УРОК: {template_lesson['student']} на {current_date} в {template_lesson['time']}")
-                    
-                    # Создаем новый урок с правильными полями
-                    lesson_data = {
-                        'id': generate_slot_id(),
-                        'date': current_date.strftime('%Y-%m-%d'),
-                        'time': template_lesson['time'],
-                        'student': template_lesson['student'],
-                        'subject': template_lesson['subject'],
-                        'status': 'scheduled',
-                        'from_template': True,
-                        'lesson_type': template_lesson.get('lesson_type', 'regular'),
-                        'lesson_duration': template_lesson.get('lesson_duration', 60),
-                        'original_date': current_date.strftime('%Y-%m-%d'),
-                        'original_time': template_lesson['time'],
-                        'is_moved': False,
-                        'moved_reason': None
-                    }
-                    
-                    print(f"🔍 ДАННЫЕ УРОКА: {lesson_data}")
-                    
-                    if create_lesson(lesson_data):
-                        added_count += 1
-                        print(f"✅ УРОК СОЗДАН! Всего создано: {added_count}")
-                    else:
-                        print(f"❌ ОШИБКА СОЗДАНИЯ УРОКА!")
-                else:
-                    print(f"⏭️ УРОК УЖЕ СУЩЕСТВУЕТ, ПРОПУСКАЕМ")
-            
-            current_date += timedelta(days=1)
-    
-    return added_count
+    Возвращает {'added', 'skipped', 'clipped'} (см. materialize_templates).
+    """
+    result = materialize_templates()
+    if result is None:
+        raise RuntimeError("Не удалось создать уроки по шаблону")
+    print(f"✅ Шаблон применен: создано {result['added']}, уже были {result['skipped']}, "
+          f"отрезано периодами {result['clipped']}")
+    return result
 
 # ============================================================================
 # ФУНКЦИИ ДЛЯ РАБОТЫ С СЕМЬЯМИ
@@ -898,118 +835,78 @@ def apply_template_to_schedule_with_periods():
 
 def get_families():
     """Определить все семьи по parent_name (2+ детей)"""
-    query = """
-        SELECT parent_name, COUNT(*) as children_count
-        FROM students 
-        WHERE parent_name IS NOT NULL AND parent_name != ''
-        GROUP BY parent_name
-        HAVING COUNT(*) > 1
-    """
-    families_result = execute_query(query, fetch=True)
-    
-    families = {}
-    for family in families_result:
-        parent_name = family['parent_name']
-        
-        # Получаем детей этой семьи
-        children_query = """
-            SELECT id, name, class_level, city, timezone, contact, notes, lesson_price
-            FROM students 
-            WHERE parent_name = %s
-            ORDER BY name
-        """
-        children = execute_query(children_query, (parent_name,), fetch=True)
-        families[parent_name] = [dict(child) for child in children]
-    
-    return families
-
-def get_family_members(parent_name):
-    """Получить список детей в семье"""
-    families = get_families()
-    return families.get(parent_name, [])
+    return {parent_name: [dict(child) for child in children]
+            for parent_name, children in get_family_roster().families.items()}
 
 def is_student_in_family(student_name):
     """Проверить, принадлежит ли ученик к семье"""
-    student = get_student_by_name(student_name)
-    if not student:
-        return False, None
-    
-    parent_name = student.get('parent_name', '').strip()
-    if not parent_name:
-        return False, None
-    
-    family_members = get_family_members(parent_name)
-    return len(family_members) > 1, parent_name
+    return get_family_roster().family_of(student_name)
 
 def get_student_family_parent(student_name):
     """Получить родителя ученика"""
-    student = get_student_by_name(student_name)
-    return student.get('parent_name', '').strip() if student else None
+    return get_family_roster().parent_of(student_name)
 
 # ============================================================================
 # ФУНКЦИИ ДЛЯ СЕМЕЙНЫХ БАЛАНСОВ
 # ============================================================================
 
-def get_family_balance(parent_name):
-    """Получить баланс семьи"""
-    query = "SELECT * FROM families WHERE parent_name = %s"
-    result = execute_query(query, (parent_name,), fetch_one=True)
-    
-    if not result:
-        # Создаем новый семейный баланс
-        family_balance = {
+def family_balance_from_row(row):
+    """Баланс семьи из строки families (None - строки еще нет, все по нулям)"""
+    if not row:
+        return {
             "family_balance": 0,
             "total_family_paid": 0,
             "total_family_spent": 0,
-            "created_at": datetime.now().isoformat()
+            "created_at": ""
         }
-        
-        create_query = """
-            INSERT INTO families (parent_name, family_balance, total_family_paid, total_family_spent, created_at)
-            VALUES (%s, %s, %s, %s, NOW())
-        """
-        execute_query(create_query, (parent_name, 0, 0, 0))
-        return family_balance
-    
     return {
-        "family_balance": float(result['family_balance']),
-        "total_family_paid": float(result['total_family_paid']),
-        "total_family_spent": float(result['total_family_spent']),
-        "created_at": result['created_at'].isoformat() if result['created_at'] else ""
+        "family_balance": float(row['family_balance']),
+        "total_family_paid": float(row['total_family_paid']),
+        "total_family_spent": float(row['total_family_spent']),
+        "created_at": row['created_at'].isoformat() if row['created_at'] else ""
     }
 
-def save_family_balance(parent_name, balance_data):
-    """Сохранить семейный баланс"""
+def get_family_balances(parent_names):
+    """Балансы семей одним запросом: {parent_name: баланс}
+
+    Только чтение: семьи без строки в families получают нулевой баланс,
+    строка создается при первом семейном платеже (add_family_payment).
+    """
+    parent_names = list(parent_names)
+    if not parent_names:
+        return {}
     query = """
-        UPDATE families 
-        SET family_balance = %s, total_family_paid = %s, total_family_spent = %s
-        WHERE parent_name = %s
+        SELECT parent_name, family_balance, total_family_paid, total_family_spent, created_at
+        FROM families
+        WHERE parent_name = ANY(%s)
     """
-    execute_query(query, (
-        balance_data["family_balance"],
-        balance_data["total_family_paid"], 
-        balance_data["total_family_spent"],
-        parent_name
-    ))
+    rows = execute_query(query, (parent_names,), fetch=True) or []
+    found = {row['parent_name']: row for row in rows}
+    return {parent_name: family_balance_from_row(found.get(parent_name)) for parent_name in parent_names}
 
 def add_family_payment(parent_name, amount, description="Семейное пополнение"):
     """Пополнить семейный баланс"""
     # Создаем запись о платеже
     payment_query = """
-        INSERT INTO payments (id, student_id, amount, payment_type, description, payment_date, created_at)
-        VALUES (%s, NULL, %s, %s, %s, NOW(), NOW())
+        INSERT INTO payments (student_id, amount, payment_type, description, payment_date, created_at)
+        VALUES (NULL, %s, %s, %s, NOW(), NOW())
+        RETURNING id
     """
-    payment_id = generate_slot_id()
-    execute_query(payment_query, (payment_id, amount, 'family_payment', f"СЕМЬЯ: {parent_name} - {description}"))
-    
-    # Обновляем семейный баланс
-    family_balance = get_family_balance(parent_name)
-    family_balance["family_balance"] += amount
-    family_balance["total_family_paid"] += amount
-    save_family_balance(parent_name, family_balance)
+    payment = execute_query(payment_query, (amount, 'family_payment', f"СЕМЬЯ: {parent_name} - {description}"),
+                            fetch_one=True)
+    
+    # Обновляем семейный баланс (строку семьи создаем при первом платеже)
+    balance_query = """
+        INSERT INTO families (parent_name, family_balance, total_family_paid, total_family_spent, created_at)
+        VALUES (%(parent_name)s, %(amount)s, %(amount)s, 0, NOW())
+        ON CONFLICT (parent_name) DO UPDATE SET
+            family_balance = families.family_balance + EXCLUDED.family_balance,
+            total_family_paid = families.total_family_paid + EXCLUDED.total_family_paid
+    """
+    execute_query(balance_query, {'parent_name': parent_name, 'amount': amount})
     
     return {
-        "id": payment_id,
+        "id": payment['id'] if payment else None,
         "student_name": f"СЕМЬЯ: {parent_name}",
         "amount": amount,
         "type": "family_payment",
@@ -1035,6 +932,11 @@ def get_weekday_num(day_name_ru):
     }
     return days_mapping.get(day_name_ru)
 
+def get_iso_weekday(day_name_ru):
+    """Номер дня недели по ISO (1 - понедельник, как weekday в БД) по русскому названию"""
+    weekday_num = get_weekday_num(day_name_ru)
+    return weekday_num + 1 if weekday_num is not None else None
+
 def get_weekday_ru(weekday_num):
     """Конвертация номера дня недели в русское название"""
     days = ["Понедельник", "Вторник", "Среда", "Четверг", "Пятница", "Суббота", "Воскресенье"]
@@ -1084,19 +986,21 @@ def add_payment(student_name, amount, description="Пополнение бала
             payment_date = datetime.now()
     
     # Создаем запись о платеже
+    ledger.lock_balance(student['id'])
     payment_query = """
-        INSERT INTO payments (id, student_id, amount, payment_type, description, payment_date, created_at)
-        VALUES (%s, %s, %s, %s, %s, %s, NOW())
+        INSERT INTO payments (student_id, amount, payment_type, description, payment_date, created_at)
+        VALUES (%s, %s, %s, %s, %s, NOW())
         RETURNING id
     """
-    payment_id = generate_slot_id()
     result = execute_query(payment_query, (
-        payment_id, student['id'], amount, 'payment', description, payment_date
+        student['id'], amount, 'payment', description, payment_date
     ), fetch_one=True)
     
     if result:
+        ledger.record_payment(student['id'], amount)
+        notify_change('payments', student['id'])
         return {
-            "id": payment_id,
+            "id": result['id'],
             "student_name": student_name,
             "amount": amount,
             "type": "payment",
@@ -1119,96 +1023,83 @@ def get_student_balance(student_name):
             "lessons_taken": 0
         }
     
-    # Получаем все платежи ученика
-    payments_query = """
-        SELECT SUM(CASE WHEN amount > 0 THEN amount ELSE 0 END) as total_paid,
-               SUM(CASE WHEN amount < 0 THEN ABS(amount) ELSE 0 END) as total_spent,
-               SUM(amount) as balance
-        FROM payments
-        WHERE student_id = %s
-    """
-    payments_result = execute_query(payments_query, (student['id'],), fetch_one=True)
-    
-    # Подсчитываем проведенные уроки
-    lessons_query = """
-        SELECT COUNT(*) as lessons_taken
-        FROM lessons
-        WHERE student_id = %s AND status = 'completed'
-    """
-    lessons_result = execute_query(lessons_query, (student['id'],), fetch_one=True)
+    # Сводка балансов - одна строка вместо суммы по всем платежам и урокам
+    summary = ledger.get_balance(student['id'])
     
     return {
-        "balance": float(payments_result['balance']) if payments_result['balance'] else 0,
+        "balance": float(summary['balance']),
         "lesson_price": float(student['lesson_price']) if student['lesson_price'] else 0,
-        "total_paid": float(payments_result['total_paid']) if payments_result['total_paid'] else 0,
-        "total_spent": float(payments_result['total_spent']) if payments_result['total_spent'] else 0,
-        "lessons_taken": int(lessons_result['lessons_taken']) if lessons_result['lessons_taken'] else 0
+        "total_paid": float(summary['total_paid']),
+        "total_spent": float(summary['total_spent']),
+        "lessons_taken": int(summary['lessons_taken'])
     }
 
-def get_student_payment_history(student_name, limit=None):
-    """Получить историю платежей ученика"""
+# Платежи ученика от новых к старым, продолжение - строго после ключа (payment_date, id)
+# прошлой страницы (индекс idx_payments_student_date); даты форматирует сама база
+PAYMENT_HISTORY_SQL = """
+    SELECT id, amount, payment_type as type, description,
+           to_char(payment_date, 'YYYY-MM-DD"T"HH24:MI:SS') as date,
+           to_char(payment_date, 'DD.MM.YYYY') as date_formatted,
+           to_char(payment_date, 'YYYY-MM-DD"T"HH24:MI:SS.US') || '_' || id as cursor
+    FROM payments
+    WHERE student_id = %(student_id)s
+    AND (%(before_date)s::timestamp IS NULL
+         OR (payment_date, id) < (%(before_date)s::timestamp, %(before_id)s::bigint))
+    ORDER BY payment_date DESC, id DESC
+    LIMIT %(limit)s
+"""
+
+# Вся история для выгрузки: готовый JSON каждой записи собирает база
+PAYMENT_EXPORT_SQL = """
+    SELECT json_build_object(
+               'id', id,
+               'amount', amount,
+               'type', payment_type,
+               'description', description,
+               'date', to_char(payment_date, 'YYYY-MM-DD"T"HH24:MI:SS')
+           )::text as payment
+    FROM payments
+    WHERE student_id = %s
+    ORDER BY payment_date DESC, id DESC
+"""
+
+def parse_payment_cursor(cursor):
+    """Ключ (payment_date, id) из next_cursor прошлой страницы; (None, None) - с начала"""
+    try:
+        before_date, before_id = cursor.rsplit('_', 1)
+        return datetime.fromisoformat(before_date), int(before_id)
+    except (AttributeError, ValueError):
+        return None, None
+
+def get_student_payment_history(student_name, limit=PAYMENT_HISTORY_PAGE_SIZE, cursor=None):
+    """Получить страницу истории платежей ученика (от новых к старым)
+
+    Возвращает (платежи, next_cursor); next_cursor передается в следующий вызов,
+    None - записей больше нет.
+    """
     student = get_student_by_name(student_name)
     if not student:
-        return []
-    
-    query = """
-        SELECT id, amount, payment_type as type, description, payment_date as date, created_at
-        FROM payments
-        WHERE student_id = %s
-        ORDER BY payment_date DESC
-    """
+        return [], None
     
-    if limit:
-        query += f" LIMIT {limit}"
+    before_date, before_id = parse_payment_cursor(cursor)
+    result = execute_query(PAYMENT_HISTORY_SQL, {
+        'student_id': student['id'],
+        'before_date': before_date,
+        'before_id': before_id,
+        'limit': limit + 1   # лишняя строка - признак, что есть следующая страница
+    }, fetch=True, name='payment_history_page') or []
     
-    result = execute_query(query, (student['id'],), fetch=True)
+    rows = result[:limit]
+    next_cursor = rows[-1]['cursor'] if len(result) > limit else None
     
     payments = []
-    for row in result:
+    for row in rows:
         payment = dict(row)
-        if payment['date']:
-            payment['date'] = payment['date'].isoformat()
-            payment['date_formatted'] = payment['date'][:10]  # YYYY-MM-DD
+        del payment['cursor']
+        payment['amount'] = float(payment['amount'])
         payments.append(payment)
     
-    return payments
-
-def process_lesson_payment(student_name, lesson_id):
-    """Списать средства за проведенный урок"""
-    # Проверяем, не является ли урок пробным
-    lesson = get_lesson_by_id(lesson_id)
-    if lesson and lesson.get('lesson_type') == 'trial':
-        return True, "Пробный урок завершен (бесплатно)"
-    print(f"🔄 СПИСАНИЕ: урок {lesson_id}, ученик {student_name}")
-    print(f"🔄 Данные урока: {lesson}")
-    
-    student = get_student_by_name(student_name)
-    if not student:
-        return False, "Ученик не найден в системе"
-    
-    lesson_price = float(student['lesson_price']) if student['lesson_price'] else 0
-    
-    # Создаем запись о расходе
-    expense_query = """
-        INSERT INTO payments (id, student_id, amount, payment_type, description, lesson_id, payment_date, created_at)
-        VALUES (%s, %s, %s, %s, %s, %s, NOW(), NOW())
-    """
-    expense_id = generate_slot_id()
-    result = execute_query(expense_query, (
-        expense_id, student['id'], -lesson_price, 'expense', 
-        f"Оплата урока {lesson_id}", lesson_id
-    ))
-    print(f"🔄 Запись о списании создана: result={result}, amount={-lesson_price}")
-
-    # Помечаем урок как оплаченный
-    mark_paid_query = "UPDATE lessons SET is_paid = true WHERE id = %s"
-    result2 = execute_query(mark_paid_query, (lesson_id,))
-    print(f"🔄 Урок помечен как оплаченный: result={result2}")
-
-    # Получаем текущий баланс
-    balance = get_student_balance(student_name)
-    
-    return True, f"Урок оплачен. Остаток на балансе: {balance['balance']} руб."
+    return payments, next_cursor
 
 def reset_student_balance(student_name):
     """Обнулить баланс ученика"""
@@ -1216,71 +1107,57 @@ def reset_student_balance(student_name):
     if not student:
         return False
     
-    # Удаляем все записи о платежах этого ученика
-    delete_query = "DELETE FROM payments WHERE student_id = %s"
-    execute_query(delete_query, (student['id'],))
+    # Контрольная точка с нулевым балансом: история платежей остается
+    if not ledger.reset_balance(student['id']):
+        return False
+    notify_change('payments', student['id'])
     
     return True
 
-def get_financial_overview():
-    """Получить общий финансовый обзор по всем ученикам"""
-    # Общий баланс всех студентов
+def get_student_balances():
+    """Балансы всех учеников одним запросом из сводки student_balances: {имя: баланс}"""
     query = """
         SELECT 
-            SUM(CASE WHEN amount > 0 THEN amount ELSE 0 END) as total_paid,
-            SUM(CASE WHEN amount < 0 THEN ABS(amount) ELSE 0 END) as total_spent,
-            SUM(amount) as total_balance
-        FROM payments p
-        JOIN students s ON p.student_id = s.id
-    """
-    result = execute_query(query, fetch_one=True)
-    
-    # Подсчитываем долги как отрицательные балансы учеников
-    debt_query = """
-        SELECT SUM(ABS(balance)) as total_debt
-        FROM (
-            SELECT student_id, SUM(amount) as balance
-            FROM payments p
-            JOIN students s ON p.student_id = s.id
-            GROUP BY student_id
-            HAVING SUM(amount) < 0
-        ) negative_balances
+            s.name,
+            s.lesson_price,
+            COALESCE(b.total_paid, 0) as total_paid,
+            COALESCE(b.total_spent, 0) as total_spent,
+            COALESCE(b.balance, 0) as balance,
+            COALESCE(b.lessons_taken, 0) as lessons_taken
+        FROM students s
+        LEFT JOIN student_balances b ON b.student_id = s.id
+        ORDER BY s.name
     """
-    debt_result = execute_query(debt_query, fetch_one=True)
-    
-    if not result:
-        return {
-            'total_prepaid': 0,
-            'total_debt': 0,
-            'total_balance': 0,
-            'students_with_positive_balance': 0,
-            'students_with_negative_balance': 0
+    balances = {}
+    for row in execute_query(query, fetch=True, name='student_balances') or []:
+        balances[row['name']] = {
+            'balance': float(row['balance']),
+            'lesson_price': float(row['lesson_price']) if row['lesson_price'] else 0,
+            'total_paid': float(row['total_paid']),
+            'total_spent': float(row['total_spent']),
+            'lessons_taken': row['lessons_taken']
         }
-    
-    total_balance = float(result['total_balance']) if result['total_balance'] else 0
-    total_debt = float(debt_result['total_debt']) if debt_result and debt_result['total_debt'] else 0
-    total_prepaid = total_balance if total_balance > 0 else 0
-    
-    # Подсчитываем студентов с положительным и отрицательным балансом
-    students_balances_query = """
-        SELECT 
-            COUNT(CASE WHEN balance > 0 THEN 1 END) as positive_count,
-            COUNT(CASE WHEN balance < 0 THEN 1 END) as negative_count
-        FROM (
-            SELECT student_id, SUM(amount) as balance
-            FROM payments p
-            JOIN students s ON p.student_id = s.id
-            GROUP BY student_id
-        ) balances
+    return balances
+
+def get_financial_overview(balances=None):
+    """Получить общий финансовый обзор по всем ученикам
+
+    Считается из тех же балансов учеников, что показывает страница оплаты
+    (get_student_balances), без отдельных запросов.
     """
-    balances_result = execute_query(students_balances_query, fetch_one=True)
+    if balances is None:
+        balances = get_student_balances()
+    
+    total_balance = sum(item['balance'] for item in balances.values())
+    # Долги - отрицательные балансы учеников
+    total_debt = sum(-item['balance'] for item in balances.values() if item['balance'] < 0)
     
     return {
-        'total_prepaid': total_prepaid,
+        'total_prepaid': total_balance if total_balance > 0 else 0,
         'total_debt': total_debt,
         'total_balance': total_balance,
-        'students_with_positive_balance': int(balances_result['positive_count']) if balances_result['positive_count'] else 0,
-        'students_with_negative_balance': int(balances_result['negative_count']) if balances_result['negative_count'] else 0
+        'students_with_positive_balance': sum(1 for item in balances.values() if item['balance'] > 0),
+        'students_with_negative_balance': sum(1 for item in balances.values() if item['balance'] < 0)
     }
 
 # ============================================================================
@@ -1288,50 +1165,59 @@ def get_financial_overview():
 # ============================================================================
 
 def auto_update_lesson_statuses():
-    """Автоматически обновляет статусы уроков на основе даты, времени и длительности урока"""
-    today = datetime.now()
-    
-    # Находим уроки, которые должны были закончиться
-    query = """
-        SELECT l.*, s.name as student_name
-        FROM lessons l
-        JOIN students s ON l.student_id = s.id
-        WHERE l.status = 'scheduled'
-        AND l.date IS NOT NULL
-        AND l.time IS NOT NULL
-        AND l.date + l.time + INTERVAL '1 minute' * COALESCE(l.lesson_duration, 60) < NOW()
+    """Провести прошедшие уроки и списать оплату (кроме пробных)
+
+    Возвращает количество проведенных уроков. Вызывается фоновой задачей
+    (start_settlement_scheduler), а не обработчиками страниц.
     """
+    if recurrence.materialize_due() is None:
+        raise RuntimeError("Не удалось сохранить уроки по шаблону")
+    summary = settle_overdue_lessons()
+    if summary is None:
+        raise RuntimeError("Не удалось провести уроки")
     
-    overdue_lessons = execute_query(query, fetch=True)
-    modified = False
+    for row in summary:
+        print(f"[AUTO_UPDATE] {row['student_name']}: проведено {row['lessons']} "
+              f"(пробных {row['trial_lessons']}), списано {-row['amount']} руб.")
     
-    for lesson in overdue_lessons:
-        # Обновляем статус урока (убираем автоматическую пометку как оплаченный)
-        update_query = """
-            UPDATE lessons 
-            SET status = 'completed'
-            WHERE id = %s
-        """
-        execute_query(update_query, (lesson['id'],))
+    return sum(row['lessons'] for row in summary)
 
-        # Списываем оплату
-        success, message = process_lesson_payment(lesson['student_name'], lesson['id'])
-        print(f"[AUTO_UPDATE] Урок {lesson['id']}: success={success}, message={message}")
-        if success:
-            # Помечаем урок как оплаченный только после успешного списания
-            paid_query = "UPDATE lessons SET is_paid = true WHERE id = %s"
-            execute_query(paid_query, (lesson['id'],))
-            print(f"✅ Урок {lesson['id']} помечен как оплаченный")
-        else:
-            print(f"❌ Ошибка списания для урока {lesson['id']}: {message}")
-        if success:
-            print(f"[AUTO_UPDATE] Автоматически списана оплата: {message}")
-        else:
-            print(f"[AUTO_UPDATE] Ошибка списания оплаты: {message}")
-        
-        modified = True
-    
-    return modified
+def close_previous_month():
+    """Закрыть прошлый месяц контрольными точками балансов, если он еще не закрыт
+
+    Отдельная фоновая задача со своей транзакцией: закрытие блокирует payments
+    и не должно держать ничего, что держат писатели платежей (см. ledger.close_month).
+    """
+    period = (periods.month().start - timedelta(days=1)).replace(day=1)
+    if ledger.month_closed(period):
+        return 0
+    closed = ledger.close_month(period)
+    if closed is None:
+        raise RuntimeError("Не удалось закрыть месяц")
+    print(f"📒 Закрыт месяц {period:%m.%Y}: контрольных точек {closed}")
+    return closed
+
+settlement_job = None
+month_close_job = None
+
+def start_settlement_scheduler():
+    """Запустить фоновое проведение уроков (первый запуск - сразу)"""
+    global settlement_job
+    if settlement_job is None:
+        settlement_job = PeriodicJob('settlement', auto_update_lesson_statuses,
+                                     SETTLEMENT_INTERVAL, SETTLEMENT_LOCK_KEY)
+        settlement_job.start()
+        print(f"⏱️ Проведение уроков в фоне раз в {SETTLEMENT_INTERVAL} сек")
+    return settlement_job
+
+def start_month_close_scheduler():
+    """Запустить фоновое закрытие прошлого месяца (проверка раз в MONTH_CLOSE_INTERVAL сек)"""
+    global month_close_job
+    if month_close_job is None:
+        month_close_job = PeriodicJob('month_close', close_previous_month,
+                                      MONTH_CLOSE_INTERVAL, MONTH_CLOSE_LOCK_KEY)
+        month_close_job.start()
+    return month_close_job
 
 # ============================================================================
 # ФУНКЦИИ ДЛЯ СТАТИСТИКИ
@@ -1367,9 +1253,7 @@ def get_student_widget_stats(student_name):
             'planned_this_month': 0
         }
     
-    today = datetime.now().date()
-    current_month = today.month
-    current_year = today.year
+    current_month = periods.month()
     
     # Статистика за все время
     all_time_query = """
@@ -1382,16 +1266,21 @@ def get_student_widget_stats(student_name):
     all_time_result = execute_query(all_time_query, (student['id'],), fetch_one=True)
     
     # Запланированные уроки в текущем месяце
-    month_query = """
-        SELECT COUNT(*) as planned_this_month
-        FROM lessons
-        WHERE student_id = %s
-        AND status = 'scheduled'
-        AND from_template = true
-        AND EXTRACT(MONTH FROM date) = %s
-        AND EXTRACT(YEAR FROM date) = %s
+    month_query = f"""
+        SELECT (
+            SELECT COUNT(*)
+            FROM lessons
+            WHERE student_id = %(student_id)s
+            AND status = 'scheduled'
+            AND from_template = true
+            AND date >= %(start)s AND date < %(end)s
+        ) + (
+            SELECT COUNT(*) FROM ({recurrence.OCCURRENCES_SQL}) o
+        ) as planned_this_month
     """
-    month_result = execute_query(month_query, (student['id'], current_month, current_year), fetch_one=True)
+    month_params = dict(current_month.params(), student_id=student['id'],
+                        **recurrence.occurrence_params(*current_month, student_ids=[student['id']]))
+    month_result = execute_query(month_query, month_params, fetch_one=True)
     
     return {
         'completed_lessons': int(all_time_result['completed_lessons']) if all_time_result['completed_lessons'] else 0,
@@ -1460,10 +1349,10 @@ def get_month_calendar(year, month):
 
 def get_lessons_for_date(date_str, slots=None):
     """Получить все занятия для конкретной даты"""
+    date_obj = datetime.strptime(date_str, '%Y-%m-%d')
     if slots is None:
-        slots = load_slots()
+        slots = load_lessons_between(date_obj.date(), date_obj.date() + timedelta(days=1))
     
-    date_obj = datetime.strptime(date_str, '%Y-%m-%d')
     weekday_ru = get_weekday_ru(date_obj.weekday())
     
     lessons = []
@@ -1488,6 +1377,9 @@ def clear_all_lessons():
     """Очистить все занятия"""
     try:
         execute_query("DELETE FROM lessons")
+        recurrence.restart_rules()
+        ledger.reset_lessons()
+        notify_change('lessons')
         return True, "Все занятия удалены"
     except Exception as e:
         return False, f"Ошибка при очистке: {e}"
@@ -1499,18 +1391,9 @@ def clear_all_lessons():
 def load_available_slots():
     """Загрузить доступные слоты"""
     query = """
-        SELECT id, day_of_week as day, time, duration, slot_type as type, created_at
+        SELECT id, weekday, time, duration, slot_type as type, created_at
         FROM available_slots
-        ORDER BY 
-            CASE day_of_week
-                WHEN 'Понедельник' THEN 1
-                WHEN 'Вторник' THEN 2
-                WHEN 'Среда' THEN 3
-                WHEN 'Четверг' THEN 4
-                WHEN 'Пятница' THEN 5
-                WHEN 'Суббота' THEN 6
-                WHEN 'Воскресенье' THEN 7
-            END, time
+        ORDER BY weekday, time
     """
     result = execute_query(query, fetch=True)
     
@@ -1518,7 +1401,7 @@ def load_available_slots():
     for row in result:
         slot = {
             'id': row['id'],
-            'day': row['day'],
+            'day': get_weekday_ru(row['weekday'] - 1) if row['weekday'] else None,
             'time': str(row['time']),
             'duration': row['duration'],
             'type': row['type']
@@ -1534,48 +1417,24 @@ def load_available_slots():
 def create_available_slot(slot_data):
     """Создать новый доступный слот"""
     query = """
-        INSERT INTO available_slots (id, day_of_week, time, duration, slot_type, created_at)
-        VALUES (%s, %s, %s, %s, %s, NOW())
+        INSERT INTO available_slots (weekday, time, duration, slot_type, created_at)
+        VALUES (%s, %s, %s, %s, NOW())
+        RETURNING id
     """
     
-    slot_id = slot_data.get('id', generate_slot_id())
-    execute_query(query, (
-        slot_id,
-        slot_data.get('day'),
+    result = execute_query(query, (
+        get_iso_weekday(slot_data.get('day')),
         slot_data.get('time'),
         slot_data.get('duration', 60),
         slot_data.get('type', 'permanent')
-    ))
-    
-    return slot_id
-
-def delete_available_slot(slot_index):
-    """Удалить доступный слот по индексу"""
-    # Получаем ID слота по порядковому номеру
-    query_get_id = """
-        SELECT id FROM available_slots 
-        ORDER BY 
-            CASE day_of_week
-                WHEN 'Понедельник' THEN 1
-                WHEN 'Вторник' THEN 2
-                WHEN 'Среда' THEN 3
-                WHEN 'Четверг' THEN 4
-                WHEN 'Пятница' THEN 5
-                WHEN 'Суббота' THEN 6
-                WHEN 'Воскресенье' THEN 7
-            END, time
-        LIMIT 1 OFFSET %s
-    """
-    result = execute_query(query_get_id, (slot_index,), fetch_one=True)
-    if not result:
-        return False
-        
-    slot_id = result['id']
+    ), fetch_one=True)
     
-    # Удаляем слот
-    delete_query = "DELETE FROM available_slots WHERE id = %s"
-    execute_query(delete_query, (slot_id,))
-    return True
+    return result['id'] if result else None
+
+def delete_available_slot(slot_id):
+    """Удалить доступный слот по ID; False - слота нет"""
+    query = "DELETE FROM available_slots WHERE id = %s"
+    return bool(execute_query(query, (slot_id,)))
 
 # ============================================================================
 # ИНИЦИАЛИЗАЦИЯ ПРИЛОЖЕНИЯ
@@ -1585,9 +1444,15 @@ def initialize_app():
     """Инициализация приложения при запуске"""
     print("Инициализация Календаши...")
     
-    # Автоматически обновляем статусы уроков и списываем оплату
-    print("Проверяем статусы уроков...")
-    auto_update_lesson_statuses()
+    # Схема БД: новые миграции (сводка балансов, уникальность списаний и т.д.)
+    migrate()
+    
+    # Статусы уроков и списание оплаты - в фоновом потоке
+    start_settlement_scheduler()
+    start_month_close_scheduler()
+    
+    # Состав семей держим в памяти, пока слышим события об изменении учеников
+    start_family_roster()
     
     print("Календаша готова к работе!")
 
@@ -1597,37 +1462,38 @@ def initialize_app():
 
 def get_predicted_income_current_month():
     """Получить прогнозируемый доход за текущий месяц (БЫСТРО)"""
-    today = datetime.now()
-    year, month = today.year, today.month
-    
-    query = """
+    month = periods.month()
+    query = f"""
         SELECT SUM(s.lesson_price) as predicted_income
-        FROM lessons l
+        FROM (
+            SELECT l.student_id
+            FROM lessons l
+            WHERE l.lesson_type = 'regular'
+            AND l.from_template = true
+            AND l.status IN ('scheduled', 'completed')
+            AND l.date >= %(start)s AND l.date < %(end)s
+            UNION ALL
+            SELECT o.student_id
+            FROM ({recurrence.OCCURRENCES_SQL}) o
+            WHERE o.lesson_type = 'regular'
+        ) l
         JOIN students s ON l.student_id = s.id
-        WHERE l.lesson_type = 'regular'
-        AND l.from_template = true
-        AND l.status IN ('scheduled', 'completed')
-        AND EXTRACT(MONTH FROM l.date) = %s
-        AND EXTRACT(YEAR FROM l.date) = %s
     """
-    result = execute_query(query, (month, year), fetch_one=True)
+    params = dict(month.params(), **recurrence.occurrence_params(*month))
+    result = execute_query(query, params, fetch_one=True)
     
     return float(result['predicted_income']) if result and result['predicted_income'] else 0
 
 def get_actual_income_current_month():
     """Получить фактический доход за текущий месяц (БЫСТРО)"""
-    today = datetime.now()
-    year, month = today.year, today.month
-    
     query = """
         SELECT SUM(ABS(amount)) as actual_income
         FROM payments
         WHERE amount < 0
         AND payment_type = 'expense'
-        AND EXTRACT(MONTH FROM payment_date) = %s
-        AND EXTRACT(YEAR FROM payment_date) = %s
+        AND payment_date >= %(start)s AND payment_date < %(end)s
     """
-    result = execute_query(query, (month, year), fetch_one=True)
+    result = execute_query(query, periods.month().params(), fetch_one=True)
     
     return float(result['actual_income']) if result and result['actual_income'] else 0
 
@@ -1635,14 +1501,20 @@ def get_month_student_detailed_stats(year, month):
     """Получить детальную статистику по каждому ученику за месяц (БЫСТРО)"""
     print(f"🔍 Считаем статистику для {month}/{year}")
     
-    query = """
+    # Уроки по правилам шаблона, еще не сохраненные в lessons, - тоже регулярные
+    query = f"""
+        WITH occurrences AS (
+            SELECT student_id, COUNT(*) as planned
+            FROM ({recurrence.OCCURRENCES_SQL}) o
+            GROUP BY student_id
+        )
         SELECT 
             s.name,
             COUNT(CASE 
                 WHEN l.from_template = true 
                 AND l.status IN ('scheduled', 'completed', 'cancelled') 
                 THEN 1 
-            END) as regular_planned,
+            END) + COALESCE(MAX(occurrences.planned), 0) as regular_planned,
             COUNT(CASE WHEN l.status = 'completed' THEN 1 END) as total_completed,
             COUNT(CASE 
                 WHEN l.status = 'cancelled' 
@@ -1651,12 +1523,13 @@ def get_month_student_detailed_stats(year, month):
             END) as regular_cancelled
         FROM students s
         LEFT JOIN lessons l ON s.id = l.student_id 
-            AND EXTRACT(MONTH FROM l.date) = %s
-            AND EXTRACT(YEAR FROM l.date) = %s
+            AND l.date >= %(start)s AND l.date < %(end)s
+        LEFT JOIN occurrences ON occurrences.student_id = s.id
         GROUP BY s.id, s.name
         ORDER BY s.name
     """
-    result = execute_query(query, (month, year), fetch=True)
+    period = periods.month(year, month)
+    result = execute_query(query, dict(period.params(), **recurrence.occurrence_params(*period)), fetch=True)
     
     student_stats = {}
     for row in result:
@@ -1677,11 +1550,6 @@ def get_student_by_id(student_id):
     result = execute_query(query, (student_id,), fetch_one=True)
     return dict(result) if result else None
 
-def get_student_balance(student_id):
-    """Получить баланс ученика"""
-    # Временная заглушка - позже подключим к системе оплат
-    return {'balance': 0}
-
 def get_student_lessons_count(student_id):
     """Получить количество уроков ученика"""
     query = """
@@ -1886,7 +1754,7 @@ def add_lesson_report():
         return redirect("http://127.0.0.1:8080/admin-auth")
     """Добавить отчет по уроку"""
     try:
-        lesson_id = request.form.get('lesson_id')
+        lesson_id = recurrence.resolve_lesson_id(request.form.get('lesson_id'))
         topic = request.form.get('topic')
         understanding_level = request.form.get('understanding_level')
         teacher_comment = request.form.get('teacher_comment')
@@ -1912,6 +1780,7 @@ def add_lesson_report():
             VALUES (%s, %s, %s, %s, %s, %s)
         """
         execute_query(report_query, (lesson_id, student['id'], topic, understanding_level, teacher_comment, homework_assigned))
+        notify_change('lesson_reports', student['id'])
         
         # Если есть баллы за пробник - сохраняем их
         if exam_score and exam_score.strip():
@@ -1921,6 +1790,7 @@ def add_lesson_report():
             """
             lesson_date = datetime.strptime(lesson['date'], '%Y-%m-%d').date()
             execute_query(exam_query, (student['id'], lesson_date, int(exam_score)))
+            notify_change('exam_results', student['id'])
         
         return f"<script>alert('Отчет успешно сохранен!'); window.location.href='/';</script>"
         
@@ -2030,18 +1900,15 @@ def add_student():
     
     return render_template("add_student.html")
 
-@app.route("/ученики/редактировать/<int:index>", methods=["GET", "POST"])
-def edit_student(index):
+@app.route("/ученики/редактировать/<int:student_id>", methods=["GET", "POST"])
+def edit_student(student_id):
     if not session.get('admin_logged_in'):
         return redirect("http://127.0.0.1:8080/admin-auth")
     
-    students = load_students()
-    
-    if index < 0 or index >= len(students):
+    student = load_student(student_id)
+    if not student:
         return redirect(url_for("ucheniki"))
     
-    student = students[index]
-    
     if request.method == "POST":
         # Обработка кастомного класса
         class_value = request.form.get("class", "").strip()
@@ -2057,12 +1924,9 @@ def edit_student(index):
         except (ValueError, TypeError):
             lesson_price = student.get('lesson_price', 0)
         
-        old_name = student["name"]
-        new_name = request.form.get("name", "").strip()
-        
-        # Обновляем данные ученика
+        # Обновляем данные ученика (уроки ссылаются на student_id, их трогать не нужно)
         student_data = {
-            "name": new_name,
+            "name": request.form.get("name", "").strip(),
             "class": class_value,
             "city": request.form.get("city", "").strip(),
             "timezone": request.form.get("timezone", "МСК"),
@@ -2074,25 +1938,16 @@ def edit_student(index):
         
         update_student(student['id'], student_data)
         
-        # Если имя изменилось, обновляем все связанные данные
-        if old_name != new_name:
-            # Обновляем уроки
-            update_query = "UPDATE lessons SET student_id = %s WHERE student_id = %s"
-            execute_query(update_query, (student['id'], student['id']))
-        
         return redirect(url_for("ucheniki"))
     
-    return render_template("edit_student.html", student=student, index=index)
+    return render_template("edit_student.html", student=student)
 
-@app.route("/ученики/удалить/<int:index>", methods=["POST"])
-def delete_student(index):
+@app.route("/ученики/удалить/<int:student_id>", methods=["POST"])
+def delete_student(student_id):
     if not session.get('admin_logged_in'):
         return redirect("http://127.0.0.1:8080/admin-auth")
     
-    students = load_students()
-    if 0 <= index < len(students):
-        student = students[index]
-        delete_student_completely(student['id'])
+    delete_student_completely(student_id)
     return redirect(url_for("ucheniki"))
 
 @app.route("/расписание")
@@ -2102,9 +1957,6 @@ def raspisanie(view_type=None, year=None, period=None):
     if not session.get('admin_logged_in'):
         return redirect("http://127.0.0.1:8080/admin-auth")
     
-    # Автоматически обновляем статусы уроков
-    auto_update_lesson_statuses()
-    
     today = datetime.now()
     
     # Если view_type не указан, используем текущую неделю по умолчанию
@@ -2126,12 +1978,11 @@ def raspisanie(view_type=None, year=None, period=None):
         
         # Получаем данные недели
         week_dates = get_week_dates(year, period)
-        slots = load_slots()
+        schedule = ScheduleIndex(load_week_lessons(week_dates))
         
         # Добавляем занятия к каждому дню
         for date_info in week_dates:
-            date_lessons = get_lessons_for_date(date_info['full_date'], slots)
-            date_info['lessons'] = date_lessons
+            date_info['lessons'] = schedule.lessons_for(date_info['full_date'])
         
         # Правильные русские названия месяцев для недели - используем ISO недели
         week_dates_for_header = get_week_dates(year, period)
@@ -2178,14 +2029,13 @@ def raspisanie(view_type=None, year=None, period=None):
         
         # Получаем календарь месяца
         month_calendar = get_month_calendar(year, period)
-        slots = load_slots()
+        schedule = ScheduleIndex(load_lessons_between(*periods.month(year, period)))
         
         # Добавляем занятия к каждому дню
         for week in month_calendar:
             for day in week:
                 if day:
-                    date_lessons = get_lessons_for_date(day['date'], slots)
-                    day['lessons'] = date_lessons
+                    day['lessons'] = schedule.lessons_for(day['date'])
         
         # Название месяца
         month_names = {
@@ -2239,6 +2089,10 @@ def clear_schedule():
         execute_query("DELETE FROM lesson_templates")
         print("✅ Удален шаблон недели")
         
+        ledger.reset_payments()
+        ledger.reset_lessons()
+        notify_changes(['lesson_reports', 'homework_assignments', 'exam_results', 'payments', 'lessons'])
+        
         print("🎉 ПОЛНАЯ ОЧИСТКА ЗАВЕРШЕНА!")
         
         return f"<script>alert('✅ ВСЁ ОЧИЩЕНО!\\n\\n🗑️ Удалены:\\n• Все уроки\\n• Все платежи\\n• Все отчеты\\n• Все домашки\\n• Шаблон недели\\n\\nМожешь начинать заново!'); window.location.href='/расписание';</script>"
@@ -2271,7 +2125,6 @@ def add_slot():
             lesson_duration = 60
 
         lesson_data = {
-            "id": generate_slot_id(),
             "date": request.form.get("specific_date"),
             "time": request.form.get("time"),
             "student": request.form.get("student_name"),
@@ -2296,10 +2149,10 @@ def shablon_nedeli():
     
     if request.method == "POST":
         # Проверяем, какое действие выполняется
-        if 'edit_index' in request.form:
+        if 'edit_template_id' in request.form:
             # Редактирование существующего урока
             try:
-                edit_index = int(request.form.get('edit_index'))
+                edit_template_id = int(request.form.get('edit_template_id'))
                 
                 # Получаем длительность урока для редактирования
                 edit_lesson_duration = request.form.get("edit_lesson_duration", "60")
@@ -2322,7 +2175,7 @@ def shablon_nedeli():
                     "lesson_type": request.form.get("edit_lesson_type", "regular"),
                     "lesson_duration": edit_lesson_duration
                 }
-                update_template_lesson(edit_index, lesson_data)
+                update_template_lesson(edit_template_id, lesson_data)
             except (ValueError, IndexError):
                 pass
         else:
@@ -2360,33 +2213,31 @@ def shablon_nedeli():
     
     return render_template("shablon_nedeli.html", students=students, template=template)
 
-@app.route("/шаблон-недели/удалить/<int:index>", methods=["POST"])
-def delete_template_lesson_route(index):
+@app.route("/шаблон-недели/удалить/<int:template_id>", methods=["POST"])
+def delete_template_lesson_route(template_id):
     if not session.get('admin_logged_in'):
         return redirect("http://127.0.0.1:8080/admin-auth")
     """Удаление урока из шаблона недели"""
-    print(f" Удаляем урок из шаблона с индексом: {index}")
-    success = delete_template_lesson(index)
+    print(f" Удаляем урок из шаблона с ID: {template_id}")
+    success = delete_template_lesson(template_id)
     
     if success:
-        print(f"✅ Урок {index} успешно удален из шаблона")
+        print(f"✅ Урок {template_id} успешно удален из шаблона")
     else:
-        print(f"❌ Ошибка удаления урока {index} из шаблона")
+        print(f"❌ Ошибка удаления урока {template_id} из шаблона")
     
     return redirect(url_for("shablon_nedeli"))
 
-@app.route("/шаблон-недели/урок/<int:index>/редактировать", methods=["GET", "POST"])
-def edit_template_lesson_page(index):
+@app.route("/шаблон-недели/урок/<int:template_id>/редактировать", methods=["GET", "POST"])
+def edit_template_lesson_page(template_id):
     if not session.get('admin_logged_in'):
         return redirect("http://127.0.0.1:8080/admin-auth")
     """Редактирование урока в шаблоне недели на отдельной странице"""
-    template = load_template_week()
-    students = load_students()
-    
-    if index < 0 or index >= len(template):
+    lesson = load_template_lesson(template_id)
+    if not lesson:
         return "Урок не найден", 404
     
-    lesson = template[index]
+    students = load_students()
     
     if request.method == "POST":
         # Обработка кастомного предмета
@@ -2416,13 +2267,13 @@ def edit_template_lesson_page(index):
             "lesson_duration": lesson_duration
         }
         
-        success = update_template_lesson(index, lesson_data)
+        success = update_template_lesson(template_id, lesson_data)
         if success:
             return f"<script>alert('Урок в шаблоне обновлен!'); window.location.href='/шаблон-недели';</script>"
         else:
             return "Ошибка обновления урока", 500
     
-    return render_template("edit_template_lesson.html", lesson=lesson, students=students, index=index)
+    return render_template("edit_template_lesson.html", lesson=lesson, students=students)
 
 @app.route("/применить-шаблон", methods=["POST"])
 def apply_template_week():
@@ -2430,27 +2281,60 @@ def apply_template_week():
         return redirect("http://127.0.0.1:8080/admin-auth")
     """Применить шаблон недели к основному расписанию с учетом периодов"""
     try:
-        added_count = apply_template_to_schedule_with_periods()
+        result = apply_template_to_schedule_with_periods()
         
-        if added_count > 0:
-            message = f'Добавлено {added_count} занятий с учетом указанных периодов!'
+        if result['added'] > 0:
+            message = f"Добавлено {result['added']} занятий с учетом указанных периодов!"
         else:
             message = 'Новые занятия не добавлены (возможно, все уроки уже существуют)'
+        message += f" Уже были в расписании: {result['skipped']}, вне периодов шаблона: {result['clipped']}."
         
         return f"<script>alert('{message}'); window.location.href='/шаблон-недели';</script>"
         
     except Exception as e:
         return f"<script>alert('Ошибка применения шаблона: {e}'); window.location.href='/шаблон-недели';</script>"
 
+@app.route("/api/template-preview")
+def template_apply_preview():
+    """Предпросмотр "Применить шаблон": какие уроки будут созданы, какие даты заняты переносами"""
+    if not session.get('admin_logged_in'):
+        return jsonify({"success": False, "error": "Не авторизован"}), 401
+    preview = template_preview.preview_apply()
+    if preview is None:
+        return jsonify({"success": False, "error": "Не удалось построить предпросмотр"}), 500
+    return jsonify(dict(preview, success=True))
+
+@app.route("/api/template-preview/<int:template_id>", methods=["POST"])
+def template_edit_preview(template_id):
+    """Предпросмотр изменения урока в шаблоне (поля как в форме редактирования)"""
+    if not session.get('admin_logged_in'):
+        return jsonify({"success": False, "error": "Не авторизован"}), 401
+    if not get_template(template_id):
+        return jsonify({"success": False, "error": "Урок не найден"}), 404
+    student = get_student_by_name(request.form.get("student"))
+    if not student:
+        return jsonify({"success": False, "error": "Ученик не найден"}), 400
+    
+    lesson_data = {
+        "day": request.form.get("day"),
+        "time": request.form.get("time"),
+        "start_date": request.form.get("start_date", ""),
+        "end_date": request.form.get("end_date", "")
+    }
+    try:
+        preview = template_preview.preview_edit(template_id, lesson_data, student)
+    except ValueError as e:
+        return jsonify({"success": False, "error": f"Неверные данные: {e}"}), 400
+    if preview is None:
+        return jsonify({"success": False, "error": "Не удалось построить предпросмотр"}), 500
+    return jsonify(dict(preview, success=True))
+
 @app.route("/оплата")
 @app.route("/оплата/<int:year>/<int:month>")
 def oplata(year=None, month=None):
     if not session.get('admin_logged_in'):
         return redirect("http://127.0.0.1:8080/admin-auth")
     
-    # Убираем медленную функцию!
-    auto_update_lesson_statuses()
-
     # Устанавливаем текущий месяц
     if year is None or month is None:
         today = datetime.now()
@@ -2470,46 +2354,10 @@ def oplata(year=None, month=None):
     # Загружаем только основные данные
     students = load_students()
     
-    # ОПТИМИЗИРОВАННАЯ ВЕРСИЯ - получаем все балансы одним запросом
-    balances = {}
-    balances_query = """
-        SELECT 
-            s.name,
-            s.lesson_price,
-            COALESCE(SUM(CASE WHEN p.amount > 0 THEN p.amount ELSE 0 END), 0) as total_paid,
-            COALESCE(SUM(CASE WHEN p.amount < 0 THEN ABS(p.amount) ELSE 0 END), 0) as total_spent,
-            COALESCE(SUM(p.amount), 0) as balance
-        FROM students s
-        LEFT JOIN payments p ON s.id = p.student_id
-        GROUP BY s.id, s.name, s.lesson_price
-        ORDER BY s.name
-    """
-
-    balances_result = execute_query(balances_query, fetch=True)
-
-    # Отдельно считаем завершенные уроки
-    lessons_count_query = """
-        SELECT s.name, COUNT(l.id) as lessons_taken
-        FROM students s
-        LEFT JOIN lessons l ON s.id = l.student_id AND l.status = 'completed'
-        GROUP BY s.id, s.name
-    """
-    lessons_counts = execute_query(lessons_count_query, fetch=True)
-
-    # Создаем словарь с количеством уроков
-    lessons_dict = {row['name']: row['lessons_taken'] for row in lessons_counts}
-
-    for row in balances_result:
-        balances[row['name']] = {
-            'balance': float(row['balance']),
-            'lesson_price': float(row['lesson_price']) if row['lesson_price'] else 0,
-            'total_paid': float(row['total_paid']),
-            'total_spent': float(row['total_spent']),
-            'lessons_taken': lessons_dict.get(row['name'], 0)  # Берем из отдельного запроса
-        }
-    
-    # Настоящий финансовый обзор
-    financial_overview = get_financial_overview()
+    # Все балансы одним запросом - из сводки student_balances, без суммирования платежей;
+    # финансовый обзор считается из них же
+    balances = get_student_balances()
+    financial_overview = get_financial_overview(balances)
     
     # Название месяца
     month_names = {
@@ -2521,10 +2369,11 @@ def oplata(year=None, month=None):
     
     # Получаем семейные данные
     families = get_families()
+    family_balances = get_family_balances(families)
     families_data = {}
 
     for parent_name, children in families.items():
-        family_balance = get_family_balance(parent_name)
+        family_balance = family_balances[parent_name]
         
         families_data[parent_name] = {
             'children': children,
@@ -2588,30 +2437,49 @@ def payment_history_page(student_name=None):
         # Показываем выбор ученика
         return render_template("payment_history.html", students=students)
     
-    # Показываем историю конкретного ученика
-    payments = get_student_payment_history(student_name)
+    # Показываем историю конкретного ученика: первую страницу, остальное - по "Показать еще"
+    payments, next_cursor = get_student_payment_history(student_name)
     balance = get_student_balance(student_name)
     
-    # Форматируем даты для отображения
-    for payment in payments:
-        try:
-            if payment['date']:
-                date_obj = datetime.fromisoformat(payment['date'])
-                payment['date_formatted'] = date_obj.strftime('%d.%m.%Y')
-            else:
-                payment['date_formatted'] = payment['date']
-        except:
-            payment['date_formatted'] = payment['date']
-    
     return render_template("payment_history.html", 
                          students=students,
                          student_name=student_name,
                          payments=payments,
+                         next_cursor=next_cursor,
                          total_paid=balance.get('total_paid', 0),
                          total_spent=balance.get('total_spent', 0),
                          current_balance=balance.get('balance', 0),
                          lessons_taken=balance.get('lessons_taken', 0))
 
+@app.route("/api/payment-history/<student_name>")
+def payment_history_more(student_name):
+    """Следующая страница истории платежей (?cursor=next_cursor прошлой страницы)"""
+    if not session.get('admin_logged_in'):
+        return jsonify({"success": False, "error": "Не авторизован"}), 401
+    payments, next_cursor = get_student_payment_history(student_name, cursor=request.args.get("cursor"))
+    return jsonify({"success": True, "payments": payments, "next_cursor": next_cursor})
+
+@app.route("/api/payment-history/<student_name>/export")
+def payment_history_export(student_name):
+    """Вся история платежей ученика в JSON - отдается потоком, частями с серверного курсора"""
+    if not session.get('admin_logged_in'):
+        return jsonify({"success": False, "error": "Не авторизован"}), 401
+    student = get_student_by_name(student_name)
+    if not student:
+        return jsonify({"success": False, "error": "Ученик не найден"}), 404
+    
+    # Ошибка базы посреди выгрузки обрывает ответ (stream_query ее пробрасывает):
+    # закрывающей ] не будет, и неполный файл не сойдет за всю историю
+    def generate():
+        yield '['
+        for i, row in enumerate(stream_query(PAYMENT_EXPORT_SQL, (student['id'],), name='payment_history_export')):
+            yield (',\n' if i else '\n') + row['payment']
+        yield '\n]\n'
+    
+    return Response(generate(), mimetype='application/json', headers={
+        'Content-Disposition': f'attachment; filename="payments_{student["id"]}.json"'
+    })
+
 @app.route("/обнулить-баланс/<student_name>", methods=["POST"])
 def reset_balance_route(student_name):
     if not session.get('admin_logged_in'):
@@ -2697,34 +2565,23 @@ def delete_slot(slot_id):
     delete_available_slot(slot_id)
     return redirect(url_for("setup_slots"))
 
-@app.route("/api/delete-slot/<slot_id>", methods=["POST"])
+@app.route("/api/delete-slot/<int:slot_id>", methods=["POST"])
 def delete_slot_by_id(slot_id):
     """Удаление слота по ID через API"""
     print(f"Удаляем слот с ID: {slot_id}")
     
-    # Находим индекс слота в списке
-    slots = load_available_slots()
-    slot_index = None
-    
-    for i, slot in enumerate(slots):
-        if slot.get('id') == slot_id:
-            slot_index = i
-            break
-    
-    if slot_index is not None:
-        success = delete_available_slot(slot_index)
-        if success:
-            return {"success": True, "message": "Слот удален"}
-        else:
-            return {"success": False, "message": "Ошибка удаления"}, 500
-    else:
-        return {"success": False, "message": "Слот не найден"}, 404
+    if delete_available_slot(slot_id):
+        return {"success": True, "message": "Слот удален"}
+    return {"success": False, "message": "Слот не найден"}, 404
 
 @app.route("/schedule/lesson/<lesson_id>/edit", methods=["GET", "POST"])
 def edit_lesson_from_schedule(lesson_id):
     if not session.get('admin_logged_in'):
         return redirect("http://127.0.0.1:8080/admin-auth")
     students = load_students()
+    if request.method == "POST":
+        # Урок по правилу шаблона сохраняется в lessons при первом изменении
+        lesson_id = recurrence.resolve_lesson_id(lesson_id)
     lesson = get_lesson_by_id(lesson_id)
     
     if not lesson:
@@ -2747,15 +2604,17 @@ def edit_lesson_from_schedule(lesson_id):
                     
                     # Создаем возвратный платеж
                     if lesson_price > 0:
+                        ledger.lock_balance(student['id'])
                         refund_query = """
-                            INSERT INTO payments (id, student_id, amount, payment_type, description, lesson_id, payment_date, created_at)
-                            VALUES (%s, %s, %s, %s, %s, %s, NOW(), NOW())
+                            INSERT INTO payments (student_id, amount, payment_type, description, lesson_id, payment_date, created_at)
+                            VALUES (%s, %s, %s, %s, %s, NOW(), NOW())
                         """
-                        refund_id = generate_slot_id()
                         execute_query(refund_query, (
-                            refund_id, student['id'], lesson_price, 'refund', 
+                            student['id'], lesson_price, 'refund', 
                             f"Возврат за отмененный урок {lesson_id}", lesson_id
                         ))
+                        ledger.record_payment(student['id'], lesson_price)
+                        notify_change('payments', student['id'])
                         print(f"✅ Возвращено {lesson_price} руб. за отмененный урок {lesson_id}")
                     
                     # Убираем отметку об оплате
@@ -2870,7 +2729,6 @@ def add_trial_lesson_route():
         
         # Создаем пробный урок
         lesson_data = {
-            "id": generate_slot_id(),
             "date": date,
             "time": time,
             "student": student_name,
@@ -2908,28 +2766,26 @@ def get_template_week_api():
 @app.route("/api/week-schedule/<int:year>/<int:week>")
 def get_week_schedule_api(year, week):
     """API для получения расписания конкретной недели"""
-    slots = load_slots()
-    
     # Получаем даты недели
     week_dates = get_week_dates(year, week)
+    return jsonify(build_week_schedule(week_dates, ScheduleIndex(load_week_lessons(week_dates))))
+
+def build_week_schedule(week_dates, schedule):
+    """Плоский список уроков недели по дням (для API и страницы скриншота)"""
     week_schedule = []
-    
-    # Фильтруем уроки по датам недели
     for date_info in week_dates:
         date_str = date_info['full_date']
-        day_lessons = get_lessons_for_date(date_str, slots)
-        
-        for lesson in day_lessons:
+        for lesson in schedule.lessons_for(date_str):
             week_schedule.append({
                 'date': date_str,
+                'day': date_info['day_name'],
                 'time': lesson['time'],
                 'student': lesson['student'],
                 'subject': lesson['subject'],
                 'status': lesson.get('status', 'scheduled'),
                 'lesson_type': lesson.get('lesson_type', 'regular')
             })
-    
-    return jsonify(week_schedule)
+    return week_schedule
 
 @app.route("/restore-lesson/<lesson_id>", methods=["POST"])
 def restore_lesson(lesson_id):
@@ -2948,9 +2804,10 @@ def restore_lesson(lesson_id):
     
     # Восстанавливаем урок
     restore_query = "UPDATE lessons SET status = 'scheduled' WHERE id = %s"
-    result = execute_query(restore_query, (lesson_id,))
+    result = execute_query(restore_query, (lesson['id'],))
     
     if result is not None:
+        notify_change('lessons', lesson.get('student_id'))
         print(f"✅ Урок {lesson_id} восстановлен")
         return jsonify({"success": True, "message": "Урок восстановлен"})
     else:
@@ -3121,7 +2978,7 @@ def save_report():
     
     try:
         data = request.get_json()
-        lesson_id = data.get('lesson_id')
+        lesson_id = recurrence.resolve_lesson_id(data.get('lesson_id'))
         topic = data.get('topic', '').strip()
         understanding_level = data.get('understanding_level', '').strip()
         teacher_comment = data.get('teacher_comment', '').strip()
@@ -3182,6 +3039,7 @@ def save_report():
                 RETURNING id
             """
             result = execute_query(report_query, (lesson_id, student['id'], topic, understanding_level, teacher_comment, report_date), fetch_one=True)
+        notify_change('lesson_reports', student['id'])
         
         # Если есть баллы за экзамен - используем ДАТУ УРОКА
         if secondary_score is not None:
@@ -3190,6 +3048,7 @@ def save_report():
                 VALUES (%s, %s, %s, %s, %s)
             """
             execute_query(exam_query, (student['id'], report_date, primary_score, secondary_score, report_date))
+            notify_change('exam_results', student['id'])
         
         return jsonify({"success": True, "message": "Отчет успешно сохранен"})
         
@@ -3207,10 +3066,15 @@ def delete_report():
         if not lesson_id:
             return jsonify({'success': False, 'error': 'Не указан ID урока'})
         
+        # id из запроса: BIGINT или старый 8-символьный id (урока по правилу у отчетов нет)
+        lesson_id = find_lesson_id(lesson_id)
+        if lesson_id is None:
+            return jsonify({'success': False, 'error': 'Отчет не найден'})
+        
         print(f"🗑️ Удаляем отчет для урока {lesson_id}")
         
         # Проверяем существует ли отчет
-        check_query = "SELECT id FROM lesson_reports WHERE lesson_id = %s"
+        check_query = "SELECT id, student_id FROM lesson_reports WHERE lesson_id = %s"
         existing_report = execute_query(check_query, (lesson_id,), fetch_one=True)
         
         if not existing_report:
@@ -3221,6 +3085,7 @@ def delete_report():
         result = execute_query(delete_query, (lesson_id,))
         
         if result is not None:
+            notify_change('lesson_reports', existing_report['student_id'])
             print(f"✅ Отчет для урока {lesson_id} успешно удален")
             return jsonify({'success': True, 'message': 'Отчет удален'})
         else:
@@ -3240,6 +3105,11 @@ def mark_homework_checked():
         if not lesson_id:
             return jsonify({'success': False, 'error': 'Не указан ID урока'})
         
+        # id из запроса: BIGINT или старый 8-символьный id (урока по правилу у отчетов нет)
+        lesson_id = find_lesson_id(lesson_id)
+        if lesson_id is None:
+            return jsonify({'success': False, 'error': 'Домашнее задание не найдено'})
+        
         print(f"✅ Отмечаем домашку как проверенную для урока {lesson_id}")
         
         # Проверяем существует ли домашка
@@ -3277,10 +3147,15 @@ def delete_homework():
         if not lesson_id:
             return jsonify({'success': False, 'error': 'Не указан ID урока'})
         
+        # id из запроса: BIGINT или старый 8-символьный id (урока по правилу у отчетов нет)
+        lesson_id = find_lesson_id(lesson_id)
+        if lesson_id is None:
+            return jsonify({'success': False, 'error': 'Домашнее задание не найдено'})
+        
         print(f"🗑️ Удаляем домашку для урока {lesson_id}")
         
         # Проверяем существует ли домашка
-        check_query = "SELECT id FROM homework_assignments WHERE lesson_id = %s"
+        check_query = "SELECT id, student_id FROM homework_assignments WHERE lesson_id = %s"
         existing_homework = execute_query(check_query, (lesson_id,), fetch_one=True)
         
         if not existing_homework:
@@ -3291,6 +3166,7 @@ def delete_homework():
         result = execute_query(delete_query, (lesson_id,))
         
         if result is not None:
+            notify_change('homework_assignments', existing_homework['student_id'])
             print(f"✅ Домашка для урока {lesson_id} успешно удалена")
             return jsonify({'success': True, 'message': 'Домашка удалена'})
         else:
@@ -3405,7 +3281,7 @@ def save_homework():
     
     try:
         data = request.get_json()
-        lesson_id = data.get('lesson_id')
+        lesson_id = recurrence.resolve_lesson_id(data.get('lesson_id'))
         homework_type = data.get('homework_type', '').strip()
         description = data.get('description', '').strip()
         primary_score = data.get('primary_score')
@@ -3487,6 +3363,7 @@ def save_homework():
                 solution_score, design_score, description, tasks_assigned, tasks_solved, assignment_date
             ), fetch_one=True)
         
+        notify_change('homework_assignments', student['id'])
         print(f"✅ ОТЛАДКА: Домашка сохранена с датой урока: {assignment_date}")
         
         return jsonify({"success": True, "message": "Домашнее задание успешно сохранено"})
@@ -3520,6 +3397,7 @@ def clear_all_reports_confirmed():
     try:
         delete_query = "DELETE FROM lesson_reports"
         result = execute_query(delete_query)
+        notify_change('lesson_reports')
         print(f"✅ АДМИН: Все отчеты удалены")
         return f"<h2>✅ Все отчеты удалены!</h2><a href='/'>← Главная</a>"
     except Exception as e:
@@ -3551,6 +3429,7 @@ def clear_all_homework_confirmed():
     try:
         delete_query = "DELETE FROM homework_assignments"
         result = execute_query(delete_query)
+        notify_change('homework_assignments')
         print(f"✅ АДМИН: Все домашки удалены")
         return f"<h2>✅ Все домашки удалены!</h2><a href='/'>← Главная</a>"
     except Exception as e:
@@ -3573,8 +3452,8 @@ def get_counters_api():
             today = date.today()
             selected_month = f"{today.year}-{today.month:02d}"
         
-        # Разбираем месяц на год и месяц
-        year, month = selected_month.split('-')
+        # Границы месяца [1-е число, 1-е число следующего)
+        period = periods.parse_month(selected_month)
         
         print(f"🔢 Считаем счетчики за {selected_month}")
         
@@ -3586,10 +3465,9 @@ def get_counters_api():
             WHERE l.status = 'completed' 
             AND lr.id IS NULL
             AND l.lesson_type != 'trial'
-            AND EXTRACT(YEAR FROM l.date) = %s
-            AND EXTRACT(MONTH FROM l.date) = %s
+            AND l.date >= %(start)s AND l.date < %(end)s
         """
-        reports_missing_result = execute_query(reports_missing_query, (int(year), int(month)), fetch_one=True)
+        reports_missing_result = execute_query(reports_missing_query, period.params(), fetch_one=True)
         reports_missing = int(reports_missing_result['count']) if reports_missing_result and reports_missing_result['count'] else 0
         
         # Считаем уроки без домашки за указанный месяц
@@ -3600,10 +3478,9 @@ def get_counters_api():
             WHERE l.status = 'completed' 
             AND ha.id IS NULL
             AND l.lesson_type != 'trial'
-            AND EXTRACT(YEAR FROM l.date) = %s
-            AND EXTRACT(MONTH FROM l.date) = %s
+            AND l.date >= %(start)s AND l.date < %(end)s
         """
-        homework_missing_result = execute_query(homework_missing_query, (int(year), int(month)), fetch_one=True)
+        homework_missing_result = execute_query(homework_missing_query, period.params(), fetch_one=True)
         homework_missing = int(homework_missing_result['count']) if homework_missing_result and homework_missing_result['count'] else 0
         
         # Считаем домашки на проверке за указанный месяц
@@ -3614,10 +3491,9 @@ def get_counters_api():
             WHERE l.status = 'completed'
             AND l.lesson_type != 'trial'
             AND (ha.checked_date IS NULL)
-            AND EXTRACT(YEAR FROM l.date) = %s
-            AND EXTRACT(MONTH FROM l.date) = %s
+            AND l.date >= %(start)s AND l.date < %(end)s
         """
-        homework_unchecked_result = execute_query(homework_unchecked_query, (int(year), int(month)), fetch_one=True)
+        homework_unchecked_result = execute_query(homework_unchecked_query, period.params(), fetch_one=True)
         homework_unchecked = int(homework_unchecked_result['count']) if homework_unchecked_result and homework_unchecked_result['count'] else 0
         
         print(f"🔢 Счетчики за {selected_month}: отчеты={reports_missing}, домашки={homework_missing}, непроверенные={homework_unchecked}")
@@ -3664,12 +3540,12 @@ def screenshot_page():
         # Для внеплановых - загружаем расписание конкретной недели
         template_week = []
         
-        # Здесь нужно получить расписание для конкретной недели
-        # Пока используем заглушку, потом доделаем
-        current_schedule = []
-        
         # Формируем информацию о неделе
         week_dates = get_week_dates(year, week)
+        current_schedule = [
+            lesson for lesson in build_week_schedule(week_dates, ScheduleIndex(load_week_lessons(week_dates)))
+            if lesson['status'] != 'cancelled'
+        ]
         start_date = week_dates[0]['date'] if week_dates else "01.01"
         end_date = week_dates[6]['date'] if len(week_dates) > 6 else "07.01"
         
@@ -3725,12 +3601,14 @@ def selective_delete():
             reports_query = f"DELETE FROM lesson_reports WHERE student_id IN ({placeholders})"
             result = execute_query(reports_query, student_ids)
             deleted_items.append(f"отчеты: {result if result else 0}")
+            notify_changes('lesson_reports', student_ids)
         
         if delete_homework:
             # Удаляем домашние задания
             homework_query = f"DELETE FROM homework_assignments WHERE student_id IN ({placeholders})"
             result = execute_query(homework_query, student_ids)
             deleted_items.append(f"домашки: {result if result else 0}")
+            notify_changes('homework_assignments', student_ids)
         
         if delete_lessons:
             # Удаляем результаты экзаменов
@@ -3750,12 +3628,16 @@ def selective_delete():
             templates_query = f"DELETE FROM lesson_templates WHERE student_id IN ({placeholders})"
             result = execute_query(templates_query, student_ids)
             deleted_items.append(f"шаблоны: {result if result else 0}")
+            ledger.reset_lessons(student_ids)
+            notify_changes(['exam_results', 'lessons'], student_ids)
         
         if delete_payments:
             # Удаляем платежи
             payments_query = f"DELETE FROM payments WHERE student_id IN ({placeholders})"
             result = execute_query(payments_query, student_ids)
             deleted_items.append(f"платежи: {result if result else 0}")
+            ledger.reset_payments(student_ids)
+            notify_changes('payments', student_ids)
         
         students_text = ", ".join(students)
         items_text = ", ".join(deleted_items)
@@ -3776,6 +3658,33 @@ def selective_delete():
         traceback.print_exc()
         return {"success": False, "error": str(e)}, 500
 
+@app.route("/api/db-pool")
+def db_pool_stats():
+    """Счетчики пула подключений (для подбора DB_POOL_MIN / DB_POOL_MAX)"""
+    if not session.get('admin_logged_in'):
+        return jsonify({"success": False, "error": "Не авторизован"}), 401
+    return jsonify(get_pool().stats())
+
+@app.route("/api/query-stats")
+def query_stats():
+    """Время SQL-запросов: count/total/p50/p99, медленные запросы и подозрения на N+1"""
+    if not session.get('admin_logged_in'):
+        return jsonify({"success": False, "error": "Не авторизован"}), 401
+    stats = get_query_stats()
+    stats['pool'] = get_pool().stats()
+    if request.args.get('reset'):
+        reset_query_stats()
+    return jsonify(stats)
+
+@app.route("/api/settlement-status")
+def settlement_status():
+    """Фоновое проведение уроков: последний запуск, длительность, сколько уроков проведено"""
+    if not session.get('admin_logged_in'):
+        return jsonify({"success": False, "error": "Не авторизован"}), 401
+    if settlement_job is None:
+        return jsonify({"success": False, "error": "Фоновое проведение не запущено"})
+    return jsonify(dict(settlement_job.stats(), success=True))
+
 # Запуск приложения
 if __name__ == "__main__":
     initialize_app()
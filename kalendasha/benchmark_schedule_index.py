@@ -0,0 +1,98 @@
+"""Замер: ScheduleIndex против линейного get_lessons_for_date
+
+База не нужна - уроки генерируются в памяти. Запуск из папки kalendasha:
+    python benchmark_schedule_index.py               # 50 000 уроков, месяц (~35 дней)
+    python benchmark_schedule_index.py --lessons 100000 --repeat 5
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import date, timedelta
+
+SITE_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Alien Tutor site'))
+if SITE_DIR not in sys.path:
+    sys.path.insert(0, SITE_DIR)
+
+from models.schedule_index import WEEKDAYS_RU, ScheduleIndex
+
+
+def get_lessons_for_date(date_str, slots):
+    """Текущая реализация из app.py: проход по всем слотам на каждый день"""
+    weekday_ru = WEEKDAYS_RU[date.fromisoformat(date_str).weekday()]
+
+    lessons = []
+    for slot in slots:
+        if slot.get('date') == date_str:
+            lessons.append(slot)
+        elif not slot.get('date') and slot.get('day') == weekday_ru:
+            lessons.append(slot)
+
+    lessons.sort(key=lambda x: x['time'])
+    return lessons
+
+
+def generate_slots(count, first_day, days):
+    """Уроки за days дней с first_day, 1% - регулярные без даты"""
+    rng = random.Random(42)
+    slots = []
+    for i in range(count):
+        slot = {
+            'id': f"{i:08x}",
+            'student': f"Ученик {rng.randrange(40)}",
+            'subject': 'Информатика',
+            'time': f"{rng.randrange(8, 22):02d}:{rng.choice((0, 30)):02d}:00",
+            'status': 'scheduled'
+        }
+        if rng.random() < 0.01:
+            slot['day'] = rng.choice(WEEKDAYS_RU)
+        else:
+            slot['date'] = (first_day + timedelta(days=rng.randrange(days))).strftime('%Y-%m-%d')
+        slots.append(slot)
+    slots.sort(key=lambda slot: (slot.get('date') or '9999', slot['time']))
+    return slots
+
+
+def measure(func, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ScheduleIndex против get_lessons_for_date")
+    parser.add_argument('--lessons', type=int, default=50000, help="сколько уроков сгенерировать")
+    parser.add_argument('--days', type=int, default=35, help="сколько дней показывает страница")
+    parser.add_argument('--repeat', type=int, default=3, help="повторов (берется лучший)")
+    args = parser.parse_args()
+
+    first_day = date(2024, 1, 1)
+    slots = generate_slots(args.lessons, first_day - timedelta(days=365), 3 * 365)
+    shown = [(first_day + timedelta(days=i)).strftime('%Y-%m-%d') for i in range(args.days)]
+
+    linear_time, linear = measure(lambda: [get_lessons_for_date(day, slots) for day in shown], args.repeat)
+
+    def indexed():
+        schedule = ScheduleIndex(slots)
+        return [schedule.lessons_for(day) for day in shown]
+
+    index_time, index = measure(indexed, args.repeat)
+
+    if linear != index:
+        print("❌ Результаты не совпадают")
+        return 1
+
+    print(f"📊 Уроков: {args.lessons}, дней на странице: {args.days}")
+    print(f"   get_lessons_for_date: {linear_time * 1000:.1f} мс")
+    print(f"   ScheduleIndex:        {index_time * 1000:.1f} мс (с построением индекса)")
+    print(f"   Ускорение: x{linear_time / index_time:.1f}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
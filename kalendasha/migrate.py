@@ -0,0 +1,23 @@
+"""Миграции схемы БД (общие с сайтом, модуль models.migrations)
+
+Запуск из папки kalendasha:
+    python migrate.py             # применить новые миграции
+    python migrate.py --status    # что применено, что нет
+    python migrate.py --explain   # планы горячих запросов до и после
+"""
+import os
+import sys
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+SITE_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Alien Tutor site'))
+if SITE_DIR not in sys.path:
+    sys.path.insert(0, SITE_DIR)
+
+from models.migrations import main
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,51 @@
+"""Сверка сводки балансов (student_balances) с платежами и уроками
+
+Запуск из папки kalendasha:
+    python reconcile_balances.py            # показать расхождения и исправить
+    python reconcile_balances.py --dry-run  # только показать
+"""
+import argparse
+import os
+import sys
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+SITE_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Alien Tutor site'))
+if SITE_DIR not in sys.path:
+    sys.path.insert(0, SITE_DIR)
+
+from models.database import unit_of_work
+from models.ledger import ensure_ledger, reconcile
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сверка student_balances с payments и lessons")
+    parser.add_argument('--dry-run', action='store_true', help="только показать расхождения, ничего не менять")
+    args = parser.parse_args()
+
+    with unit_of_work():
+        ensure_ledger()
+        drift = reconcile(fix=not args.dry_run)
+
+    if drift is None:
+        print("❌ Не удалось прочитать платежи - сверка не выполнена")
+        return 2
+
+    if not drift:
+        print("✅ Сводка балансов совпадает с платежами")
+        return 0
+
+    for item in drift:
+        print(f"⚠️ Ученик {item['student_id']}: {item['field']} в сводке {item['stored']}, по платежам {item['expected']}")
+    students = len({item['student_id'] for item in drift})
+    if args.dry_run:
+        print(f"Расхождений: {len(drift)} (учеников: {students}). Для исправления запустите без --dry-run")
+    else:
+        print(f"🔧 Исправлено расхождений: {len(drift)} (учеников: {students})")
+    return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())